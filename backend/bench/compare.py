@@ -0,0 +1,68 @@
+import argparse, json, sys
+
+## bench/compare.py compares two results files written by bench/run.py
+## run it from backend/ with `python -m bench.compare base.json new.json`
+
+## changes smaller than this fraction are reported as noise
+DEFAULT_THRESHOLD = 0.1
+
+
+def load(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+# Returns {metric name: (value, True if higher is better)} for a results file
+def flatten(results: dict) -> dict:
+    metrics = {}
+    for run in results.get("engine", []):
+        fixture = f"engine {run['duration']}s/{run['voices']}v"
+        metrics[f"{fixture} p50"] = (run["latency"]["p50"], False)
+        metrics[f"{fixture} p95"] = (run["latency"]["p95"], False)
+        for stage, timing in run["stages"].items():
+            metrics[f"{fixture} {stage}"] = (timing["mean"], False)
+    for run in results.get("endpoints", []):
+        burst = f"{run['endpoint']} x{run['concurrency']}"
+        metrics[f"{burst} throughput"] = (run["throughput"], True)
+        metrics[f"{burst} p95"] = (run["latency"].get("p95", 0.0), False)
+    for name, value in results.get("memory", {}).items():
+        metrics[name] = (value, False)
+    return metrics
+
+
+# Prints every metric both files have, returns the names of the ones that got worse
+def Compare(base: dict, new: dict, threshold: float = DEFAULT_THRESHOLD) -> list:
+    base_metrics = flatten(base)
+    new_metrics = flatten(new)
+    print(f"base: {base['meta'].get('commit')}  new: {new['meta'].get('commit')}")
+    regressions = []
+    width = max((len(name) for name in new_metrics), default=0)
+    for name, (value, higher_is_better) in new_metrics.items():
+        if name not in base_metrics:
+            continue
+        previous = base_metrics[name][0]
+        change = (value - previous) / previous if previous else 0.0
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > threshold:
+            flag = "REGRESSION"
+            regressions.append(name)
+        elif worse < -threshold:
+            flag = "improved"
+        print(f"{name:<{width}}  {previous:10.3f} -> {value:10.3f}  {change:+7.1%}  {flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark results files")
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument(
+        "--threshold", type=float, default=DEFAULT_THRESHOLD,
+        help="fractional change that counts as a regression",
+    )
+    args = parser.parse_args()
+    regressions = Compare(load(args.base), load(args.new), args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regressions over {args.threshold:.0%}")
+        sys.exit(1)
@@ -0,0 +1,81 @@
+import argparse, os
+import numpy as np
+import soundfile as sf
+
+## fixtures.py synthesizes the benchmark recordings, a seeded random violin-like
+## melody with up to a few extra voices, so every machine benchmarks the same audio
+
+SAMPLE_RATE = 22050
+DEFAULT_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+DEFAULT_DURATIONS = (10, 30, 120, 300)
+DEFAULT_POLYPHONY = (1, 3)
+
+## G major from the violin's open G up two octaves, as MIDI pitches
+SCALE = [55, 57, 59, 60, 62, 64, 66, 67, 69, 71, 72, 74, 76, 78, 79, 81, 83]
+## note lengths in beats
+NOTE_BEATS = [0.5, 1, 1, 2]
+HARMONICS = 6
+
+
+# Returns a mono float32 recording of the given length with `voices` notes sounding at once
+def synthesize(duration: float, voices: int, seed: int = 0, bpm: int = 100) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    total = int(duration * SAMPLE_RATE)
+    audio = np.zeros(total, dtype=np.float32)
+    beat = 60 / bpm
+    start = 0
+    while start < total:
+        length = int(beat * rng.choice(NOTE_BEATS) * SAMPLE_RATE)
+        end = min(total, start + length)
+        t = np.arange(end - start) / SAMPLE_RATE
+        ## short attack and release so onsets are clear but don't click
+        envelope = np.minimum(1, t / 0.02) * np.minimum(1, (t[-1] - t + 1e-3) / 0.05)
+        root = rng.integers(0, len(SCALE) - 2 * voices)
+        for voice in range(voices):
+            ## stack thirds on the root so chords stay in key
+            pitch = SCALE[root + 2 * voice]
+            freq = 440 * 2 ** ((pitch - 69) / 12)
+            tone = sum(
+                np.sin(2 * np.pi * freq * k * t) / k
+                for k in range(1, HARMONICS + 1)
+                if freq * k < SAMPLE_RATE / 2
+            )
+            audio[start:end] += (tone * envelope / voices).astype(np.float32)
+        start = end
+    audio += rng.normal(0, 0.002, total).astype(np.float32)
+    return audio * 0.3
+
+
+def fixture_name(duration: float, voices: int) -> str:
+    return f"fixture_{int(duration)}s_{voices}v.wav"
+
+
+# Writes every missing fixture to directory, returns {(duration, voices): path}
+def EnsureFixtures(
+    directory: str = DEFAULT_DIR,
+    durations=DEFAULT_DURATIONS,
+    polyphony=DEFAULT_POLYPHONY,
+) -> dict:
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for duration in durations:
+        for voices in polyphony:
+            path = os.path.join(directory, fixture_name(duration, voices))
+            if not os.path.exists(path):
+                ## the seed only depends on the fixture, so regenerating is reproducible
+                audio = synthesize(duration, voices, seed=int(duration) * 10 + voices)
+                sf.write(path, audio, SAMPLE_RATE, subtype="PCM_16")
+            paths[(duration, voices)] = path
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate benchmark fixture audio")
+    parser.add_argument("--dir", default=DEFAULT_DIR)
+    parser.add_argument("--durations", type=int, nargs="+", default=DEFAULT_DURATIONS)
+    parser.add_argument("--polyphony", type=int, nargs="+", default=DEFAULT_POLYPHONY)
+    args = parser.parse_args()
+    for (duration, voices), path in EnsureFixtures(
+        args.dir, args.durations, args.polyphony
+    ).items():
+        print(f"{duration}s, {voices} voices: {path}")
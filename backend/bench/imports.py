@@ -0,0 +1,92 @@
+import os
+
+## bench/imports.py measures how long the API process takes to start:
+## importing main, answering its first request, and with --preload, until /ready says
+## a worker's model is warm. every measurement runs in a fresh interpreter
+## run it from backend/ with `python -m bench.imports`
+
+import argparse, json, subprocess, sys
+
+## importing bench.run also sets the environment the API needs to import
+from bench.run import summarize, log_line
+
+## what each fresh interpreter runs, it prints its measurements as JSON
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter() - start
+from fastapi.testclient import TestClient
+with TestClient(main.app) as client:
+    client.get("/ready")
+    first_response = time.perf_counter() - start
+    ready = None
+    while {preload} and time.perf_counter() - start < {timeout}:
+        if client.get("/ready").status_code == 200:
+            ready = time.perf_counter() - start
+            break
+        time.sleep(0.05)
+print(json.dumps({{"import": imported, "first_response": first_response, "ready": ready}}))
+"""
+
+
+# Returns [(cumulative seconds, module)] for the slowest imports of main
+def slowest_imports(count: int) -> list:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split(":", 1)[1].split("|")
+        modules.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(modules, reverse=True)[:count]
+
+
+def startup(preload: bool, timeout: float) -> dict:
+    env = dict(os.environ, ENGINE_PRELOAD="1" if preload else "")
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT.format(preload=preload, timeout=timeout)],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=env,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure API startup time")
+    parser.add_argument("--repeat", type=int, default=3, help="fresh interpreters per mode")
+    parser.add_argument("--top", type=int, default=15, help="slowest imports to list")
+    parser.add_argument(
+        "--preload", action="store_true", help="also time ENGINE_PRELOAD until /ready"
+    )
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for /ready")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {"slowest_imports": slowest_imports(args.top)}
+    for seconds, module in results["slowest_imports"]:
+        log_line(f"{seconds * 1000:8.1f}ms  {module}")
+    for preload in [False, True] if args.preload else [False]:
+        runs = [startup(preload, args.timeout) for _ in range(args.repeat)]
+        mode = "preload" if preload else "lazy"
+        results[mode] = {
+            key: summarize([run[key] for run in runs if run[key] is not None])
+            for key in ("import", "first_response", "ready")
+        }
+        line = (
+            f"{mode}: import main {results[mode]['import']['p50'] * 1000:.0f}ms, "
+            f"first response {results[mode]['first_response']['p50'] * 1000:.0f}ms"
+        )
+        if results[mode]["ready"]:
+            line += f", ready {results[mode]['ready']['p50'] * 1000:.0f}ms"
+        log_line(line)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,355 @@
+import os
+
+## bench/run.py benchmarks the transcription pipeline and writes the results as JSON
+## run it from backend/ with `python -m bench.run`, see README for the options
+
+## the API needs these to import, the benchmark never talks to Stripe or Auth0
+for name in (
+    "STRIPE_SK",
+    "STRIPE_WEBHOOK_SK",
+    "STRIPE_PRICE_ID",
+    "AUTH0_BASE",
+    "AUTH0_CLIENT_ID",
+    "AUTH0_CLIENT_SECRET",
+    "AUTH0_PRO_ROLE_ID",
+    "PROD",
+):
+    os.environ.setdefault(name, "")
+os.environ.setdefault("FRONTEND_HOST", "http://localhost:3000")
+## the engine logs every step at INFO, which would swamp the report
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+## a disk cache left over from an earlier run would turn transcriptions into cache hits
+os.environ.setdefault("RESULT_CACHE_DIR", "")
+
+import argparse, asyncio, datetime, json, multiprocessing, platform, resource
+import secrets, shutil, subprocess, sys, time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from bench.fixtures import EnsureFixtures, DEFAULT_DIR, DEFAULT_DURATIONS, DEFAULT_POLYPHONY
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+ENDPOINT_UPLOAD = "upload"
+ENDPOINT_JOBS = "jobs"
+BENCH_USER = "bench-pro-user"
+## seconds between polls of a running job
+JOB_POLL_SECONDS = 0.1
+## last stage every transcription reports, used to tell when all timings have arrived
+LAST_STAGE = "score_write"
+
+
+def summarize(values: list) -> dict:
+    if not values:
+        return {}
+    values = np.asarray(values, dtype=float)
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "min": float(values.min()),
+        "max": float(values.max()),
+    }
+
+
+# Calls fn repeat times, returns its last result and the summarized run times
+def timed(fn, repeat: int):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, summarize(times)
+
+
+def git_revision() -> dict:
+    def git(*args):
+        return subprocess.run(
+            ["git", *args], capture_output=True, text=True, check=True
+        ).stdout.strip()
+
+    try:
+        return {
+            "commit": git("rev-parse", "HEAD"),
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        }
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+
+# Returns peak resident memory in MB from a getrusage result
+def maxrss_mb(usage) -> float:
+    ## Linux reports kilobytes, macOS bytes
+    scale = 1 if sys.platform == "darwin" else 1024
+    return usage.ru_maxrss * scale / (1024 * 1024)
+
+
+# Returns the peak resident memory in MB of every live worker process
+## getrusage only covers children once they have exited, so read /proc while they run
+def worker_peak_rss() -> list:
+    peaks = []
+    for process in multiprocessing.active_children():
+        try:
+            with open(f"/proc/{process.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        peaks.append(int(line.split()[1]) / 1024)
+        except OSError:
+            pass
+    return peaks
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.worker_peaks = []
+
+    # Copies a fixture into a scratch space of its own, the engine releases it when done
+    def stage_copy(self, path: str) -> str:
+        from engine.scratch import scratch_manager
+
+        copy = scratch_manager.Create().Path(f"bench_{secrets.token_hex(8)}.wav")
+        shutil.copyfile(path, copy)
+        return copy
+
+    ## workers send stage timings through a queue, wait for them to be recorded
+    async def stage_deltas(self, before: dict, runs: int) -> dict:
+        from metrics import STAGE_SECONDS
+
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            after = STAGE_SECONDS.Snapshot()
+            done = after.get((LAST_STAGE,), (0, 0))[1] - before.get((LAST_STAGE,), (0, 0))[1]
+            if done >= runs:
+                break
+            await asyncio.sleep(0.05)
+        stages = {}
+        for (stage,), (total, count) in sorted(after.items()):
+            previous_total, previous_count = before.get((stage,), (0.0, 0))
+            if count > previous_count:
+                stages[stage] = {
+                    "mean": (total - previous_total) / (count - previous_count),
+                    "count": count - previous_count,
+                }
+        return stages
+
+    async def transcribe(self, path: str):
+        from engine.engine import MusicEngine
+
+        ## a random hash keeps the result cache from answering
+        await MusicEngine.ProcessSaved(
+            self.stage_copy(path), secrets.token_hex(32), "bench"
+        )
+
+    # Transcribes each fixture through MusicEngine directly, without HTTP
+    async def run_engine(self, fixtures: dict) -> list:
+        from engine.engine import MusicEngine
+        from metrics import STAGE_SECONDS
+
+        MusicEngine.Start()
+        results = []
+        try:
+            ## the first job also pays for starting the worker and loading the model
+            for _ in range(self.args.warmup):
+                await self.transcribe(fixtures[min(fixtures)])
+            for (duration, voices), path in fixtures.items():
+                before = STAGE_SECONDS.Snapshot()
+                latencies = []
+                for _ in range(self.args.repeat):
+                    start = time.perf_counter()
+                    await self.transcribe(path)
+                    latencies.append(time.perf_counter() - start)
+                result = {
+                    "duration": duration,
+                    "voices": voices,
+                    "runs": self.args.repeat,
+                    "latency": summarize(latencies),
+                    "realtime_factor": float(np.mean(latencies)) / duration,
+                    "stages": await self.stage_deltas(before, self.args.repeat),
+                }
+                log_line(
+                    f"engine {duration}s/{voices}v: "
+                    f"p50 {result['latency']['p50']:.2f}s, "
+                    f"{result['realtime_factor']:.3f}x realtime"
+                )
+                results.append(result)
+        finally:
+            self.worker_peaks.extend(worker_peak_rss())
+            MusicEngine.Shutdown()
+        return results
+
+    def request_upload(self, client, path: str, name: str):
+        with open(path, "rb") as audio:
+            response = client.post(
+                "/api/v1/upload",
+                data={"user_id": BENCH_USER},
+                files={"file": (name, audio, "audio/wav")},
+            )
+        return response.status_code
+
+    def request_job(self, client, path: str, name: str):
+        from engine.jobs import STATUS_DONE, STATUS_FAILED
+
+        with open(path, "rb") as audio:
+            response = client.post(
+                "/api/v1/jobs/upload",
+                data={"user_id": BENCH_USER},
+                files={"file": (name, audio, "audio/wav")},
+            )
+        if response.status_code != 202:
+            return response.status_code
+        job_id = response.json()["job_id"]
+        while True:
+            job = client.get(
+                f"/api/v1/jobs/{job_id}", params={"response_format": "artifacts"}
+            ).json()
+            if job["status"] == STATUS_DONE:
+                return 200
+            if job["status"] == STATUS_FAILED:
+                return STATUS_FAILED
+            time.sleep(JOB_POLL_SECONDS)
+
+    # Sends bursts of concurrent transcription requests through the FastAPI app
+    def run_endpoints(self, path: str, duration: int, voices: int) -> list:
+        from fastapi.testclient import TestClient
+        import main
+
+        requests = {
+            ENDPOINT_UPLOAD: self.request_upload,
+            ENDPOINT_JOBS: self.request_job,
+        }
+        results = []
+        with TestClient(main.app) as client:
+            for _ in range(self.args.warmup):
+                self.request_upload(client, path, f"warmup_{secrets.token_hex(8)}.wav")
+            for endpoint in self.args.endpoints:
+                for concurrency in self.args.concurrency:
+                    latencies = []
+                    statuses = {}
+
+                    def one(index):
+                        ## the filename is the score title, part of the cache key
+                        name = f"bench_{secrets.token_hex(8)}.wav"
+                        start = time.perf_counter()
+                        status = requests[endpoint](client, path, name)
+                        latencies.append(time.perf_counter() - start)
+                        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+                    start = time.perf_counter()
+                    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                        list(executor.map(one, range(concurrency)))
+                    wall = time.perf_counter() - start
+                    ok = statuses.get("200", 0)
+                    result = {
+                        "endpoint": endpoint,
+                        "concurrency": concurrency,
+                        "duration": duration,
+                        "voices": voices,
+                        "requests": concurrency,
+                        "statuses": statuses,
+                        "wall_seconds": wall,
+                        "throughput": ok / wall,
+                        "audio_seconds_per_second": ok * duration / wall,
+                        "latency": summarize(latencies),
+                    }
+                    log_line(
+                        f"{endpoint} x{concurrency}: {result['throughput']:.2f} req/s, "
+                        f"p95 {result['latency']['p95']:.2f}s, statuses {statuses}"
+                    )
+                    results.append(result)
+            self.worker_peaks.extend(worker_peak_rss())
+        return results
+
+    def Run(self) -> dict:
+        args = self.args
+        fixtures = EnsureFixtures(args.fixtures_dir, args.durations, args.polyphony)
+
+        ## stub the Auth0 lookups, the benchmark user is always Pro so it is never rate limited
+        import client.client as client
+
+        client.InitClient = lambda: None
+        client.fetchHasProRole = lambda user_id: True
+
+        from engine.engine import worker_pool
+        from engine.worker import stream_threshold, chunk_seconds
+
+        results = {
+            "meta": {
+                **git_revision(),
+                "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "workers": worker_pool.workers,
+                "queue_size": worker_pool.queue_size,
+                "stream_threshold": stream_threshold,
+                "chunk_seconds": chunk_seconds,
+                "args": {
+                    key: value for key, value in vars(args).items() if key != "output"
+                },
+            },
+            "engine": [],
+            "endpoints": [],
+        }
+        if not args.skip_engine:
+            results["engine"] = asyncio.run(self.run_engine(fixtures))
+        if not args.skip_endpoints:
+            key = (args.endpoint_duration, args.endpoint_voices)
+            if key not in fixtures:
+                fixtures.update(EnsureFixtures(args.fixtures_dir, [key[0]], [key[1]]))
+            results["endpoints"] = self.run_endpoints(fixtures[key], *key)
+        results["memory"] = {
+            "api_peak_rss_mb": maxrss_mb(resource.getrusage(resource.RUSAGE_SELF)),
+            "worker_peak_rss_mb": max(
+                self.worker_peaks
+                + [maxrss_mb(resource.getrusage(resource.RUSAGE_CHILDREN))]
+            ),
+        }
+        log_line(
+            f"peak RSS: API {results['memory']['api_peak_rss_mb']:.0f} MB, "
+            f"worker {results['memory']['worker_peak_rss_mb']:.0f} MB"
+        )
+        return results
+
+
+def log_line(message: str):
+    print(message, flush=True)
+
+
+def default_output(results: dict) -> str:
+    commit = (results["meta"]["commit"] or "unknown")[:8]
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    return os.path.join(RESULTS_DIR, f"{stamp}-{commit}.json")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the transcription pipeline")
+    parser.add_argument("--durations", type=int, nargs="+", default=DEFAULT_DURATIONS)
+    parser.add_argument("--polyphony", type=int, nargs="+", default=DEFAULT_POLYPHONY)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per fixture")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 2, 4],
+        help="concurrent requests in each endpoint burst",
+    )
+    parser.add_argument(
+        "--endpoints", nargs="+", choices=[ENDPOINT_UPLOAD, ENDPOINT_JOBS],
+        default=[ENDPOINT_UPLOAD, ENDPOINT_JOBS],
+    )
+    parser.add_argument("--endpoint-duration", type=int, default=30)
+    parser.add_argument("--endpoint-voices", type=int, default=1)
+    parser.add_argument("--skip-engine", action="store_true")
+    parser.add_argument("--skip-endpoints", action="store_true")
+    parser.add_argument("--fixtures-dir", default=DEFAULT_DIR)
+    parser.add_argument("--output", help="results file, defaults to bench/results/")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    ## bursts bigger than the default queue would just measure 503s
+    os.environ.setdefault("ENGINE_QUEUE_SIZE", str(max(args.concurrency)))
+    results = Benchmark(args).Run()
+    output = args.output or default_output(results)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    log_line(f"wrote {output}")
@@ -0,0 +1,122 @@
+import os
+
+## bench/scores.py checks the direct MusicXML writer against the music21 one:
+## both write each fixture's transcription, then the scores are compared note by note
+## run it from backend/ with `python -m bench.scores`
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import argparse, json, warnings
+import numpy as np
+from music21 import converter
+from bench.fixtures import EnsureFixtures, DEFAULT_DIR, DEFAULT_DURATIONS, DEFAULT_POLYPHONY
+from bench.run import timed, log_line
+
+## notes are compared with each other and with the note events they were written from
+## onsets closer than this many quarter notes count as the same note,
+## music21 rounds to sixteenths or triplet eighths, the direct writer to sixteenths only
+ONSET_TOLERANCE = 0.25
+
+
+# Returns the (onset in quarter notes, MIDI pitch) of every note, and the key, of a MusicXML score
+def score_notes(mxml: str) -> tuple:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        score = converter.parseData(mxml, format="musicxml")
+    notes = []
+    for element in score.flatten().notes:
+        ## tied continuations are the same note
+        if element.tie is not None and element.tie.type != "start":
+            continue
+        for pitch in element.pitches:
+            notes.append((float(element.offset), pitch.midi))
+    signatures = score.flatten().getElementsByClass("KeySignature")
+    key = signatures[0].sharps if signatures else None
+    return notes, key
+
+
+# Returns the F1 score of matching notes of the same pitch with nearby onsets
+def note_f1(reference: list, candidate: list) -> float:
+    if not reference and not candidate:
+        return 1.0
+    unmatched = sorted(candidate)
+    matches = 0
+    for onset, pitch in sorted(reference):
+        for index, (other_onset, other_pitch) in enumerate(unmatched):
+            if other_pitch == pitch and abs(other_onset - onset) <= ONSET_TOLERANCE:
+                matches += 1
+                del unmatched[index]
+                break
+    precision = matches / len(candidate) if candidate else 0.0
+    recall = matches / len(reference) if reference else 0.0
+    if precision + recall == 0:
+        return 0.0
+    return 2 * precision * recall / (precision + recall)
+
+
+def compare_fixture(path: str, title: str, repeat: int) -> dict:
+    from engine.worker import create_midi
+    from engine.postprocess import BuildScore
+    from engine.settings import ScoreOptions, SCORE_WRITER_MUSIC21, SCORE_WRITER_DIRECT
+
+    _, note_events, tempo = create_midi(path)
+    music21_xml, music21_time = timed(
+        lambda: BuildScore(title, note_events, tempo, ScoreOptions(SCORE_WRITER_MUSIC21)),
+        repeat,
+    )
+    direct_xml, direct_time = timed(
+        lambda: BuildScore(title, note_events, tempo, ScoreOptions(SCORE_WRITER_DIRECT)),
+        repeat,
+    )
+    music21_notes, music21_key = score_notes(music21_xml)
+    direct_notes, direct_key = score_notes(direct_xml)
+    ## what basic-pitch heard, so a writer that drifts from the audio shows up as such
+    heard = [(onset * tempo / 60, pitch) for onset, _, pitch, *_ in note_events]
+    return {
+        "note_events": len(note_events),
+        "tempo": tempo,
+        "music21_seconds": music21_time,
+        "direct_seconds": direct_time,
+        "speedup": music21_time["p50"] / direct_time["p50"],
+        "music21_notes": len(music21_notes),
+        "direct_notes": len(direct_notes),
+        "note_f1": note_f1(music21_notes, direct_notes),
+        "music21_events_f1": note_f1(heard, music21_notes),
+        "direct_events_f1": note_f1(heard, direct_notes),
+        "same_key": music21_key == direct_key,
+        "music21_bytes": len(music21_xml),
+        "direct_bytes": len(direct_xml),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the MusicXML writers")
+    parser.add_argument("--durations", type=int, nargs="+", default=DEFAULT_DURATIONS)
+    parser.add_argument("--polyphony", type=int, nargs="+", default=DEFAULT_POLYPHONY)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per writer")
+    parser.add_argument("--fixtures-dir", default=DEFAULT_DIR)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    fixtures = EnsureFixtures(args.fixtures_dir, args.durations, args.polyphony)
+    for (duration, voices), path in fixtures.items():
+        result = compare_fixture(path, "Benchmark", args.repeat)
+        result.update(duration=duration, voices=voices)
+        results.append(result)
+        log_line(
+            f"{duration}s/{voices}v: note F1 {result['note_f1']:.3f} "
+            f"(against the note events: music21 {result['music21_events_f1']:.3f}, "
+            f"direct {result['direct_events_f1']:.3f}), "
+            f"same key {result['same_key']}, "
+            f"music21 {result['music21_seconds']['p50'] * 1000:.1f}ms, "
+            f"direct {result['direct_seconds']['p50'] * 1000:.1f}ms "
+            f"({result['speedup']:.0f}x)"
+        )
+    log_line(
+        f"mean note F1 {np.mean([r['note_f1'] for r in results]):.3f}, "
+        f"keys agree on {sum(r['same_key'] for r in results)}/{len(results)}"
+    )
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,84 @@
+import os
+
+## bench/tempo.py compares the excerpts tempo estimator with the full-track beat tracker:
+## both estimate the tempo of synthesized recordings of several lengths and tempos,
+## and their answers are checked against each other and the tempo the audio was made at
+## run it from backend/ with `python -m bench.tempo`
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import argparse, json
+from bench.fixtures import synthesize
+from bench.run import timed, log_line
+
+DEFAULT_DURATIONS = (30, 120, 300, 600)
+DEFAULT_TEMPOS = (72, 100, 132, 160)
+## estimates this close, relative to the reference, count as the same tempo
+TOLERANCE = 0.04
+
+
+## "same", "double", "half" or "other" for an estimate against a reference tempo
+def agreement(estimate: float, reference: float) -> str:
+    for name, factor in (("same", 1), ("double", 2), ("half", 0.5)):
+        if abs(estimate - reference * factor) <= reference * factor * TOLERANCE:
+            return name
+    return "other"
+
+
+def compare_recording(audio, bpm: int, repeat: int) -> dict:
+    from engine.tempo import (
+        onset_envelope,
+        tempo_from_envelope,
+        tempo_from_excerpts,
+        block_envelopes,
+        excerpt_ranges,
+    )
+
+    full, full_time = timed(lambda: tempo_from_envelope(onset_envelope(audio)), repeat)
+    ranges = excerpt_ranges(audio.shape[0])
+    excerpts, excerpts_time = timed(
+        lambda: tempo_from_excerpts(block_envelopes(audio, 0, ranges)), repeat
+    )
+    return {
+        "bpm": bpm,
+        "full_tempo": full,
+        "excerpts_tempo": excerpts,
+        "full_seconds": full_time,
+        "excerpts_seconds": excerpts_time,
+        "speedup": full_time["p50"] / excerpts_time["p50"],
+        "agrees_with_full": agreement(excerpts, full),
+        "full_vs_true": agreement(full, bpm),
+        "excerpts_vs_true": agreement(excerpts, bpm),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the tempo estimators")
+    parser.add_argument("--durations", type=int, nargs="+", default=DEFAULT_DURATIONS)
+    parser.add_argument("--tempos", type=int, nargs="+", default=DEFAULT_TEMPOS)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per estimator")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for duration in args.durations:
+        for bpm in args.tempos:
+            audio = synthesize(duration, 1, seed=duration * 10 + bpm, bpm=bpm)
+            result = compare_recording(audio, bpm, args.repeat)
+            result.update(duration=duration)
+            results.append(result)
+            log_line(
+                f"{duration}s at {bpm} BPM: full {result['full_tempo']} "
+                f"({result['full_seconds']['p50'] * 1000:.0f}ms), "
+                f"excerpts {result['excerpts_tempo']} "
+                f"({result['excerpts_seconds']['p50'] * 1000:.0f}ms, "
+                f"{result['speedup']:.1f}x), {result['agrees_with_full']}"
+            )
+    for key in ("agrees_with_full", "full_vs_true", "excerpts_vs_true"):
+        counts = {}
+        for result in results:
+            counts[result[key]] = counts.get(result[key], 0) + 1
+        log_line(f"{key}: " + ", ".join(f"{name} {count}" for name, count in counts.items()))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
@@ -1,5 +1,8 @@
-import logger, requests, os, time
-from util import MustGetEnv
+import asyncio, logger, requests, os, threading, time
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from util import MustGetEnv, GetIntEnv
+from metrics import Counter, Histogram
 from datetime import datetime
 
 ## client.py is used to interact with the Auth0 management api
@@ -11,6 +14,12 @@ AUTH0_BASE_ENV = "AUTH0_BASE"
 AUTH0_CLIENT_ID_ENV = "AUTH0_CLIENT_ID"
 AUTH0_CLIENT_SECRET_ENV = "AUTH0_CLIENT_SECRET"
 AUTH0_ROLE_ID_ENV = "AUTH0_PRO_ROLE_ID"
+ROLE_CACHE_TTL_ENV = "AUTH0_ROLE_CACHE_TTL"
+ROLE_CACHE_SIZE_ENV = "AUTH0_ROLE_CACHE_SIZE"
+POOL_SIZE_ENV = "AUTH0_POOL_SIZE"
+
+## seconds to wait on Auth0 before giving up on a request
+REQUEST_TIMEOUT = 10
 
 ## cache token so we don't need to get a new one on every request
 CURRENT_TOKEN = None
@@ -21,6 +30,35 @@ AUTH0_CLIENT_ID = ""
 AUTH0_CLIENT_SECRET = ""
 AUTH0_PRO_ROLE_ID = ""
 
+## one session for every Auth0 call, so connections (and their TLS handshakes) are reused
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_maxsize=GetIntEnv(POOL_SIZE_ENV, 10))
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+## guards the token, several threads can ask for one at once
+TOKEN_LOCK = threading.Lock()
+
+## user ID -> (has pro role, time the entry expires), oldest entries first
+## subscription changes invalidate entries, the TTL only bounds how stale
+## a role changed outside of String Scribe (e.g. in the Auth0 dashboard) can get
+ROLE_CACHE = OrderedDict()
+ROLE_CACHE_TTL = GetIntEnv(ROLE_CACHE_TTL_ENV, 5 * 60)
+ROLE_CACHE_SIZE = GetIntEnv(ROLE_CACHE_SIZE_ENV, 10000)
+ROLE_CACHE_LOCK = threading.Lock()
+## bumped by every invalidation, so a lookup that started before one doesn't cache its stale answer
+ROLE_CACHE_GENERATION = 0
+
+AUTH0_SECONDS = Histogram(
+    "string_scribe_auth0_request_seconds",
+    "Time spent on each kind of Auth0 call",
+    ("call",),
+)
+ROLE_LOOKUPS = Counter(
+    "string_scribe_role_lookups_total",
+    "Pro role checks by outcome (cache_hit, fetched, failed)",
+    ("outcome",),
+)
+
 
 def InitClient():
     global AUTH0_BASE, AUTH0_CLIENT_ID, AUTH0_CLIENT_SECRET, AUTH0_PRO_ROLE_ID
@@ -43,7 +81,10 @@ def AddProRole(user_id: str):
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
-        response = requests.post(url, json=payload, headers=headers)
+        with AUTH0_SECONDS.Time(call="add_role"):
+            response = SESSION.post(
+                url, json=payload, headers=headers, timeout=REQUEST_TIMEOUT
+            )
         # Auth0 returns 204 No Content on success for role assignment
         if response.status_code > 299:
             ## log and throw error
@@ -71,7 +112,10 @@ def RemoveProRole(user_id: str):
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
-        response = requests.delete(url, json=payload, headers=headers)
+        with AUTH0_SECONDS.Time(call="remove_role"):
+            response = SESSION.delete(
+                url, json=payload, headers=headers, timeout=REQUEST_TIMEOUT
+            )
         # Auth0 returns 204 No Content on success for role deletion
         if response.status_code > 299:
             error_msg = response.text
@@ -88,7 +132,15 @@ def RemoveProRole(user_id: str):
 
 ## fetches a new token from Auth0 if the cached one is expired
 def getToken() -> str:
+    if CURRENT_TOKEN and time.time() < TOKEN_EXPIRY:
+        return CURRENT_TOKEN
+    with TOKEN_LOCK:
+        return fetchToken()
+
+
+def fetchToken() -> str:
     global CURRENT_TOKEN, TOKEN_EXPIRY, AUTH0_BASE, AUTH0_CLIENT_ID, AUTH0_CLIENT_SECRET
+    ## another thread may have refreshed it while we waited for the lock
     if CURRENT_TOKEN and time.time() < TOKEN_EXPIRY:
         return CURRENT_TOKEN
     url = f"{AUTH0_BASE}/oauth/token"
@@ -99,7 +151,8 @@ def getToken() -> str:
         "grant_type": "client_credentials",
     }
     ## make request to Auth0
-    response = requests.post(url, json=payload)
+    with AUTH0_SECONDS.Time(call="token"):
+        response = SESSION.post(url, json=payload, timeout=REQUEST_TIMEOUT)
     response.raise_for_status()
     data = response.json()
     ## extract token from response
@@ -111,8 +164,66 @@ def getToken() -> str:
     return CURRENT_TOKEN
 
 
-# Check if user has Pro role
+## returns the cached role of the user, or None if it isn't cached
+def cachedRole(user_id: str):
+    with ROLE_CACHE_LOCK:
+        entry = ROLE_CACHE.get(user_id)
+        if entry is None:
+            return None
+        has_pro, expires_at = entry
+        if time.time() >= expires_at:
+            del ROLE_CACHE[user_id]
+            return None
+        return has_pro
+
+
+def cacheRole(user_id: str, has_pro: bool, generation: int):
+    with ROLE_CACHE_LOCK:
+        if generation != ROLE_CACHE_GENERATION:
+            return
+        ROLE_CACHE[user_id] = (has_pro, time.time() + ROLE_CACHE_TTL)
+        ROLE_CACHE.move_to_end(user_id)
+        while len(ROLE_CACHE) > ROLE_CACHE_SIZE:
+            ROLE_CACHE.popitem(last=False)
+
+
+## forgets the cached role of a user, call whenever their subscription changes
+def InvalidateRole(user_id: str):
+    global ROLE_CACHE_GENERATION
+    with ROLE_CACHE_LOCK:
+        ROLE_CACHE_GENERATION += 1
+        ROLE_CACHE.pop(user_id, None)
+
+
+# Check if user has Pro role, answered from the role cache when possible
 def HasProRole(user_id: str) -> bool:
+    has_pro = cachedRole(user_id)
+    if has_pro is not None:
+        ROLE_LOOKUPS.Inc(outcome="cache_hit")
+        return has_pro
+    generation = ROLE_CACHE_GENERATION
+    has_pro = fetchHasProRole(user_id)
+    ## failed lookups return None and aren't cached, so the next request tries again
+    if has_pro is None:
+        ROLE_LOOKUPS.Inc(outcome="failed")
+        return False
+    ROLE_LOOKUPS.Inc(outcome="fetched")
+    cacheRole(user_id, has_pro, generation)
+    return has_pro
+
+
+# Same as HasProRole, for async handlers: cache hits return right away
+# and misses go to Auth0 on a thread so the event loop keeps running
+async def HasProRoleAsync(user_id: str) -> bool:
+    has_pro = cachedRole(user_id)
+    if has_pro is not None:
+        ROLE_LOOKUPS.Inc(outcome="cache_hit")
+        return has_pro
+    return await asyncio.to_thread(HasProRole, user_id)
+
+
+## asks Auth0 whether the user has the Pro role, returns None if the lookup failed
+def fetchHasProRole(user_id: str):
     try:
         url = f"{AUTH0_BASE}/api/v2/users/{user_id}/roles"
         token = getToken()
@@ -121,14 +232,15 @@ def HasProRole(user_id: str) -> bool:
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
-        response = requests.get(url, headers=headers)
+        with AUTH0_SECONDS.Time(call="get_roles"):
+            response = SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
 
         if response.status_code != 200:
             error_msg = response.text
             log.error(
                 f"unexpected response from Auth0 (status {response.status_code}): {error_msg}"
             )
-            return False
+            return None
 
         roles = response.json()
         # Check if the pro role is in the user's roles
@@ -139,4 +251,4 @@ def HasProRole(user_id: str) -> bool:
 
     except Exception as err:
         log.error(f"Error while checking user roles: {err}")
-        return False
+        return None
@@ -0,0 +1,334 @@
+import argparse, asyncio, logger, os, random, sqlite3, threading, time
+import client.client as client
+from util import GetIntEnv
+from metrics import Counter, Gauge
+
+## role_queue.py applies the Pro role changes from Stripe's subscription webhooks
+## the webhook only records the event in a SQLite queue and answers right away,
+## a background task then makes the Auth0 calls, retrying with backoff until they succeed
+## events are keyed by their Stripe event ID, so Stripe's retries are only applied once
+## role additions are retried until they succeed, removals that run out of attempts
+## are kept as failed until they are replayed with `python -m client.role_queue replay`
+
+log = logger.get()
+
+ROLE_QUEUE_DB_ENV = "ROLE_QUEUE_DB"
+ROLE_QUEUE_MAX_ATTEMPTS_ENV = "ROLE_QUEUE_MAX_ATTEMPTS"
+
+ACTION_ADD = "add"
+ACTION_REMOVE = "remove"
+
+## what became of a queued event
+OUTCOME_APPLIED = "applied"
+OUTCOME_RETRY = "retry"
+OUTCOME_FAILED = "failed"
+## a newer event for the same user decided their role instead
+OUTCOME_SUPERSEDED = "superseded"
+OUTCOME_DUPLICATE = "duplicate"
+
+## first retry waits this long, then twice as long each time up to RETRY_MAX_SECONDS,
+## where additions keep retrying for as long as Auth0 keeps failing
+RETRY_BASE_SECONDS = 2
+RETRY_MAX_SECONDS = 10 * 60
+## events applied at once, each Auth0 call runs on its own thread
+BATCH_SIZE = 20
+## how often the consumer looks for retries that have come due
+POLL_SECONDS = 5
+## finished events are kept this long to recognize Stripe's retries,
+## which go on for up to three days
+KEEP_SECONDS = 7 * 24 * 60 * 60
+PURGE_EVERY_SECONDS = 60 * 60
+
+ROLE_EVENTS = Counter(
+    "string_scribe_role_events_total",
+    "Subscription webhook events by outcome (applied, retry, failed, superseded, duplicate)",
+    ("outcome",),
+)
+
+
+class RoleQueue:
+    """
+    Subscription events waiting to be applied to Auth0, kept in a SQLite file
+    so they survive restarts. Every method is safe to call from any thread.
+    """
+
+    ## max_attempts only applies to removals, a paying customer's role is never given up on
+    def __init__(self, path: str, max_attempts: int):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(
+            path, timeout=10, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        ## created is Stripe's timestamp for the event, events can arrive out of order
+        ## done_at stays NULL until the event is applied, superseded or given up on
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS role_events ("
+            "event_id TEXT PRIMARY KEY, user_id TEXT NOT NULL, action TEXT NOT NULL, "
+            "created REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt REAL NOT NULL, done_at REAL, outcome TEXT, error TEXT)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS role_events_pending "
+            "ON role_events (done_at, next_attempt)"
+        )
+        self.lock = threading.Lock()
+        self.max_attempts = max_attempts
+
+    ## records the event, returns False if it was already queued
+    def Enqueue(self, event_id: str, user_id: str, action: str, created: float) -> bool:
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO role_events "
+                "(event_id, user_id, action, created, next_attempt) VALUES (?, ?, ?, ?, ?)",
+                (event_id, user_id, action, created, time.time()),
+            )
+        if cursor.rowcount == 0:
+            ROLE_EVENTS.Inc(outcome=OUTCOME_DUPLICATE)
+            return False
+        return True
+
+    ## returns up to limit (event ID, user ID, action, attempts) that are due now,
+    ## only the newest pending event of each user, the older ones are marked superseded
+    def Due(self, limit: int) -> list:
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.conn.execute(
+                    "SELECT event_id, user_id, action, created, attempts, next_attempt "
+                    "FROM role_events WHERE done_at IS NULL ORDER BY created"
+                ).fetchall()
+                newest = {}
+                superseded = []
+                for row in rows:
+                    if row[1] in newest:
+                        superseded.append(newest[row[1]][0])
+                    newest[row[1]] = row
+                ## a late retry of an old event must not undo a newer one already applied
+                for user_id, row in list(newest.items()):
+                    applied = self.conn.execute(
+                        "SELECT 1 FROM role_events WHERE user_id = ? AND outcome = ? "
+                        "AND created > ? LIMIT 1",
+                        (user_id, OUTCOME_APPLIED, row[3]),
+                    ).fetchone()
+                    if applied:
+                        superseded.append(row[0])
+                        del newest[user_id]
+                self.conn.executemany(
+                    "UPDATE role_events SET done_at = ?, outcome = ? WHERE event_id = ?",
+                    [(now, OUTCOME_SUPERSEDED, event_id) for event_id in superseded],
+                )
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+        ROLE_EVENTS.Inc(len(superseded), outcome=OUTCOME_SUPERSEDED)
+        due = [row for row in newest.values() if row[5] <= now][:limit]
+        return [
+            (event_id, user_id, action, attempts)
+            for event_id, user_id, action, _, attempts, _ in due
+        ]
+
+    def MarkApplied(self, event_id: str):
+        self._finish(event_id, OUTCOME_APPLIED, None)
+        ROLE_EVENTS.Inc(outcome=OUTCOME_APPLIED)
+
+    ## schedules another attempt with exponential backoff,
+    ## or gives up on a removal after max_attempts
+    def MarkFailed(self, event_id: str, attempts: int, error: str, action: str = None):
+        attempts += 1
+        if action != ACTION_ADD and attempts >= self.max_attempts:
+            log.error(
+                f"giving up on role event {event_id} after {attempts} attempts: {error}, "
+                f"replay it with `python -m client.role_queue replay {event_id}`"
+            )
+            with self.lock:
+                self.conn.execute(
+                    "UPDATE role_events SET attempts = ? WHERE event_id = ?",
+                    (attempts, event_id),
+                )
+            self._finish(event_id, OUTCOME_FAILED, error)
+            ROLE_EVENTS.Inc(outcome=OUTCOME_FAILED)
+            return
+        delay = RETRY_BASE_SECONDS * 2 ** min(attempts - 1, 20)
+        delay = min(delay, RETRY_MAX_SECONDS)
+        ## jitter spreads out a burst of failures so the retries don't all land together
+        delay *= random.uniform(0.5, 1.0)
+        with self.lock:
+            self.conn.execute(
+                "UPDATE role_events SET attempts = ?, next_attempt = ?, error = ? "
+                "WHERE event_id = ?",
+                (attempts, time.time() + delay, error, event_id),
+            )
+        ROLE_EVENTS.Inc(outcome=OUTCOME_RETRY)
+
+    ## seconds until the next pending event is due, or None if nothing is pending
+    def NextDue(self):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MIN(next_attempt) FROM role_events WHERE done_at IS NULL"
+            ).fetchone()
+        return None if row[0] is None else max(0, row[0] - time.time())
+
+    ## returns (events waiting to be applied, events that ran out of attempts)
+    def Depths(self) -> (int, int):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(CASE WHEN done_at IS NULL THEN 1 END), "
+                "COUNT(CASE WHEN outcome = ? THEN 1 END) FROM role_events",
+                (OUTCOME_FAILED,),
+            ).fetchone()
+
+    ## queues failed events again with a fresh set of attempts, all of them
+    ## or only event_id, returns how many were queued
+    ## the running consumer picks them up on its next poll
+    def Replay(self, event_id: str = None) -> int:
+        query = (
+            "UPDATE role_events SET done_at = NULL, outcome = NULL, attempts = 0, "
+            "next_attempt = ? WHERE outcome = ?"
+        )
+        args = [time.time(), OUTCOME_FAILED]
+        if event_id:
+            query += " AND event_id = ?"
+            args.append(event_id)
+        with self.lock:
+            return self.conn.execute(query, args).rowcount
+
+    ## returns [(event ID, user ID, action, attempts, error)] of the failed events
+    def ListFailed(self) -> list:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT event_id, user_id, action, attempts, error FROM role_events "
+                "WHERE outcome = ? ORDER BY created",
+                (OUTCOME_FAILED,),
+            ).fetchall()
+
+    ## forgets finished events older than KEEP_SECONDS, failed ones wait for a replay
+    def Purge(self):
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM role_events WHERE done_at IS NOT NULL AND done_at < ? "
+                "AND outcome != ?",
+                (time.time() - KEEP_SECONDS, OUTCOME_FAILED),
+            )
+
+    def _finish(self, event_id: str, outcome: str, error: str):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE role_events SET done_at = ?, outcome = ?, error = ? WHERE event_id = ?",
+                (time.time(), outcome, error, event_id),
+            )
+
+
+role_queue = RoleQueue(
+    os.getenv(ROLE_QUEUE_DB_ENV, "./cache/role_queue.sqlite3"),
+    GetIntEnv(ROLE_QUEUE_MAX_ATTEMPTS_ENV, 12),
+)
+
+## queue depths as of the consumer's last pass, it counts them off the event loop
+## so /metrics never waits on the SQLite file
+depths = {"pending": 0, "failed": 0}
+
+Gauge(
+    "string_scribe_role_queue_pending",
+    "Subscription webhook events waiting to be applied to Auth0",
+    fn=lambda: depths["pending"],
+)
+## anything above zero needs a replay, see the module comment
+Gauge(
+    "string_scribe_role_queue_failed",
+    "Subscription webhook events that ran out of attempts and were never applied",
+    fn=lambda: depths["failed"],
+)
+
+## set whenever an event is queued, so the consumer doesn't wait for its next poll
+consumer_wakeup = None
+consumer_task = None
+
+
+# Queues a role change from a webhook event, returns False if the event was seen before
+async def EnqueueRoleChange(
+    event_id: str, user_id: str, action: str, created: float
+) -> bool:
+    ## the cached role is stale from now on, even before Auth0 is updated
+    client.InvalidateRole(user_id)
+    ## the insert can wait on the consumer's write lock, keep that off the event loop
+    queued = await asyncio.to_thread(
+        role_queue.Enqueue, event_id, user_id, action, created
+    )
+    if queued and consumer_wakeup is not None:
+        consumer_wakeup.set()
+    return queued
+
+
+# Starts the background task that applies queued role changes, call from the event loop
+def StartConsumer():
+    global consumer_wakeup, consumer_task
+    consumer_wakeup = asyncio.Event()
+    consumer_task = asyncio.create_task(consume())
+
+
+async def StopConsumer():
+    if consumer_task is None:
+        return
+    consumer_task.cancel()
+    try:
+        await consumer_task
+    except asyncio.CancelledError:
+        pass
+
+
+async def consume():
+    purged_at = 0
+    while True:
+        consumer_wakeup.clear()
+        try:
+            if time.time() - purged_at > PURGE_EVERY_SECONDS:
+                await asyncio.to_thread(role_queue.Purge)
+                purged_at = time.time()
+            due = await asyncio.to_thread(role_queue.Due, BATCH_SIZE)
+            await asyncio.gather(*(apply_event(*event) for event in due))
+            if len(due) == BATCH_SIZE:
+                ## there may be more waiting already
+                continue
+            wait = await asyncio.to_thread(role_queue.NextDue)
+            depths["pending"], depths["failed"] = await asyncio.to_thread(role_queue.Depths)
+        except Exception as e:
+            log.error(f"role queue consumer error: {e}")
+            wait = POLL_SECONDS
+        wait = POLL_SECONDS if wait is None else min(wait, POLL_SECONDS)
+        try:
+            await asyncio.wait_for(consumer_wakeup.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+
+
+# Makes the Auth0 call for one queued event and records how it went
+async def apply_event(event_id: str, user_id: str, action: str, attempts: int):
+    change = client.AddProRole if action == ACTION_ADD else client.RemoveProRole
+    try:
+        await asyncio.to_thread(change, user_id)
+    except Exception as e:
+        await asyncio.to_thread(role_queue.MarkFailed, event_id, attempts, str(e), action)
+        return
+    ## a lookup made while the change was on its way may have cached the old role
+    client.InvalidateRole(user_id)
+    log.info(f"applied role event {event_id}: {action} Pro role for user {user_id}")
+    await asyncio.to_thread(role_queue.MarkApplied, event_id)
+
+
+## lists or replays the events that ran out of attempts, run from backend/ with
+## `python -m client.role_queue list` or `python -m client.role_queue replay [event ID]`
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect failed Pro role changes")
+    parser.add_argument("command", choices=("list", "replay"))
+    parser.add_argument("event_id", nargs="?", help="replay only this event")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for event_id, user_id, action, attempts, error in role_queue.ListFailed():
+            print(f"{event_id}\t{action}\t{user_id}\t{attempts} attempts\t{error}")
+    else:
+        print(f"queued {role_queue.Replay(args.event_id)} failed events again")
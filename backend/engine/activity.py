@@ -0,0 +1,76 @@
+import numpy as np
+from basic_pitch.constants import AUDIO_SAMPLE_RATE
+from engine.settings import PREDICT_PARAMS
+
+## activity.py finds the parts of a recording that could hold violin notes,
+## so inference can skip long silences, intros and outros
+## it only looks at the energy in the violin's range, a few FFTs per second of audio
+
+## samples per analysis frame, about 93ms, frames don't overlap
+FRAME_SAMPLES = 2048
+## frames analyzed per FFT call, bounds memory on long recordings
+FRAMES_PER_BLOCK = 512
+## frames quieter than this in the violin range are silent, whatever the recording's level
+SILENCE_FLOOR_DB = -60
+## and so are frames this far below the recording's loud passages
+RELATIVE_FLOOR_DB = 45
+## percentile of frame levels taken as "loud", so one click doesn't set the bar
+LOUD_PERCENTILE = 95
+## audio kept on either side of an active frame, so attacks and decays are seen whole
+PAD_SECONDS = 0.5
+## shorter gaps are transcribed anyway, every cut adds a partly empty model window
+MIN_GAP_SECONDS = 3.0
+
+_window = np.hanning(FRAME_SAMPLES).astype(np.float32)
+_frequencies = np.fft.rfftfreq(FRAME_SAMPLES, 1 / AUDIO_SAMPLE_RATE)
+_band = (_frequencies >= PREDICT_PARAMS["minimum_frequency"]) & (
+    _frequencies <= PREDICT_PARAMS["maximum_frequency"]
+)
+
+
+# Returns the level in dB relative to full scale of each frame's energy in the violin range
+def band_levels(audio: np.ndarray) -> np.ndarray:
+    count = -(-audio.shape[0] // FRAME_SAMPLES)
+    frames = np.zeros((count * FRAME_SAMPLES,), dtype=np.float32)
+    frames[: audio.shape[0]] = audio
+    frames = frames.reshape(count, FRAME_SAMPLES)
+    power = np.empty((count,), dtype=np.float64)
+    for start in range(0, count, FRAMES_PER_BLOCK):
+        block = frames[start : start + FRAMES_PER_BLOCK] * _window
+        spectrum = np.abs(np.fft.rfft(block, axis=1)[:, _band]) ** 2
+        ## Parseval: the mean square of the band limited signal, so a full scale sine is -3dB
+        power[start : start + FRAMES_PER_BLOCK] = (
+            2 * spectrum.sum(axis=1) / (FRAME_SAMPLES * np.sum(_window**2))
+        )
+    return 10 * np.log10(power + 1e-12)
+
+
+# Returns [(start sample, end sample)] of the parts of the audio that may hold notes
+# the whole recording is one segment unless it has gaps of at least MIN_GAP_SECONDS
+def active_segments(audio: np.ndarray) -> list:
+    if audio.shape[0] == 0:
+        return []
+    levels = band_levels(audio)
+    loud = np.percentile(levels, LOUD_PERCENTILE)
+    threshold = max(SILENCE_FLOOR_DB, loud - RELATIVE_FLOOR_DB)
+    active = levels > threshold
+    if not active.any():
+        return []
+    ## widen every active frame by PAD_SECONDS on both sides
+    pad = int(np.ceil(PAD_SECONDS * AUDIO_SAMPLE_RATE / FRAME_SAMPLES))
+    padded = np.convolve(active, np.ones(2 * pad + 1), mode="same") > 0
+    ## starts and ends of the active runs, in frames
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], padded.astype(np.int8), [0]])))
+    runs = edges.reshape(-1, 2)
+    ## merge runs whose gap is too short to be worth cutting out
+    min_gap = MIN_GAP_SECONDS * AUDIO_SAMPLE_RATE / FRAME_SAMPLES
+    segments = [list(runs[0])]
+    for start, end in runs[1:]:
+        if start - segments[-1][1] < min_gap:
+            segments[-1][1] = end
+        else:
+            segments.append([start, end])
+    return [
+        (int(start) * FRAME_SAMPLES, min(int(end) * FRAME_SAMPLES, audio.shape[0]))
+        for start, end in segments
+    ]
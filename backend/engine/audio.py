@@ -0,0 +1,104 @@
+import logger, librosa, os, shutil, subprocess
+import numpy as np
+from basic_pitch.constants import AUDIO_SAMPLE_RATE
+from engine.duration import MAX_DURATION, too_long_error
+
+## audio.py decodes audio once into memory so every pipeline stage can share it
+
+log = logger.get()
+
+## tempo detection doesn't need the full bandwidth, so it runs on a half rate view
+TEMPO_SAMPLE_RATE = AUDIO_SAMPLE_RATE // 2
+
+
+## compressed formats that librosa would hand to audioread and resample in python
+FFMPEG_EXTENSIONS = {".opus", ".webm", ".m4a", ".mp4", ".aac", ".ogg", ".mp3"}
+FFMPEG_PATH = shutil.which("ffmpeg")
+
+## float32 samples
+SAMPLE_BYTES = 4
+
+
+# Decodes an audio file to mono float32 PCM at basic-pitch's sample rate
+def load_audio(file_path: str) -> np.ndarray:
+    log.info(f"decoding audio at {file_path}")
+    extension = os.path.splitext(file_path)[1].lower()
+    if FFMPEG_PATH and extension in FFMPEG_EXTENSIONS:
+        try:
+            return decode_with_ffmpeg(file_path)
+        except Exception as e:
+            log.warning(f"ffmpeg decode failed, falling back to librosa: {e}")
+    audio, _ = librosa.load(file_path, sr=AUDIO_SAMPLE_RATE, mono=True)
+    return audio.astype(np.float32, copy=False)
+
+
+# ffmpeg arguments that decode, downmix and resample to raw float32 on stdout
+def ffmpeg_pcm_command(file_path: str) -> list:
+    return [
+        FFMPEG_PATH,
+        "-nostdin",
+        "-v",
+        "error",
+        "-i",
+        file_path,
+        "-vn",
+        "-ac",
+        "1",
+        "-ar",
+        str(AUDIO_SAMPLE_RATE),
+        "-f",
+        "f32le",
+        "pipe:1",
+    ]
+
+
+# Decodes, downmixes and resamples in a single ffmpeg pass straight into memory
+def decode_with_ffmpeg(file_path: str) -> np.ndarray:
+    command = ffmpeg_pcm_command(file_path)
+    result = subprocess.run(command, capture_output=True, check=True)
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+
+# Yields the audio as consecutive mono float32 blocks of block_seconds each,
+# decoding as it goes so only one block is in memory at a time
+def stream_audio(file_path: str, block_seconds: int):
+    block_samples = int(block_seconds * AUDIO_SAMPLE_RATE)
+    max_samples = MAX_DURATION * AUDIO_SAMPLE_RATE
+    if not FFMPEG_PATH:
+        ## without ffmpeg we can't decode incrementally, so fall back to slicing
+        log.warning("ffmpeg not found, streaming mode will decode the whole file")
+        audio = load_audio(file_path)
+        if audio.shape[0] > max_samples:
+            raise too_long_error()
+        for i in range(0, audio.shape[0], block_samples):
+            yield audio[i : i + block_samples]
+        return
+
+    command = ffmpeg_pcm_command(file_path)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    total = 0
+    try:
+        while True:
+            data = process.stdout.read(block_samples * SAMPLE_BYTES)
+            if not data:
+                break
+            block = np.frombuffer(data, dtype=np.float32)
+            total += block.shape[0]
+            ## the container's duration can be missing or wrong, so check as we go
+            if total > max_samples:
+                raise too_long_error()
+            yield block
+    finally:
+        process.kill()
+        process.wait()
+
+
+# Returns a cheap downsampled copy of the audio for tempo detection
+def tempo_view(audio: np.ndarray) -> np.ndarray:
+    ## basic-pitch's rate is an exact multiple, so a polyphase filter is enough
+    return librosa.resample(
+        audio,
+        orig_sr=AUDIO_SAMPLE_RATE,
+        target_sr=TEMPO_SAMPLE_RATE,
+        res_type="polyphase",
+    )
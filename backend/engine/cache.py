@@ -0,0 +1,257 @@
+import asyncio, hashlib, json, logger, os, secrets, struct, threading, time
+from collections import OrderedDict
+from util import GetIntEnv
+
+## cache.py stores finished transcriptions so repeat uploads skip the engine
+## entries are (musicXML string, MIDI bytes) tuples keyed by a content hash
+
+log = logger.get()
+
+## every cache reads <PREFIX>_MAX_BYTES, <PREFIX>_DIR, <PREFIX>_DISK_MAX_BYTES and <PREFIX>_TTL
+MAX_BYTES_ENV_SUFFIX = "_MAX_BYTES"
+DIR_ENV_SUFFIX = "_DIR"
+DISK_MAX_BYTES_ENV_SUFFIX = "_DISK_MAX_BYTES"
+TTL_ENV_SUFFIX = "_TTL"
+
+DEFAULT_MEMORY_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_BYTES = 1024 * 1024 * 1024
+
+## bump this whenever the engine output changes, so old entries stop matching
+CACHE_VERSION = 2
+
+## disk entries are: creation timestamp, 8 byte musicXML length, musicXML, MIDI
+HEADER = struct.Struct("<dQ")
+
+
+# Builds a cache key from the audio hash and everything else that affects the output
+def cache_key(audio_hash: str, params: dict, title: str) -> str:
+    material = json.dumps(
+        {"v": CACHE_VERSION, "audio": audio_hash, "params": params, "title": title},
+        sort_keys=True,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def entry_size(entry: tuple) -> int:
+    mxml, midi = entry
+    return len(mxml) + len(midi)
+
+
+class MemoryLRU:
+    """
+    In-process LRU that evicts the least recently used entries past max_bytes.
+    Entries older than ttl seconds are dropped on read, a ttl of 0 keeps them forever.
+    """
+
+    def __init__(self, max_bytes: int, ttl: int = 0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        ## key -> (entry, created_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def Get(self, key: str):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            entry, created_at = item
+            if self.ttl and time.time() - created_at > self.ttl:
+                del self._entries[key]
+                self.size -= entry_size(entry)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def Put(self, key: str, entry: tuple, created_at: float = None):
+        size = entry_size(entry)
+        ## don't let one huge result flush everything else
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= entry_size(old[0])
+            self._entries[key] = (entry, created_at or time.time())
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.size -= entry_size(evicted)
+
+
+class DiskStore:
+    """
+    Directory of cache entries shared by every process on the machine.
+    Writes go through a temp file and a rename, so readers never see partial entries.
+    Every method does blocking file I/O, ResultCache calls them off the event loop.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: int = 0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+        ## running total of the entries' bytes, so a Put only scans the directory
+        ## when the store has outgrown max_bytes
+        ## other processes write here too, each scan brings it back in line with them
+        self._lock = threading.Lock()
+        self.size = self._scan()[1]
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.bin")
+
+    ## returns (entry, created_at), or None if the entry is missing or expired
+    def Get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        created_at, mxml_len = HEADER.unpack_from(data)
+        if self.ttl and time.time() - created_at > self.ttl:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            else:
+                with self._lock:
+                    self.size -= len(data)
+            return None
+        ## touch the file so eviction treats it as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        mxml_end = HEADER.size + mxml_len
+        entry = data[HEADER.size : mxml_end].decode("utf-8"), data[mxml_end:]
+        return entry, created_at
+
+    def Put(self, key: str, entry: tuple):
+        mxml, midi = entry
+        mxml_bytes = mxml.encode("utf-8")
+        path = self._path(key)
+        tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(time.time(), len(mxml_bytes)))
+            f.write(mxml_bytes)
+            f.write(midi)
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.size += HEADER.size + len(mxml_bytes) + len(midi) - replaced
+            full = self.size > self.max_bytes
+        if full:
+            self._evict()
+
+    ## returns [(mtime, size, path)] of every entry, oldest first, and their total size
+    def _scan(self) -> (list, int):
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".bin"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        files.sort()
+        return files, total
+
+    ## removes the least recently used entries until the store fits in max_bytes
+    def _evict(self):
+        files, total = self._scan()
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self.size = total
+
+
+class ResultCache:
+    """
+    Memory LRU in front of an optional disk store, with hit/miss counters.
+    Get and Put run the disk store on a thread, so they never block the event loop.
+    """
+
+    def __init__(self, memory: MemoryLRU, disk: DiskStore = None):
+        self.memory = memory
+        self.disk = disk
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def FromEnv(prefix: str, default_dir: str, default_ttl: int = 0):
+        ttl = GetIntEnv(prefix + TTL_ENV_SUFFIX, default_ttl)
+        memory = MemoryLRU(
+            GetIntEnv(prefix + MAX_BYTES_ENV_SUFFIX, DEFAULT_MEMORY_BYTES), ttl
+        )
+        directory = os.getenv(prefix + DIR_ENV_SUFFIX, default_dir)
+        ## an empty directory setting turns the disk store off
+        disk = None
+        if directory:
+            disk = DiskStore(
+                directory,
+                GetIntEnv(prefix + DISK_MAX_BYTES_ENV_SUFFIX, DEFAULT_DISK_BYTES),
+                ttl,
+            )
+        return ResultCache(memory, disk)
+
+    async def Get(self, key: str):
+        entry = self.memory.Get(key)
+        if entry is not None:
+            self.stats["memory_hits"] += 1
+            return entry
+        if self.disk is not None:
+            try:
+                item = await asyncio.to_thread(self.disk.Get, key)
+            except Exception as e:
+                log.error(f"error reading result cache entry {key}: {e}")
+                item = None
+            if item is not None:
+                entry, created_at = item
+                self.stats["disk_hits"] += 1
+                ## keep the original creation time so the ttl still applies
+                self.memory.Put(key, entry, created_at)
+                return entry
+        self.stats["misses"] += 1
+        return None
+
+    async def Put(self, key: str, entry: tuple):
+        self.memory.Put(key, entry)
+        if self.disk is not None:
+            try:
+                await asyncio.to_thread(self.disk.Put, key, entry)
+            except Exception as e:
+                ## a full or read-only disk shouldn't fail the request
+                log.error(f"error writing result cache entry {key}: {e}")
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key, so the work runs once
+    and every caller gets the same result
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    async def Do(self, key: str, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            log.info(f"joining in-flight job for {key}")
+        ## shield so one caller disconnecting doesn't cancel the work for the others
+        return await asyncio.shield(task)
@@ -0,0 +1,57 @@
+import logger, shutil, subprocess
+from util import GetIntEnv
+
+## duration.py checks how long a recording is without decoding it
+## it only needs ffprobe, so the API process can refuse long uploads
+## without loading the audio stack
+
+log = logger.get()
+
+FFPROBE_PATH = shutil.which("ffprobe")
+
+## longest recording we will transcribe, in seconds
+MAX_DURATION_ENV = "ENGINE_MAX_DURATION"
+MAX_DURATION = GetIntEnv(MAX_DURATION_ENV, 30 * 60)
+
+
+class AudioTooLongError(Exception):
+    """Raised when a recording is longer than MAX_DURATION"""
+
+
+def too_long_error() -> AudioTooLongError:
+    if MAX_DURATION >= 60:
+        return AudioTooLongError(f"audio must be shorter than {MAX_DURATION // 60} minutes")
+    return AudioTooLongError(f"audio must be shorter than {MAX_DURATION} seconds")
+
+
+# Returns the duration of an audio file in seconds, or None if it can't be read cheaply
+def probe_duration(file_path: str):
+    try:
+        if FFPROBE_PATH:
+            command = [
+                FFPROBE_PATH,
+                "-v",
+                "error",
+                "-show_entries",
+                "format=duration",
+                "-of",
+                "default=noprint_wrappers=1:nokey=1",
+                file_path,
+            ]
+            result = subprocess.run(command, capture_output=True, check=True, text=True)
+            return float(result.stdout.strip())
+        ## only without ffprobe, librosa is slow to import
+        import librosa
+
+        return librosa.get_duration(path=file_path)
+    except Exception as e:
+        log.warning(f"could not read duration of {file_path}: {e}")
+        return None
+
+
+# Rejects files longer than MAX_DURATION before any decoding happens
+def check_duration(file_path: str) -> float:
+    duration = probe_duration(file_path)
+    if duration is not None and duration > MAX_DURATION:
+        raise too_long_error()
+    return duration
@@ -1,159 +1,387 @@
-import secrets, logger, os, librosa
+import asyncio, functools, importlib, multiprocessing, logger, os
 from fastapi import UploadFile
-from basic_pitch.inference import predict
-from music21 import converter
-from music21.instrument import Violin
-import yt_dlp
+from engine.pool import WorkerPool, WorkerCount, PoolSaturatedError, JobTimeoutError
+from engine.duration import check_duration, too_long_error, AudioTooLongError, MAX_DURATION
+from engine.jobs import (
+    job_store,
+    progress_queue,
+    report_timing,
+    timed_stage,
+    run_with_progress,
+    warm_workers,
+    StartProgressListener,
+    StopProgressListener,
+    STAGE_DOWNLOAD,
+)
+from engine.cache import ResultCache, SingleFlight, cache_key
+from engine.youtube import canonical_video_id, canonical_url
+from engine.settings import ScoreOptions, PREDICT_PARAMS, SCORE_PARAMS
+from engine.ingest import (
+    save_upload,
+    save_batch_upload,
+    UploadTooLargeError,
+    UnsupportedAudioError,
+    BATCH_MAX_FILES,
+)
+from engine.scratch import scratch_manager, ScratchSpace, ScratchQuotaError, ScratchFullError
+from metrics import Gauge
 
 ## engine.py holds the main backend logic for transcribing music
 
 log = logger.get()
 
-## Create the processing directory if it doesn't exist
-os.makedirs("processing", exist_ok=True)
+
+## the pool calls these in its worker processes, engine/worker.py is imported there
+## on first use, so the API process never pays for the engine stack
+def init_worker(queue=None, workers: int = None):
+    from engine import worker
+
+    worker.init_worker(queue, workers)
+
+
+def transcribe_file(file_path: str, title: str, options: ScoreOptions = None) -> (str, bytes):
+    from engine import worker
+
+    return worker.transcribe_file(file_path, title, options)
+
+
+def transcribe_batch(items: list, options: ScoreOptions = None) -> (list, dict):
+    from engine import worker
+
+    return worker.transcribe_batch(items, options)
+
+
+## preload job, the worker has already loaded its model by the time it runs
+def worker_started() -> int:
+    return os.getpid()
+
+
+## transcription jobs run here instead of on the API event loop
+engine_workers = WorkerCount()
+worker_pool = WorkerPool(
+    initializer=init_worker,
+    initargs=(progress_queue, engine_workers),
+    workers=engine_workers,
+    wait_reporter=functools.partial(report_timing, "queue_wait"),
+)
+
+## background preload and scratch janitor, referenced so they aren't garbage collected
+preload_task = None
+janitor_task = None
+
+## finished transcriptions, so re-uploads of the same file skip the workers
+result_cache = ResultCache.FromEnv("RESULT_CACHE", "./cache/results")
+
+## finished YouTube transcriptions keyed by video ID, kept for a week by default
+youtube_cache = ResultCache.FromEnv("YOUTUBE_CACHE", "./cache/youtube", 7 * 24 * 60 * 60)
+
+## YouTube jobs currently running, so identical requests share one download
+youtube_flights = SingleFlight()
+
+## start every worker, and with it the model, as soon as the API is up
+## instead of on the first transcription
+ENGINE_PRELOAD_ENV = "ENGINE_PRELOAD"
+engine_preload = os.getenv(ENGINE_PRELOAD_ENV, "").lower() in ("1", "true", "yes")
+
+## native keeps YouTube's own audio stream (opus/m4a) and decodes it straight to PCM,
+## mp3 is the old behaviour of re-encoding to a 192k MP3 first
+YOUTUBE_INGEST_MODE_ENV = "YOUTUBE_INGEST_MODE"
+INGEST_MODE_NATIVE = "native"
+INGEST_MODE_MP3 = "mp3"
+youtube_ingest_mode = os.getenv(YOUTUBE_INGEST_MODE_ENV, INGEST_MODE_NATIVE)
+
+## everything that changes the result for the same audio, part of the cache keys
+## the request's ScoreOptions are added to these
+RESULT_PARAMS = dict(PREDICT_PARAMS, **SCORE_PARAMS)
+
+## read when /metrics is scraped
+Gauge(
+    "string_scribe_pool_queue_depth",
+    "Engine jobs waiting for a free worker",
+    fn=lambda: worker_pool.QueueDepth(),
+)
+Gauge(
+    "string_scribe_pool_running",
+    "Engine jobs a worker is busy with",
+    fn=lambda: worker_pool.Running(),
+)
+Gauge(
+    "string_scribe_pool_workers",
+    "Engine worker processes",
+    fn=lambda: worker_pool.workers,
+)
+Gauge(
+    "string_scribe_cache_lookups_total",
+    "Result cache lookups by cache and outcome",
+    ("cache", "outcome"),
+    fn=lambda: [
+        ({"cache": name, "outcome": outcome}, count)
+        for name, cache in (("result", result_cache), ("youtube", youtube_cache))
+        for outcome, count in cache.stats.items()
+    ],
+    kind="counter",
+)
+Gauge(
+    "string_scribe_cache_memory_bytes",
+    "Bytes held by each in-memory result cache",
+    ("cache",),
+    fn=lambda: [
+        ({"cache": name}, cache.memory.size)
+        for name, cache in (("result", result_cache), ("youtube", youtube_cache))
+    ],
+)
 
 
 class MusicEngine:
 
-    async def ProcessMusic(file: UploadFile) -> (str, bytes):
+    ## must be called from the event loop
+    def Start():
+        global preload_task, janitor_task
+        StartProgressListener(asyncio.get_running_loop())
+        worker_pool.Start()
+        janitor_task = asyncio.create_task(scratch_manager.RunJanitor())
+        if engine_preload:
+            preload_task = asyncio.create_task(MusicEngine.Preload())
+
+    ## starts every worker, which loads and warms up its model, then imports yt-dlp
+    async def Preload():
+        log.info(f"preloading {worker_pool.workers} engine workers")
         try:
-            ## step 1: audio to MIDI
-            file_path = await create_file(file)
-            midi_file_path = create_midi_file(file_path)
-            midi_bytes = bytes()
-            with open(midi_file_path, "rb") as midi_file:
-                midi_bytes = midi_file.read()
-            ## step 2: MIDI to musicXML
-            mxml_file_path = create_mxml_file(file, file_path, midi_file_path)
-            mxml_string = read_file(mxml_file_path)
-            return mxml_string, midi_bytes
+            ## the pool starts a worker for each job submitted while the others are busy
+            await asyncio.gather(
+                *(worker_pool.Run(worker_started) for _ in range(worker_pool.workers))
+            )
+            ## only YouTube requests need it, but it takes a while to import
+            await asyncio.to_thread(importlib.import_module, "yt_dlp")
+        except Exception as e:
+            log.error(f"engine preload failed: {e}")
+            return
+        log.info("engine preload finished")
+
+    ## readiness of the engine, ready once at least one worker has its model warmed up
+    def Ready() -> dict:
+        live = {process.pid for process in multiprocessing.active_children()}
+        warm = len(warm_workers & live)
+        return {
+            "ready": warm > 0,
+            "workers": worker_pool.workers,
+            "warm_workers": warm,
+            "preload": engine_preload,
+        }
+
+    def Shutdown():
+        if janitor_task is not None:
+            janitor_task.cancel()
+        worker_pool.Shutdown()
+        StopProgressListener()
+
+    async def ProcessMusic(
+        file: UploadFile, options: ScoreOptions = None
+    ) -> (str, bytes):
+        file_path, audio_hash = await MusicEngine.SaveUpload(file)
+        return await MusicEngine.ProcessSaved(
+            file_path, audio_hash, file.filename, options=options
+        )
+
+    ## streams the upload to a scratch space of its own, returns its path and hash
+    ## the job API calls this inside the request, before the upload is closed
+    async def SaveUpload(file: UploadFile) -> (str, str):
+        scratch = scratch_manager.Create(file.size)
+        try:
+            with timed_stage("upload_write"):
+                return await save_upload(file, scratch)
+        except (
+            UploadTooLargeError,
+            UnsupportedAudioError,
+            ScratchQuotaError,
+            ScratchFullError,
+        ):
+            scratch.Release()
+            raise
+        except:
+            scratch.Release()
+            raise Exception("failed to generate sheet music")
+
+    ## saves every file of a batch upload, unpacking zips, returns [(name, path, hash)]
+    ## the whole batch shares one scratch space
+    async def SaveBatch(files: list) -> list:
+        sizes = [file.size for file in files]
+        scratch = scratch_manager.Create(None if None in sizes else sum(sizes))
+        saved = []
+        try:
+            with timed_stage("upload_write"):
+                for file in files:
+                    remaining = BATCH_MAX_FILES - len(saved)
+                    if remaining <= 0:
+                        raise UploadTooLargeError(
+                            f"A batch can hold at most {BATCH_MAX_FILES} files"
+                        )
+                    saved += await save_batch_upload(file, scratch, remaining)
+            return saved
+        except:
+            scratch.Release()
+            raise
+
+    ## transcribes the saved files of a batch job, one item job per file,
+    ## and deletes them afterwards
+    ## the files run as one pool job so their model windows can share inference calls,
+    ## each item finishes as soon as its own score is written
+    async def ProcessBatch(job, saved: list, options: ScoreOptions = None):
+        options = options or ScoreOptions()
+        params = dict(RESULT_PARAMS, **options.ToDict())
+        try:
+            pending = []
+            total_duration = 0
+            for item, (name, file_path, audio_hash) in zip(job.items, saved):
+                key = cache_key(audio_hash, params, name)
+                cached = await result_cache.Get(key)
+                if cached is not None:
+                    log.info(f"result cache hit for {name} ({result_cache.stats})")
+                    item.Finish(cached)
+                    continue
+                try:
+                    duration = await asyncio.to_thread(check_duration, file_path)
+                except AudioTooLongError as e:
+                    item.Fail(str(e), 400)
+                    continue
+                total_duration += duration or 0
+                pending.append((item, key, file_path, name))
+            if not pending:
+                return None
+            ## the batch gets one worker and one job timeout, like a single recording
+            if total_duration > MAX_DURATION:
+                raise AudioTooLongError(
+                    f"the recordings in a batch must add up to less than "
+                    f"{MAX_DURATION // 60} minutes"
+                )
+            results, failures = await worker_pool.Run(
+                run_with_progress,
+                job.id,
+                transcribe_batch,
+                [(file_path, name, item.id) for item, _, file_path, name in pending],
+                options,
+            )
+            ## the workers reported these already, unless the queue dropped a report
+            for index, (item, key, _, _) in enumerate(pending):
+                if results[index] is not None:
+                    await result_cache.Put(key, results[index])
+                    if not item.Finished():
+                        item.Finish(results[index])
+                elif not item.Finished():
+                    item.Fail(*failures[index])
+            return None
+        except (PoolSaturatedError, JobTimeoutError, AudioTooLongError):
+            raise
         except:
             raise Exception("failed to generate sheet music")
         finally:
-            ## always clean up processing directory
-            delete_file(file_path)
-            delete_file(midi_file_path)
-            delete_file(mxml_file_path)
+            if saved:
+                scratch_manager.Release(saved[0][1])
 
-    async def ProcessYouTube(url: str) -> (str, bytes):
+    ## transcribes a saved upload and deletes it afterwards
+    ## job_id, if given, receives progress updates
+    async def ProcessSaved(
+        file_path: str,
+        audio_hash: str,
+        title: str,
+        job_id: str = None,
+        options: ScoreOptions = None,
+    ) -> (str, bytes):
+        options = options or ScoreOptions()
         try:
-            # Download audio from YouTube
-            file_path = await download_youtube_audio(url)
-            # Audio to MIDI
-            midi_file_path = create_midi_file(file_path)
-            midi_bytes = bytes()
-            with open(midi_file_path, "rb") as midi_file:
-                midi_bytes = midi_file.read()
-            # MIDI to musicXML
-            mxml_file_path = create_mxml_file_from_youtube(
-                file_path, midi_file_path, url
+            ## identical audio with identical settings gives identical sheet music
+            key = cache_key(audio_hash, dict(RESULT_PARAMS, **options.ToDict()), title)
+            cached = await result_cache.Get(key)
+            if cached is not None:
+                log.info(f"result cache hit for {title} ({result_cache.stats})")
+                return cached
+            ## refuse long recordings before they take up a worker
+            await asyncio.to_thread(check_duration, file_path)
+            result = await worker_pool.Run(
+                run_with_progress, job_id, transcribe_file, file_path, title, options
             )
-            mxml_string = read_file(mxml_file_path)
-            return mxml_string, midi_bytes
+            await result_cache.Put(key, result)
+            return result
+        except (PoolSaturatedError, JobTimeoutError, AudioTooLongError):
+            raise
+        except:
+            raise Exception("failed to generate sheet music")
+        finally:
+            ## always clean up the upload's scratch space
+            scratch_manager.Release(file_path)
+
+    async def ProcessYouTube(
+        url: str, job_id: str = None, options: ScoreOptions = None
+    ) -> (str, bytes):
+        options = options or ScoreOptions()
+        try:
+            ## every link to the same video maps to one canonical URL,
+            ## links we don't recognize are passed to yt-dlp as-is
+            video_id = canonical_video_id(url)
+            if video_id:
+                url = canonical_url(video_id)
+            else:
+                url = url.strip()
+            params = dict(RESULT_PARAMS, ingest=youtube_ingest_mode, **options.ToDict())
+            key = cache_key(video_id or url, params, url)
+            cached = await youtube_cache.Get(key)
+            if cached is not None:
+                log.info(f"YouTube cache hit for {url} ({youtube_cache.stats})")
+                return cached
+            ## the work is shared by every request for the video, its progress is
+            ## reported under the key and fanned out to each request's job
+            if job_id:
+                job_store.JoinGroup(key, job_id)
+            try:
+                return await youtube_flights.Do(
+                    key, lambda: transcribe_youtube(url, key, options)
+                )
+            finally:
+                if job_id:
+                    job_store.LeaveGroup(key, job_id)
+        except (
+            PoolSaturatedError,
+            JobTimeoutError,
+            AudioTooLongError,
+            ScratchQuotaError,
+            ScratchFullError,
+        ):
+            raise
         except Exception as e:
             log.error(f"Failed to process YouTube video: {e}")
             raise Exception(
                 f"Failed to generate sheet music from YouTube video: {str(e)}"
             )
-        finally:
-            # Always clean up processing directory
-            delete_file(file_path)
-            delete_file(midi_file_path)
-            delete_file(mxml_file_path)
-
-
-# Returns MIDI file path
-def create_midi_file(file_path: str) -> str:
-    # Extract tempo from audio file
-    log.info("attempting to extract tempo")
-    detected_tempo = extract_audio_tempo(file_path)
-    log.info(f"DETECTED TEMPO: {detected_tempo} BPM")
-    # 196 HZ is lowest note on violin
-    # 3520 HZis highest note on violin
-    _, midi_data, _ = predict(
-        file_path,
-        onset_threshold=0.7,
-        frame_threshold=0.5,
-        minimum_frequency=196,
-        maximum_frequency=3520,
-        melodia_trick=True,
-        midi_tempo=detected_tempo,
-    )
-    midi_file_path = f"{file_path}-midi.mid"
-    log.info(f"attempting to write midi file to {midi_file_path}")
-    midi_data.write(midi_file_path)
-    return midi_file_path
-
-
-# Returns mxml file path
-def create_mxml_file(file: UploadFile, file_path: str, midi_file_path: str) -> str:
-    log.info(f"attempting to convert MIDI to musicXML")
-    mxml_file_path = f"{file_path}-mxml.musicxml"
-    score = converter.parse(midi_file_path)
-    # Some customization of the transcription
-    score.metadata.title = file.filename
-    score.metadata.composer = "Generated by String Scribe"
-    for part in score.parts:
-        part.keySignature = part.analyze("key")
-        # Check if part has any instruments
-        instruments = part.getInstruments()
-        if instruments:
-            # Set the first instrument to violin
-            instruments[0].instrumentName = "Violin"
-        else:
-            # Create instrument if none exists
-            violin = Violin()
-            part.append(violin)
-    score.write("musicxml", mxml_file_path)
-    return mxml_file_path
-
-
-# Returns estimated BPM of the file
-def extract_audio_tempo(file_path: str) -> int:
-    try:
-        # Load the audio file
-        y, sr = librosa.load(file_path)
-        # Extract tempo using librosa's tempo detection
-        tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
-        # Convert numpy float to Python float, then to int
-        detected_tempo = int(float(tempo))
-        return detected_tempo
-    except Exception as e:
-        log.error(f"Error extracting tempo from audio: {e}")
-        # Fallback to default tempo
-        return 120
-
-
-# Helper to read file at filePath
-def read_file(filePath: str) -> str:
-    with open(filePath, "r") as file:
-        file_content = file.read()
-        return file_content
 
 
-# Helper to delete file at filePath
-def delete_file(filePath: str):
-    if os.path.exists(filePath):
-        os.remove(filePath)
-        log.info(f"removed file at path {filePath}")
-    else:
-        log.info(f"file at path {filePath} not found")
-
-
-# Helper to create file in the processing directory
-async def create_file(file: UploadFile) -> str:
-    log.info(f"creating file {file.filename}")
-    out_path = f"./processing/{file.filename}"
-    with open(out_path, "wb") as f:
-        f.write(await file.read())
-    return out_path
+# Downloads and transcribes a YouTube video, then caches the result under key
+# progress is reported under key, for the jobs that joined its group
+async def transcribe_youtube(url: str, key: str, options: ScoreOptions = None) -> (str, bytes):
+    ## the audio's size isn't known before the download, so it always goes to disk
+    scratch = scratch_manager.Create()
+    try:
+        # Download audio from YouTube without blocking the event loop
+        job_store.HandleProgress(key, STAGE_DOWNLOAD)
+        with timed_stage("download"):
+            file_path = await asyncio.to_thread(download_youtube_audio, url, scratch)
+        result = await worker_pool.Run(
+            run_with_progress,
+            key,
+            transcribe_file,
+            file_path,
+            f"YouTube: {url}",
+            options,
+        )
+        await youtube_cache.Put(key, result)
+        return result
+    finally:
+        ## the space also holds yt-dlp's partial and intermediate files
+        scratch.Release()
 
 
-async def download_youtube_audio(url: str) -> str:
-    """Download audio from YouTube URL and return file path"""
-    # Generate random filename to avoid conflicts
-    random_id = secrets.token_urlsafe(8)
-    output_path = f"./processing/youtube_{random_id}.mp3"
+def download_youtube_audio(url: str, scratch: ScratchSpace) -> str:
+    """Download audio from YouTube URL into the scratch space and return file path"""
+    output_template = scratch.Path("youtube.%(ext)s")
 
     ydl_opts = {
         "cookiefile": "./cookies.firefox-private-2.txt",
@@ -161,54 +389,52 @@ async def download_youtube_audio(url: str) -> str:
         "noplaylist": True,
         ## get best audio available
         "format": "bestaudio/best",
-        ## extract audio from video
-        "postprocessors": [
-            {
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "mp3",
-                "preferredquality": "192",
-            }
-        ],
-        "outtmpl": output_path.replace(".mp3", ""),
+        "outtmpl": output_template,
+        ## yt-dlp skips formats bigger than what is left of the job's quota
+        "max_filesize": scratch.Remaining(),
         ## verbose errors
         "quiet": False,
         "no_warnings": False,
         "verbose": True,
         "print": "cookies",
     }
+    if youtube_ingest_mode == INGEST_MODE_MP3:
+        ## legacy behaviour: re-encode to MP3 before transcribing
+        ydl_opts["postprocessors"] = [
+            {
+                "key": "FFmpegExtractAudio",
+                "preferredcodec": "mp3",
+                "preferredquality": "192",
+            }
+        ]
 
     log.info(f"Downloading audio from YouTube: {url}")
+    ## imported here, it is slow to load and only YouTube requests need it
+    import yt_dlp
 
     try:
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+            ## look at the metadata first so long videos are refused before downloading
+            info = ydl.extract_info(url, download=False)
+            duration = info.get("duration")
+            if duration and duration > MAX_DURATION:
+                raise too_long_error()
+            info = ydl.process_ie_result(info, download=True)
+            ## the final path depends on the stream's container (webm, m4a...)
+            downloads = info.get("requested_downloads") or [{}]
+            output_path = downloads[0].get("filepath") or ydl.prepare_filename(info)
 
+        ## yt-dlp doesn't raise when max_filesize stops a download, it just leaves no file
+        if not os.path.exists(output_path):
+            raise ScratchQuotaError(
+                f"the video's audio is larger than {scratch.quota // (1024 * 1024)}MB"
+            )
+        scratch.Measure()
         log.info(f"Downloaded YouTube audio to {output_path}")
         return output_path
+    except (AudioTooLongError, ScratchQuotaError, ScratchFullError):
+        raise
     except Exception as e:
         log.error(f"Failed to download YouTube audio: {e}")
         raise Exception(f"Failed to download audio from YouTube: {str(e)}")
 
-
-def create_mxml_file_from_youtube(file_path: str, midi_file_path: str, url: str) -> str:
-    """Create musicXML file from YouTube download (same as create_mxml_file but with YouTube title)"""
-    log.info(f"attempting to convert MIDI to musicXML")
-    mxml_file_path = f"{file_path}-mxml.musicxml"
-    score = converter.parse(midi_file_path)
-
-    # Some customization of the transcription
-    score.metadata.title = f"YouTube: {url}"
-    score.metadata.composer = "Generated by String Scribe"
-    for part in score.parts:
-        part.keySignature = part.analyze("key")
-        # Check if part has any instruments
-        instruments = part.getInstruments()
-        if instruments:
-            # Set the first instrument to violin
-            instruments[0].instrumentName = "Violin"
-        else:
-            # Create instrument if none exists
-            violin = Violin()
-            part.append(violin)
-    score.write("musicxml", mxml_file_path)
-    return mxml_file_path
@@ -0,0 +1,255 @@
+import io, logger
+from collections import deque
+import numpy as np
+from basic_pitch.constants import AUDIO_SAMPLE_RATE, AUDIO_N_SAMPLES, FFT_HOP
+from basic_pitch.inference import window_audio_file, unwrap_output
+from basic_pitch import note_creation as infer
+from engine.activity import active_segments
+from engine.jobs import timed_stage
+from engine.settings import PREDICT_PARAMS, skip_silence
+
+## inference.py runs basic-pitch on audio that is already decoded in memory
+## basic-pitch's own predict() only accepts a path and decodes the file again
+
+log = logger.get()
+
+## same windowing basic-pitch's predict() uses
+N_OVERLAPPING_FRAMES = 30
+OVERLAP_LEN = N_OVERLAPPING_FRAMES * FFT_HOP
+HOP_SIZE = AUDIO_N_SAMPLES - OVERLAP_LEN
+
+## streaming mode: seconds of audio on either side of a chunk that are analyzed
+## but not owned by it, so notes crossing a chunk edge are seen whole
+CONTEXT_SECONDS = 2.0
+## notes of the same pitch this close together across a chunk edge are one note
+STITCH_TOLERANCE = 0.1
+
+# Runs the model over the audio and returns basic-pitch's raw model output
+def run_inference(audio: np.ndarray, model) -> dict:
+    for _, output in run_inference_batched([(None, audio)], model):
+        return output
+
+
+class PendingRecording:
+    """A recording whose windows are on their way through the model"""
+
+    def __init__(self, key, length: int):
+        self.key = key
+        self.length = length
+        self.outputs = {"note": [], "onset": [], "contour": []}
+        self.windows = 0
+        self.predicted = 0
+        ## set once every window of the recording has been queued
+        self.queued = False
+
+    def Done(self) -> bool:
+        return self.queued and self.predicted == self.windows
+
+    def Output(self) -> dict:
+        return {
+            k: unwrap_output(np.concatenate(v), self.length, N_OVERLAPPING_FRAMES)
+            for k, v in self.outputs.items()
+        }
+
+
+# Runs the model over several recordings, given as (key, audio) pairs, and yields
+# (key, raw model output) for each one as soon as its last window has been through the model
+## windows of consecutive recordings share model calls, so a batch of short files
+## runs as a few full calls instead of a partly empty one per file
+def run_inference_batched(recordings, model):
+    ## basic-pitch's own Model runs one window at a time
+    batch_windows = getattr(model, "batch_windows", 1)
+    batch = []
+    pending = []
+
+    def flush():
+        outputs = model.predict(np.stack([window for window, _ in batch]))
+        for index, (_, recording) in enumerate(batch):
+            for k, v in outputs.items():
+                recording.outputs[k].append(v[index : index + 1])
+            recording.predicted += 1
+        batch.clear()
+
+    def finished():
+        ## windows go through the model in order, so recordings finish in order too
+        while pending and pending[0].Done():
+            recording = pending.pop(0)
+            yield recording.key, recording.Output()
+
+    for key, audio in recordings:
+        recording = PendingRecording(key, audio.shape[0])
+        pending.append(recording)
+        ## pad the front so the first window's overlap lines up like basic-pitch does
+        padded = np.concatenate([np.zeros((OVERLAP_LEN // 2,), dtype=np.float32), audio])
+        for window, _ in window_audio_file(padded, HOP_SIZE):
+            batch.append((window, recording))
+            recording.windows += 1
+            if len(batch) >= batch_windows:
+                flush()
+                yield from finished()
+        recording.queued = True
+        yield from finished()
+    if batch:
+        flush()
+    yield from finished()
+
+
+# Transcribes several recordings, given as (key, audio) pairs, and yields (key, note events)
+# for each one in order as soon as it is done, note times are on the recording's own timeline
+## only the parts of each recording that may hold notes go through the model,
+## as recordings of their own in run_inference_batched
+def predict_batched(recordings, model):
+    ## recordings in the order they came in, and the note events of the ones that are done
+    order = deque()
+    done = {}
+    events = {}
+
+    def segments():
+        for number, (key, audio) in enumerate(recordings):
+            order.append((number, key))
+            events[number] = []
+            if skip_silence:
+                with timed_stage("activity"):
+                    found = active_segments(audio)
+                skipped = audio.shape[0] - sum(end - start for start, end in found)
+                if skipped:
+                    log.info(
+                        f"skipping {skipped / AUDIO_SAMPLE_RATE:.1f}s of "
+                        f"{audio.shape[0] / AUDIO_SAMPLE_RATE:.1f}s with no violin range energy"
+                    )
+            else:
+                found = [(0, audio.shape[0])]
+            if not found:
+                done[number] = []
+            for index, (start, end) in enumerate(found):
+                last = index == len(found) - 1
+                yield (number, start / AUDIO_SAMPLE_RATE, last), audio[start:end]
+
+    def finished():
+        while order and order[0][0] in done:
+            number, key = order.popleft()
+            yield key, done.pop(number)
+
+    for (number, offset, last), output in run_inference_batched(segments(), model):
+        events[number] += [
+            (start + offset, end + offset, pitch, amplitude, bends)
+            for start, end, pitch, amplitude, bends in output_to_note_events(output)
+        ]
+        if last:
+            done[number] = events.pop(number)
+        yield from finished()
+    yield from finished()
+
+
+# Returns the note events of a single recording, see predict_batched
+def predict_notes(audio: np.ndarray, model) -> list:
+    for _, note_events in predict_batched([(None, audio)], model):
+        return note_events
+
+
+# Turns raw model output into note events using PREDICT_PARAMS
+# each event is (start seconds, end seconds, MIDI pitch, amplitude, pitch bends)
+def output_to_note_events(model_output: dict) -> list:
+    min_note_len = int(
+        np.round(
+            PREDICT_PARAMS["minimum_note_length"] / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP)
+        )
+    )
+    contours = model_output["contour"]
+    estimated_notes = infer.output_to_notes_polyphonic(
+        model_output["note"],
+        model_output["onset"],
+        onset_thresh=PREDICT_PARAMS["onset_threshold"],
+        frame_thresh=PREDICT_PARAMS["frame_threshold"],
+        infer_onsets=True,
+        min_note_len=min_note_len,
+        min_freq=PREDICT_PARAMS["minimum_frequency"],
+        max_freq=PREDICT_PARAMS["maximum_frequency"],
+        melodia_trick=PREDICT_PARAMS["melodia_trick"],
+    )
+    with_bends = infer.get_pitch_bends(contours, estimated_notes)
+    times_s = infer.model_frames_to_time(contours.shape[0])
+    return [
+        (float(times_s[note[0]]), float(times_s[note[1]]), note[2], note[3], note[4])
+        for note in with_bends
+    ]
+
+
+# Builds a PrettyMIDI object from note events
+def note_events_to_midi(note_events: list, midi_tempo: int):
+    return infer.note_events_to_midi(
+        note_events, multiple_pitch_bends=False, midi_tempo=midi_tempo
+    )
+
+
+# Returns the MIDI file contents for a PrettyMIDI object
+def midi_to_bytes(midi_data) -> bytes:
+    buffer = io.BytesIO()
+    midi_data.write(buffer)
+    return buffer.getvalue()
+
+
+# Equivalent of basic-pitch's predict() for decoded audio, returns (PrettyMIDI, note events)
+def predict_audio(audio: np.ndarray, model, midi_tempo: int):
+    log.info(f"running inference on {audio.shape[0] / AUDIO_SAMPLE_RATE:.1f}s of audio")
+    note_events = predict_notes(audio, model)
+    return note_events_to_midi(note_events, midi_tempo), note_events
+
+
+# Runs inference chunk by chunk over a stream of audio blocks and returns the note events
+# only one block plus a little context is held at a time, so memory doesn't grow with duration
+def predict_stream(blocks, model, context_seconds: float = CONTEXT_SECONDS) -> list:
+    context = int(context_seconds * AUDIO_SAMPLE_RATE)
+    note_events = []
+    ## samples of the previous block kept as left context for the next chunk
+    tail = np.zeros((0,), dtype=np.float32)
+    pending = None
+    pending_start = 0
+    for block in blocks:
+        if pending is not None:
+            segment = np.concatenate([tail, pending, block[:context]])
+            predict_chunk(segment, model, pending_start, len(tail), len(pending), note_events)
+            tail = pending[-context:]
+            pending_start += len(pending)
+        pending = block
+    if pending is not None:
+        segment = np.concatenate([tail, pending])
+        predict_chunk(segment, model, pending_start, len(tail), len(pending), note_events)
+    return note_events
+
+
+# Runs inference on one chunk with its context and stitches its notes onto note_events
+def predict_chunk(segment, model, chunk_start, left_context, chunk_length, note_events):
+    log.info(f"running inference on chunk at {chunk_start / AUDIO_SAMPLE_RATE:.1f}s")
+    offset = (chunk_start - left_context) / AUDIO_SAMPLE_RATE
+    start = chunk_start / AUDIO_SAMPLE_RATE
+    end = (chunk_start + chunk_length) / AUDIO_SAMPLE_RATE
+    ## only notes still sounding at the chunk edge can be continued by this chunk
+    open_notes = [
+        i for i, note in enumerate(note_events) if note[1] >= start - STITCH_TOLERANCE
+    ]
+    for event in predict_notes(segment, model):
+        onset, offset_s, pitch, amplitude, bends = event
+        onset += offset
+        offset_s += offset
+        if onset >= end:
+            ## the next chunk owns this note and will see its onset
+            continue
+        if onset >= start:
+            note_events.append((onset, offset_s, pitch, amplitude, bends))
+            continue
+        ## the onset is in the previous chunk, so this is either the same note the
+        ## previous chunk found or the rest of one that got cut off at its edge
+        stitch_note(note_events, open_notes, onset, offset_s, pitch)
+
+
+# Extends the matching earlier note if the next chunk saw it last longer
+def stitch_note(note_events, open_notes, onset, offset_s, pitch):
+    for i in open_notes:
+        note = note_events[i]
+        if note[2] != pitch or note[1] < onset - STITCH_TOLERANCE:
+            continue
+        if offset_s > note[1]:
+            ## keep the earlier pitch bends, they were measured from the note's onset
+            note_events[i] = (note[0], offset_s, pitch, note[3], note[4])
+        return
@@ -0,0 +1,200 @@
+import asyncio, hashlib, logger, os, secrets, zipfile
+from fastapi import UploadFile
+from util import GetIntEnv
+from engine.scratch import ScratchSpace
+
+## ingest.py streams uploads into a job's scratch space a chunk at a time
+## so an upload never has to fit in memory, no matter how large the client says it is
+## batch uploads can also be zip archives, which are unpacked the same way
+
+log = logger.get()
+
+## largest audio upload we accept, in bytes
+MAX_UPLOAD_BYTES_ENV = "UPLOAD_MAX_BYTES"
+MAX_UPLOAD_BYTES = GetIntEnv(MAX_UPLOAD_BYTES_ENV, 50 * 1024 * 1024)
+
+## most files in one batch, counting each audio file inside a zip
+BATCH_MAX_FILES_ENV = "BATCH_MAX_FILES"
+BATCH_MAX_FILES = GetIntEnv(BATCH_MAX_FILES_ENV, 10)
+## largest batch request, every file and zip in it together, in bytes
+BATCH_MAX_BYTES_ENV = "BATCH_MAX_BYTES"
+BATCH_MAX_BYTES = GetIntEnv(BATCH_MAX_BYTES_ENV, 200 * 1024 * 1024)
+
+ZIP_MAGIC = b"PK\x03\x04"
+
+## bytes read from the upload per write
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+## enough of the file to recognize every format below
+SNIFF_BYTES = 12
+
+
+class UploadTooLargeError(Exception):
+    """Raised when an upload is larger than the allowed size"""
+
+
+class UnsupportedAudioError(Exception):
+    """Raised when an upload isn't in an audio format we can decode"""
+
+
+# Returns the file extension matching the audio format in the first bytes of a file,
+# or None if it isn't a format we recognize
+def sniff_audio_format(header: bytes):
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+        return ".wav"
+    if header[:4] == b"fLaC":
+        return ".flac"
+    if header[:4] == b"OggS":
+        ## vorbis and opus both live in ogg containers, ffmpeg handles either
+        return ".ogg"
+    if header[:4] == b"FORM" and header[8:12] in (b"AIFF", b"AIFC"):
+        return ".aiff"
+    if header[4:8] == b"ftyp":
+        ## MP4 family, which is how m4a and most AAC audio is stored
+        return ".m4a"
+    if header[:4] == b"\x1a\x45\xdf\xa3":
+        ## EBML header of webm and matroska
+        return ".webm"
+    if header[:3] == b"ID3":
+        return ".mp3"
+    if len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0:
+        ## MPEG frame sync, the layer bits are 00 for raw AAC (ADTS) and set for MP3
+        return ".aac" if header[1] & 0x06 == 0 else ".mp3"
+    return None
+
+
+# Streams an upload to a new file in the scratch space, returns its path and sha256 hash
+# the file is named after its sniffed format, never after the client's filename
+async def save_upload(
+    file: UploadFile, scratch: ScratchSpace, max_bytes: int = MAX_UPLOAD_BYTES
+) -> (str, str):
+    first = await file.read(UPLOAD_CHUNK_BYTES)
+    extension = sniff_audio_format(first[:SNIFF_BYTES])
+    if extension is None:
+        raise UnsupportedAudioError("file is not in a supported audio format")
+
+    out_path = scratch.Path(f"upload_{secrets.token_urlsafe(8)}{extension}")
+    log.info(f"saving upload {file.filename} to {out_path}")
+    digest = hashlib.sha256()
+    total = 0
+    try:
+        with open(out_path, "wb") as f:
+            chunk = first
+            while chunk:
+                total += len(chunk)
+                if total > max_bytes:
+                    raise UploadTooLargeError(
+                        f"File size must be less than {max_bytes // (1024 * 1024)}MB"
+                    )
+                scratch.Charge(len(chunk))
+                digest.update(chunk)
+                f.write(chunk)
+                chunk = await file.read(UPLOAD_CHUNK_BYTES)
+    except:
+        ## don't leave partial uploads behind
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        raise
+    return out_path, digest.hexdigest()
+
+
+# Saves one file of a batch upload to the scratch space, returns [(name, path, sha256 hash)]
+# for it, or for every audio file in it if it is a zip archive
+async def save_batch_upload(file: UploadFile, scratch: ScratchSpace, max_files: int) -> list:
+    first = await file.read(UPLOAD_CHUNK_BYTES)
+    await file.seek(0)
+    if first[:4] != ZIP_MAGIC:
+        path, audio_hash = await save_upload(file, scratch)
+        return [(file.filename, path, audio_hash)]
+
+    zip_path = scratch.Path(f"batch_{secrets.token_urlsafe(8)}.zip")
+    log.info(f"saving zip upload {file.filename} to {zip_path}")
+    written = 0
+    try:
+        with open(zip_path, "wb") as f:
+            total = 0
+            while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                total += len(chunk)
+                if total > BATCH_MAX_BYTES:
+                    raise UploadTooLargeError(
+                        f"Batch size must be less than {BATCH_MAX_BYTES // (1024 * 1024)}MB"
+                    )
+                scratch.Charge(len(chunk))
+                f.write(chunk)
+                written += len(chunk)
+        ## unpacking reads and writes every member, keep it off the event loop
+        return await asyncio.to_thread(extract_zip, zip_path, scratch, max_files)
+    finally:
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+        ## the unpacked members count against the quota, the archive no longer does
+        scratch.Charge(-written)
+
+
+# Unpacks the audio files of a zip archive into the scratch space,
+# returns [(name, path, sha256 hash)]
+## members are sniffed like uploads, anything that isn't audio is skipped
+def extract_zip(zip_path: str, scratch: ScratchSpace, max_files: int) -> list:
+    saved = []
+    try:
+        with zipfile.ZipFile(zip_path) as archive:
+            for info in archive.infolist():
+                name = os.path.basename(info.filename)
+                ## folders, macOS resource forks and hidden files
+                hidden = info.filename.startswith("__MACOSX/") or name.startswith(".")
+                if info.is_dir() or hidden:
+                    continue
+                with archive.open(info) as member:
+                    saved_member = extract_member(member, name, scratch)
+                if saved_member is None:
+                    log.info(f"skipping {info.filename} in zip upload, it isn't audio")
+                    continue
+                saved.append(saved_member)
+                if len(saved) > max_files:
+                    raise UploadTooLargeError(f"A batch can hold at most {max_files} files")
+    except zipfile.BadZipFile as e:
+        remove_saved(saved)
+        raise UnsupportedAudioError(f"zip archive could not be read: {e}")
+    except:
+        remove_saved(saved)
+        raise
+    if not saved:
+        raise UnsupportedAudioError("zip archive has no audio files in a supported format")
+    return saved
+
+
+# Writes one zip member to the scratch space like save_upload, returns (name, path, hash)
+# or None if it isn't in a supported audio format
+## the size limit counts the bytes actually unpacked, not what the archive claims
+def extract_member(member, name: str, scratch: ScratchSpace):
+    first = member.read(UPLOAD_CHUNK_BYTES)
+    extension = sniff_audio_format(first[:SNIFF_BYTES])
+    if extension is None:
+        return None
+    out_path = scratch.Path(f"upload_{secrets.token_urlsafe(8)}{extension}")
+    digest = hashlib.sha256()
+    total = 0
+    try:
+        with open(out_path, "wb") as f:
+            chunk = first
+            while chunk:
+                total += len(chunk)
+                if total > MAX_UPLOAD_BYTES:
+                    raise UploadTooLargeError(
+                        f"{name} must be less than {MAX_UPLOAD_BYTES // (1024 * 1024)}MB"
+                    )
+                scratch.Charge(len(chunk))
+                digest.update(chunk)
+                f.write(chunk)
+                chunk = member.read(UPLOAD_CHUNK_BYTES)
+    except:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        raise
+    return name, out_path, digest.hexdigest()
+
+
+def remove_saved(saved: list):
+    for _, path, _ in saved:
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,366 @@
+import asyncio, logger, multiprocessing, os, secrets, threading, time
+from contextlib import contextmanager
+from util import GetIntEnv
+from metrics import STAGE_SECONDS, Gauge
+
+## jobs.py tracks transcription jobs for the asynchronous job API
+## workers report which stage they are in through a multiprocessing queue,
+## and the API process turns those reports into job updates
+## the same queue carries stage timings back for /metrics,
+## and tells the API process when a worker's model is ready
+## batch jobs have a child job per file, their workers send each file's result
+## over the queue as soon as it is ready
+
+log = logger.get()
+
+JOB_TTL_ENV = "JOB_TTL"
+## seconds a finished job (and its result) is kept for clients to collect
+JOB_TTL = GetIntEnv(JOB_TTL_ENV, 15 * 60)
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+## pipeline stages in the order they happen
+STAGE_QUEUED = "queued"
+STAGE_DOWNLOAD = "download"
+STAGE_DECODE = "decode"
+STAGE_TEMPO = "tempo"
+STAGE_INFERENCE = "inference"
+STAGE_MUSICXML = "musicxml"
+STAGE_DONE = "done"
+STAGES = [
+    STAGE_QUEUED,
+    STAGE_DOWNLOAD,
+    STAGE_DECODE,
+    STAGE_TEMPO,
+    STAGE_INFERENCE,
+    STAGE_MUSICXML,
+    STAGE_DONE,
+]
+
+
+class Job:
+    def __init__(self, job_id: str, kind: str, name: str = None, parent=None):
+        self.id = job_id
+        self.kind = kind
+        ## file name of a batch item
+        self.name = name
+        ## batch jobs: the job of each file, in the order they were uploaded
+        self.items = []
+        self.parent = parent
+        self.status = STATUS_QUEUED
+        self.stage = STAGE_QUEUED
+        self.error = None
+        self.error_status = None
+        ## (musicXML string, MIDI bytes) once the job is done
+        self.result = None
+        self.created_at = time.time()
+        self.finished_at = None
+        ## bumped on every change so watchers know when to send an update
+        self.version = 0
+        self._changed = asyncio.Event()
+
+    def ToDict(self) -> dict:
+        result = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": STAGES.index(self.stage) / (len(STAGES) - 1),
+            "error": self.error,
+        }
+        if self.name is not None:
+            result["name"] = self.name
+        if self.items:
+            result["items"] = [item.ToDict() for item in self.items]
+        return result
+
+    def SetStage(self, stage: str):
+        if self.status in (STATUS_DONE, STATUS_FAILED):
+            return
+        self.status = STATUS_RUNNING
+        self.stage = stage
+        self._touch()
+
+    def Finish(self, result: tuple):
+        self.status = STATUS_DONE
+        self.stage = STAGE_DONE
+        self.result = result
+        self.finished_at = time.time()
+        self._touch()
+
+    def Fail(self, message: str, status: int):
+        self.status = STATUS_FAILED
+        self.error = message
+        self.error_status = status
+        self.finished_at = time.time()
+        self._touch()
+        ## a failed batch takes every file it hadn't finished down with it
+        for item in self.items:
+            if not item.Finished():
+                item.Fail(message, status)
+
+    def Finished(self) -> bool:
+        return self.status in (STATUS_DONE, STATUS_FAILED)
+
+    ## waits until the job changes from the given version, or the timeout passes
+    async def WaitForChange(self, version: int, timeout: float):
+        if self.version != version:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _touch(self):
+        self.version += 1
+        ## wake everyone waiting on the old event, later waiters get a fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
+        ## a batch changes whenever one of its files does
+        if self.parent is not None:
+            self.parent._touch()
+
+
+class JobStore:
+    """In-memory registry of jobs, finished jobs are dropped after JOB_TTL seconds"""
+
+    def __init__(self):
+        self._jobs = {}
+        ## keeps running tasks referenced so they aren't garbage collected
+        self._tasks = set()
+        ## progress ID -> [last stage, job IDs] for work several jobs share,
+        ## like one YouTube download coalesced across requests
+        self._groups = {}
+
+    ## parent makes the new job one item of that batch job
+    def Create(self, kind: str, name: str = None, parent: Job = None) -> Job:
+        self._sweep()
+        job = Job(secrets.token_urlsafe(16), kind, name, parent)
+        self._jobs[job.id] = job
+        if parent is not None:
+            parent.items.append(job)
+        return job
+
+    def Get(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    ## runs the coroutine in the background and records its result on the job
+    ## error_status maps an exception to the HTTP status reported to the client,
+    ## on_success and on_failure are coroutine functions awaited afterwards
+    def Run(self, job: Job, coro, error_status, on_success=None, on_failure=None):
+        async def runner():
+            try:
+                result = await coro
+            except Exception as e:
+                log.error(f"job {job.id} failed: {e}")
+                job.Fail(str(e), error_status(e))
+                if on_failure:
+                    await on_failure()
+                return
+            job.Finish(result)
+            if on_success:
+                await on_success()
+
+        task = asyncio.create_task(runner())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    ## called on the event loop for every stage a worker reports
+    ## job_id can also be the ID of a group, every job in it gets the stage
+    def HandleProgress(self, job_id: str, stage: str):
+        job = self._jobs.get(job_id)
+        if job:
+            job.SetStage(stage)
+        group = self._groups.get(job_id)
+        if group:
+            group[0] = stage
+            for member in group[1]:
+                self.HandleProgress(member, stage)
+
+    ## makes the job follow the progress reported under group_id,
+    ## a job joining work that is already under way starts at its current stage
+    def JoinGroup(self, group_id: str, job_id: str):
+        group = self._groups.setdefault(group_id, [None, []])
+        group[1].append(job_id)
+        if group[0] is not None:
+            self.HandleProgress(job_id, group[0])
+
+    ## the group is dropped once its last job leaves
+    def LeaveGroup(self, group_id: str, job_id: str):
+        group = self._groups.get(group_id)
+        if group is None:
+            return
+        if job_id in group[1]:
+            group[1].remove(job_id)
+        if not group[1]:
+            del self._groups[group_id]
+
+    ## called on the event loop for every batch item a worker finishes
+    def HandleResult(self, job_id: str, result: tuple):
+        job = self._jobs.get(job_id)
+        if job and not job.Finished():
+            job.Finish(result)
+
+    ## called on the event loop for every batch item a worker gives up on
+    def HandleFailure(self, job_id: str, message: str, status: int):
+        job = self._jobs.get(job_id)
+        if job and not job.Finished():
+            job.Fail(message, status)
+
+    ## (labels, count) pairs for /metrics
+    def CountByStatus(self) -> list:
+        counts = {status: 0 for status in (STATUS_QUEUED, STATUS_RUNNING, STATUS_DONE, STATUS_FAILED)}
+        for job in list(self._jobs.values()):
+            counts[job.status] += 1
+        return [({"status": status}, count) for status, count in counts.items()]
+
+    def _sweep(self):
+        now = time.time()
+        expired = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.finished_at and now - job.finished_at > JOB_TTL
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+## shared by every job in the API process
+job_store = JobStore()
+
+Gauge(
+    "string_scribe_jobs",
+    "Jobs in the job store by status",
+    ("status",),
+    fn=lambda: job_store.CountByStatus(),
+)
+
+## workers put ("stage", job ID, stage), ("timing", stage, seconds),
+## ("ready", process ID), ("result", job ID, (musicXML, MIDI bytes))
+## and ("failed", job ID, message, HTTP status) tuples here
+progress_queue = multiprocessing.Queue()
+MESSAGE_STAGE = "stage"
+MESSAGE_TIMING = "timing"
+MESSAGE_READY = "ready"
+MESSAGE_RESULT = "result"
+MESSAGE_FAILED = "failed"
+
+## process IDs of the workers whose model is loaded and warmed up
+warm_workers = set()
+
+## set inside each worker process
+CURRENT_JOB = None
+IN_WORKER = False
+
+
+# Starts a thread that forwards worker progress reports to the job store
+def StartProgressListener(loop: asyncio.AbstractEventLoop):
+    def listen():
+        while True:
+            item = progress_queue.get()
+            if item is None:
+                return
+            kind, *payload = item
+            if kind == MESSAGE_TIMING:
+                stage, seconds = payload
+                STAGE_SECONDS.Observe(seconds, stage=stage)
+            elif kind == MESSAGE_READY:
+                warm_workers.add(payload[0])
+            elif kind == MESSAGE_RESULT:
+                loop.call_soon_threadsafe(job_store.HandleResult, *payload)
+            elif kind == MESSAGE_FAILED:
+                loop.call_soon_threadsafe(job_store.HandleFailure, *payload)
+            else:
+                job_id, stage = payload
+                loop.call_soon_threadsafe(job_store.HandleProgress, job_id, stage)
+
+    threading.Thread(target=listen, name="job-progress", daemon=True).start()
+
+
+def StopProgressListener():
+    progress_queue.put(None)
+
+
+# Runs in a worker process when it starts, with the API process's queue
+def set_progress_queue(queue):
+    global progress_queue, IN_WORKER
+    progress_queue = queue
+    IN_WORKER = True
+
+
+# Runs in a worker process: calls fn(*args) with progress reports tagged with job_id
+def run_with_progress(job_id: str, fn, *args):
+    global CURRENT_JOB
+    CURRENT_JOB = job_id
+    try:
+        return fn(*args)
+    finally:
+        CURRENT_JOB = None
+
+
+# Reports the current stage of the job this process is working on, if any
+def report_stage(stage: str):
+    if CURRENT_JOB is None:
+        return
+    try:
+        progress_queue.put_nowait((MESSAGE_STAGE, CURRENT_JOB, stage))
+    except Exception as e:
+        ## progress is best effort, never fail a transcription over it
+        log.warning(f"could not report job progress: {e}")
+
+
+# Records how long a pipeline stage took, workers send it to the API process
+def report_timing(stage: str, seconds: float):
+    if not IN_WORKER:
+        STAGE_SECONDS.Observe(seconds, stage=stage)
+        return
+    try:
+        progress_queue.put_nowait((MESSAGE_TIMING, stage, seconds))
+    except Exception as e:
+        log.warning(f"could not report stage timing: {e}")
+
+
+# Tells the API process this worker's model is ready for jobs
+def report_ready():
+    if not IN_WORKER:
+        warm_workers.add(os.getpid())
+        return
+    try:
+        progress_queue.put_nowait((MESSAGE_READY, os.getpid()))
+    except Exception as e:
+        log.warning(f"could not report worker readiness: {e}")
+
+
+# Sends a finished batch item's (musicXML, MIDI bytes) to the API process
+def report_result(job_id: str, result: tuple):
+    report_item(MESSAGE_RESULT, job_id, result)
+
+
+# Tells the API process a batch item failed, status is the HTTP status for the client
+def report_failure(job_id: str, message: str, status: int):
+    report_item(MESSAGE_FAILED, job_id, message, status)
+
+
+def report_item(kind: str, job_id: str, *payload):
+    if job_id is None:
+        return
+    if not IN_WORKER:
+        handler = job_store.HandleResult if kind == MESSAGE_RESULT else job_store.HandleFailure
+        handler(job_id, *payload)
+        return
+    try:
+        progress_queue.put_nowait((kind, job_id, *payload))
+    except Exception as e:
+        ## the batch's own result still carries it once the whole batch is done
+        log.warning(f"could not report batch item: {e}")
+
+
+# Times the with block as the given pipeline stage, if it finishes without raising
+@contextmanager
+def timed_stage(stage: str):
+    start = time.perf_counter()
+    yield
+    report_timing(stage, time.perf_counter() - start)
@@ -0,0 +1,97 @@
+import logger, os
+import numpy as np
+
+## key.py estimates the key of a transcription straight from its note pitches
+## and durations, the same correlation music21's analyze("key") runs on a stream
+
+log = logger.get()
+
+KEY_PROFILE_ENV = "KEY_PROFILE"
+PROFILE_AARDEN = "aarden"
+PROFILE_KRUMHANSL = "krumhansl"
+
+## (major, minor) weight of each scale degree from the tonic up
+KEY_PROFILES = {
+    ## Aarden-Essen, the profiles music21's analyze("key") uses
+    PROFILE_AARDEN: (
+        [17.7661, 0.145624, 14.9265, 0.160186, 19.8049, 11.3587,
+         0.291248, 22.062, 0.145624, 8.15494, 0.232998, 4.95122],
+        [18.2648, 0.737619, 14.0499, 16.8599, 0.702494, 14.4362,
+         0.702494, 18.6161, 4.56621, 1.93186, 7.37619, 1.75623],
+    ),
+    ## Krumhansl-Kessler, music21's analyze("krumhansl")
+    PROFILE_KRUMHANSL: (
+        [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88],
+        [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17],
+    ),
+}
+
+MODE_MAJOR = "major"
+MODE_MINOR = "minor"
+
+## key signature of each tonic pitch class (sharps, negative for flats),
+## spelled the way music21 spells them, e.g. C# major but E-flat minor
+MAJOR_FIFTHS = [0, 7, 2, -3, 4, -1, 6, 1, -4, 3, -2, 5]
+MINOR_FIFTHS = [-3, 4, -1, -6, 1, -4, 3, -2, 5, 0, -5, 2]
+
+
+# Returns a (24, 12) matrix of every major then every minor profile rotated to each
+# tonic, centered and scaled to unit length so a matrix product gives correlations
+def key_profiles(name: str) -> np.ndarray:
+    if name not in KEY_PROFILES:
+        log.warning(f"unknown key profile {name}, using {PROFILE_AARDEN}")
+        name = PROFILE_AARDEN
+    major, minor = (np.array(weights) for weights in KEY_PROFILES[name])
+    profiles = np.stack(
+        [np.roll(major, tonic) for tonic in range(12)]
+        + [np.roll(minor, tonic) for tonic in range(12)]
+    )
+    profiles -= profiles.mean(axis=1, keepdims=True)
+    return profiles / np.linalg.norm(profiles, axis=1, keepdims=True)
+
+
+key_profile = os.getenv(KEY_PROFILE_ENV, PROFILE_AARDEN)
+PROFILES = key_profiles(key_profile)
+
+
+# Returns the duration weighted pitch class histogram of notes given as MIDI pitches
+def pitch_class_histogram(pitches, durations) -> np.ndarray:
+    return np.bincount(
+        np.asarray(pitches, dtype=np.int64) % 12,
+        weights=np.asarray(durations, dtype=float),
+        minlength=12,
+    )
+
+
+# Returns a (tonic pitch class, mode, fifths) for every row of an (n, 12) histogram array
+def estimate_keys(histograms: np.ndarray) -> list:
+    centered = histograms - histograms.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(centered, axis=1)
+    ## Pearson correlation of every histogram with all 24 profiles at once
+    correlations = centered @ PROFILES.T
+    best = np.argmax(correlations, axis=1)
+    keys = []
+    for index, norm in zip(best.tolist(), norms.tolist()):
+        tonic = index % 12
+        ## no notes, or every pitch class equally often, says nothing about the key
+        if norm < 1e-9:
+            keys.append((0, MODE_MAJOR, 0))
+        elif index < 12:
+            keys.append((tonic, MODE_MAJOR, MAJOR_FIFTHS[tonic]))
+        else:
+            keys.append((tonic, MODE_MINOR, MINOR_FIFTHS[tonic]))
+    return keys
+
+
+# Returns (tonic pitch class, mode, fifths) for notes given as MIDI pitches and durations
+def estimate_key(pitches, durations) -> (int, str, int):
+    return estimate_keys(pitch_class_histogram(pitches, durations)[np.newaxis])[0]
+
+
+# Same as estimate_key for basic-pitch note events
+# the correlation doesn't depend on scale, so durations in seconds work as well as beats
+def note_events_key(note_events: list) -> (int, str, int):
+    if not note_events:
+        return 0, MODE_MAJOR, 0
+    starts, ends, pitches = zip(*(event[:3] for event in note_events))
+    return estimate_key(pitches, np.subtract(ends, starts))
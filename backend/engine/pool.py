@@ -0,0 +1,170 @@
+import asyncio, logger, os, signal, time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from util import GetIntEnv
+from metrics import Counter
+
+## pool.py runs transcription jobs in a bounded pool of worker processes,
+## so the CPU heavy engine work never blocks the API event loop
+
+log = logger.get()
+
+ENGINE_WORKERS_ENV = "ENGINE_WORKERS"
+ENGINE_QUEUE_SIZE_ENV = "ENGINE_QUEUE_SIZE"
+ENGINE_JOB_TIMEOUT_ENV = "ENGINE_JOB_TIMEOUT"
+
+## number of jobs allowed to wait for a free worker before we start rejecting
+DEFAULT_QUEUE_SIZE = 4
+## seconds a single job may run before it is aborted
+DEFAULT_JOB_TIMEOUT = 300
+## extra seconds the API waits for a worker to abort a timed out job itself
+TIMEOUT_GRACE = 5
+
+POOL_JOBS = Counter(
+    "string_scribe_pool_jobs_total",
+    "Engine jobs by outcome (ok, rejected, timeout, error)",
+    ("outcome",),
+)
+
+
+class PoolSaturatedError(Exception):
+    """Raised when every worker is busy and the wait queue is full"""
+
+    def __init__(self, queue_depth: int, retry_after: int):
+        super().__init__(f"transcription queue is full ({queue_depth} waiting)")
+        self.queue_depth = queue_depth
+        self.retry_after = retry_after
+
+
+class JobTimeoutError(Exception):
+    """Raised when a job runs longer than the configured timeout"""
+
+
+# Returns the number of worker processes ENGINE_WORKERS asks for, one per core by default
+def WorkerCount() -> int:
+    return GetIntEnv(ENGINE_WORKERS_ENV, os.cpu_count() or 1)
+
+
+def _on_job_timeout(signum, frame):
+    raise JobTimeoutError("transcription job timed out")
+
+
+## runs inside the worker process
+## the alarm makes the worker abort the job itself, so a stuck job frees its worker
+def _run_job(timeout: int, submitted_at: float, wait_reporter, fn, *args):
+    if wait_reporter:
+        wait_reporter(time.time() - submitted_at)
+    use_alarm = hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _on_job_timeout)
+        signal.alarm(timeout)
+    try:
+        return fn(*args)
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+
+
+class WorkerPool:
+    """
+    Bounded process pool for engine jobs.
+    At most `workers` jobs run at once and at most `queue_size` more may wait,
+    anything past that is rejected with PoolSaturatedError.
+    wait_reporter, if given, is called in the worker with the seconds each job
+    spent waiting for it, so it must be a picklable module level function.
+    """
+
+    def __init__(
+        self,
+        initializer=None,
+        initargs=(),
+        workers=None,
+        queue_size=None,
+        timeout=None,
+        wait_reporter=None,
+    ):
+        self.initializer = initializer
+        self.initargs = initargs
+        self.wait_reporter = wait_reporter
+        self.workers = workers or WorkerCount()
+        self.queue_size = queue_size or GetIntEnv(
+            ENGINE_QUEUE_SIZE_ENV, DEFAULT_QUEUE_SIZE
+        )
+        self.timeout = timeout or GetIntEnv(
+            ENGINE_JOB_TIMEOUT_ENV, DEFAULT_JOB_TIMEOUT
+        )
+        self._executor = None
+        ## running + waiting jobs, only touched from the event loop thread
+        self._pending = 0
+
+    def Start(self):
+        if self._executor is not None:
+            return
+        log.info(
+            f"starting engine pool with {self.workers} workers "
+            f"(queue size {self.queue_size}, job timeout {self.timeout}s)"
+        )
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=self.initializer,
+            initargs=self.initargs,
+        )
+
+    def Shutdown(self):
+        if self._executor is None:
+            return
+        log.info("shutting down engine pool")
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    ## number of jobs waiting for a free worker
+    def QueueDepth(self) -> int:
+        return max(0, self._pending - self.workers)
+
+    ## number of jobs a worker is busy with
+    def Running(self) -> int:
+        return min(self._pending, self.workers)
+
+    ## runs fn(*args) in a worker process and returns its result
+    async def Run(self, fn, *args):
+        if self._executor is None:
+            self.Start()
+        if self._pending >= self.workers + self.queue_size:
+            ## rough guess: every queued job needs about one timeout's worth of work
+            POOL_JOBS.Inc(outcome="rejected")
+            raise PoolSaturatedError(self.QueueDepth(), self.timeout // self.workers)
+
+        loop = asyncio.get_running_loop()
+        self._pending += 1
+        log.info(f"submitting engine job (queue position {self.QueueDepth()})")
+        executor = self._executor
+        future = executor.submit(
+            _run_job, self.timeout, time.time(), self.wait_reporter, fn, *args
+        )
+        ## free the slot when the job actually finishes, not when we stop waiting for it
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._release)
+        )
+        try:
+            result = await asyncio.wait_for(
+                asyncio.wrap_future(future), timeout=self.timeout + TIMEOUT_GRACE
+            )
+            POOL_JOBS.Inc(outcome="ok")
+            return result
+        except (asyncio.TimeoutError, JobTimeoutError):
+            POOL_JOBS.Inc(outcome="timeout")
+            raise JobTimeoutError("transcription job timed out")
+        except BrokenProcessPool:
+            POOL_JOBS.Inc(outcome="error")
+            ## a worker died (most likely OOM), replace the pool so later jobs still run
+            if self._executor is executor:
+                log.error("engine worker died, restarting pool")
+                self.Shutdown()
+                self.Start()
+            raise
+        except Exception:
+            POOL_JOBS.Inc(outcome="error")
+            raise
+
+    def _release(self):
+        self._pending -= 1
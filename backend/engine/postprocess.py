@@ -0,0 +1,184 @@
+import logger
+from music21 import converter
+from music21.instrument import Violin
+from music21.key import KeySignature
+from music21.metadata import Metadata
+from music21.musicxml.m21ToXml import GeneralObjectExporter
+from engine.inference import note_events_to_midi, midi_to_bytes
+from engine.jobs import timed_stage
+from engine.key import note_events_key
+from engine.score import WriteMusicXML, DIVISIONS
+from engine.settings import (
+    ScoreOptions,
+    key_detection,
+    KEY_DETECTION_MUSIC21,
+    KEY_DETECTION_VALIDATE,
+    SCORE_WRITER_MUSIC21,
+    SCORE_WRITER_DIRECT,
+    STAGE_RANGE,
+    STAGE_QUANTIZE,
+    STAGE_METADATA,
+    STAGE_KEY,
+    STAGE_INSTRUMENT,
+)
+
+## postprocess.py turns a transcription's note events into MusicXML through
+## an ordered list of stages, each one timed and skippable per request
+
+log = logger.get()
+
+COMPOSER = "Generated by String Scribe"
+INSTRUMENT = "Violin"
+## violin range, from the open G string (G3) to E7
+LOWEST_PITCH = 55
+HIGHEST_PITCH = 100
+
+
+class Transcription:
+    """The score in the making, each stage fills in or rewrites part of it"""
+
+    def __init__(self, name: str, note_events: list, tempo: int):
+        self.name = name
+        self.note_events = note_events
+        self.tempo = tempo
+        ## left out of the score unless a stage sets them
+        self.title = None
+        self.composer = None
+        ## (mode, fifths)
+        self.key = None
+        self.instrument = None
+        self._score = None
+
+    ## music21 score of the note events, only built if a stage or the writer needs it
+    ## the stages that rewrite the note events run first, so it is built from the final notes
+    def Score(self):
+        if self._score is None:
+            with timed_stage("midi_to_score"):
+                midi_data = note_events_to_midi(self.note_events, self.tempo)
+                self._score = converter.parseData(midi_to_bytes(midi_data), format="midi")
+        return self._score
+
+
+# Moves a MIDI pitch by octaves until the violin can play it
+def octave_into_range(pitch: int) -> int:
+    while pitch < LOWEST_PITCH:
+        pitch += 12
+    while pitch > HIGHEST_PITCH:
+        pitch -= 12
+    return pitch
+
+
+def clamp_range(transcription: Transcription):
+    transcription.note_events = [
+        (start, end, octave_into_range(pitch), amplitude, bends)
+        for start, end, pitch, amplitude, bends in transcription.note_events
+    ]
+
+
+# Snaps note starts and ends to the sixteenth note grid the direct writer uses,
+# so music21 doesn't round odd lengths to triplets
+def quantize_events(transcription: Transcription):
+    step = 60 / transcription.tempo / DIVISIONS
+    events = []
+    for start, end, pitch, amplitude, bends in transcription.note_events:
+        onset = round(start / step)
+        ## a note never rounds away to nothing
+        offset = max(round(end / step), onset + 1)
+        events.append((onset * step, offset * step, pitch, amplitude, bends))
+    transcription.note_events = events
+
+
+def set_metadata(transcription: Transcription):
+    transcription.title = transcription.name
+    transcription.composer = COMPOSER
+
+
+def set_key(transcription: Transcription):
+    if key_detection == KEY_DETECTION_MUSIC21:
+        analyzed = transcription.Score().analyze("key")
+        transcription.key = (analyzed.mode, analyzed.sharps)
+        return
+    _, mode, fifths = note_events_key(transcription.note_events)
+    transcription.key = (mode, fifths)
+    if key_detection == KEY_DETECTION_VALIDATE:
+        analyzed = transcription.Score().analyze("key")
+        if (analyzed.mode, analyzed.sharps) != (mode, fifths):
+            log.warning(
+                f"key detection mismatch: numpy found {KeySignature(fifths).asKey(mode)}, "
+                f"music21 found {analyzed}"
+            )
+        transcription.key = (analyzed.mode, analyzed.sharps)
+
+
+def set_instrument(transcription: Transcription):
+    transcription.instrument = INSTRUMENT
+
+
+## each of STAGE_NAMES with the function that runs it
+STAGES = [
+    (STAGE_RANGE, clamp_range),
+    (STAGE_QUANTIZE, quantize_events),
+    (STAGE_METADATA, set_metadata),
+    (STAGE_KEY, set_key),
+    (STAGE_INSTRUMENT, set_instrument),
+]
+
+
+def write_music21(transcription: Transcription) -> str:
+    score = transcription.Score()
+    ## unlike converter.parse, parsing from memory leaves the metadata unset
+    if score.metadata is None:
+        score.metadata = Metadata()
+    if transcription.title is not None:
+        score.metadata.title = transcription.title
+    if transcription.composer is not None:
+        score.metadata.composer = transcription.composer
+    for part in score.parts:
+        if transcription.key is not None:
+            mode, fifths = transcription.key
+            part.keySignature = KeySignature(fifths).asKey(mode)
+        if transcription.instrument is not None:
+            # Check if part has any instruments
+            instruments = part.getInstruments()
+            if instruments:
+                # Set the first instrument to violin
+                instruments[0].instrumentName = transcription.instrument
+            else:
+                # Create instrument if none exists
+                part.append(Violin())
+    with timed_stage("score_write"):
+        return GeneralObjectExporter(score).parse().decode("utf-8")
+
+
+def write_direct(transcription: Transcription) -> str:
+    with timed_stage("score_write"):
+        return WriteMusicXML(
+            transcription.note_events,
+            transcription.tempo,
+            title=transcription.title,
+            composer=transcription.composer,
+            key=transcription.key,
+            instrument=transcription.instrument,
+        )
+
+
+WRITERS = {
+    SCORE_WRITER_MUSIC21: write_music21,
+    SCORE_WRITER_DIRECT: write_direct,
+}
+
+
+# Runs every stage options doesn't skip, then its writer, and returns the MusicXML string
+# each event is (start seconds, end seconds, MIDI pitch, amplitude, pitch bends)
+def BuildScore(
+    name: str, note_events: list, tempo: int, options: ScoreOptions = None
+) -> str:
+    options = options or ScoreOptions()
+    transcription = Transcription(name, note_events, tempo)
+    for stage_name, stage in STAGES:
+        if stage_name in options.skip:
+            continue
+        with timed_stage(f"post_{stage_name}"):
+            stage(transcription)
+    writer = WRITERS.get(options.writer, write_music21)
+    return writer(transcription)
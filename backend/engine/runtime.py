@@ -0,0 +1,109 @@
+import logger, os
+import numpy as np
+import onnxruntime as ort
+from basic_pitch import ICASSP_2022_MODEL_PATH, build_icassp_2022_model_path, FilenameSuffix
+from basic_pitch.constants import AUDIO_N_SAMPLES
+from basic_pitch.inference import Model
+from util import GetIntEnv
+
+## runtime.py loads the basic-pitch model once per worker process, runs it through
+## an ONNX Runtime session we configure ourselves, and warms it up before the first job
+
+log = logger.get()
+
+## onnx runs the ONNX model with the thread and provider settings below,
+## auto leaves the choice to basic-pitch, which prefers TensorFlow when it is installed
+MODEL_RUNTIME_ENV = "ENGINE_MODEL_RUNTIME"
+RUNTIME_ONNX = "onnx"
+RUNTIME_AUTO = "auto"
+
+## threads ONNX Runtime uses inside one inference call,
+## defaults to the cores each worker process gets to itself
+ONNX_THREADS_ENV = "ENGINE_ONNX_THREADS"
+## comma separated ONNX Runtime execution providers, in order of preference
+ONNX_PROVIDERS_ENV = "ENGINE_ONNX_PROVIDERS"
+DEFAULT_PROVIDERS = "CPUExecutionProvider"
+## model input windows (about 2 seconds of audio each) sent to ONNX Runtime per call,
+## they can come from several recordings at once (inference.run_inference_batched)
+INFERENCE_BATCH_ENV = "ENGINE_INFERENCE_BATCH"
+inference_batch = GetIntEnv(INFERENCE_BATCH_ENV, 8)
+
+## basic-pitch's output names for each of its model outputs
+ONNX_INPUT = "serving_default_input_2:0"
+ONNX_OUTPUTS = {
+    "note": "StatefulPartitionedCall:1",
+    "onset": "StatefulPartitionedCall:2",
+    "contour": "StatefulPartitionedCall:0",
+}
+
+
+class OnnxModel:
+    """
+    The basic-pitch ONNX model in a session of our own.
+    predict works like basic-pitch's Model.predict, so inference.py takes either.
+    """
+
+    def __init__(self, model_path: str, threads: int, providers: list):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        ## the model is one chain of convolutions, nothing for a second pool to run alongside
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=providers)
+        self.output_names = list(ONNX_OUTPUTS.values())
+        ## the batch dimension of the model's input is dynamic
+        self.batch_windows = inference_batch
+
+    def predict(self, x: np.ndarray) -> dict:
+        outputs = self.session.run(self.output_names, {ONNX_INPUT: x})
+        return dict(zip(ONNX_OUTPUTS, outputs))
+
+
+# Returns the intra-op threads for each of `workers` worker processes,
+# sharing the cores out so concurrent jobs don't fight over them
+def ThreadsPerWorker(workers: int) -> int:
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    return GetIntEnv(ONNX_THREADS_ENV, max(1, (cores or 1) // max(1, workers)))
+
+
+# Returns the configured execution providers this onnxruntime build has
+def onnx_providers() -> list:
+    requested = [
+        name.strip()
+        for name in os.getenv(ONNX_PROVIDERS_ENV, DEFAULT_PROVIDERS).split(",")
+        if name.strip()
+    ]
+    available = ort.get_available_providers()
+    providers = [name for name in requested if name in available]
+    missing = [name for name in requested if name not in available]
+    if missing:
+        log.warning(f"ONNX Runtime providers {', '.join(missing)} are not available")
+    if not providers:
+        log.warning(f"no usable ONNX Runtime providers, using {DEFAULT_PROVIDERS}")
+        providers = [DEFAULT_PROVIDERS]
+    return providers
+
+
+# Returns the model for this worker, threads is its share of the cores
+def LoadModel(threads: int):
+    runtime = os.getenv(MODEL_RUNTIME_ENV, RUNTIME_ONNX)
+    if runtime == RUNTIME_AUTO:
+        log.info("loading basic-pitch model")
+        return Model(ICASSP_2022_MODEL_PATH)
+    if runtime != RUNTIME_ONNX:
+        log.warning(f"unknown model runtime {runtime}, using {RUNTIME_ONNX}")
+    providers = onnx_providers()
+    log.info(
+        f"loading basic-pitch ONNX model with {threads} threads on {', '.join(providers)}"
+    )
+    return OnnxModel(
+        str(build_icassp_2022_model_path(FilenameSuffix.onnx)), threads, providers
+    )
+
+
+# Runs the model once on a full batch of silence, so the first job doesn't pay for
+# ONNX Runtime's memory allocation and kernel selection
+def WarmUp(model):
+    batch = getattr(model, "batch_windows", 1)
+    model.predict(np.zeros((batch, AUDIO_N_SAMPLES, 1), dtype=np.float32))
@@ -0,0 +1,295 @@
+import numpy as np
+from xml.sax.saxutils import escape
+
+## score.py writes violin MusicXML straight from basic-pitch's note events,
+## without the MIDI parse and music21 score the default writer builds
+
+## grid steps per quarter note, every onset and length is rounded to a sixteenth
+DIVISIONS = 4
+BEATS_PER_MEASURE = 4
+MEASURE_STEPS = DIVISIONS * BEATS_PER_MEASURE
+## most voices in the score, anything past this cuts off the earliest ending voice
+MAX_VOICES = 4
+## overlaps up to this many steps are legato, not a second voice, so the earlier note is shortened
+LEGATO_STEPS = 2
+
+## lengths in grid steps that can be written as a single note: (steps, type, dots)
+NOTE_TYPES = [
+    (16, "whole", 0),
+    (14, "half", 2),
+    (12, "half", 1),
+    (8, "half", 0),
+    (7, "quarter", 2),
+    (6, "quarter", 1),
+    (4, "quarter", 0),
+    (3, "eighth", 1),
+    (2, "eighth", 0),
+    (1, "16th", 0),
+]
+
+## (step, alter) of each pitch class, spelled with sharps or with flats
+SHARP_SPELLING = [
+    ("C", 0), ("C", 1), ("D", 0), ("D", 1), ("E", 0), ("F", 0),
+    ("F", 1), ("G", 0), ("G", 1), ("A", 0), ("A", 1), ("B", 0),
+]
+FLAT_SPELLING = [
+    ("C", 0), ("D", -1), ("D", 0), ("E", -1), ("E", 0), ("F", 0),
+    ("G", -1), ("G", 0), ("A", -1), ("A", 0), ("B", -1), ("B", 0),
+]
+
+HEADER = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE score-partwise  PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" "http://www.musicxml.org/dtds/partwise.dtd">
+"""
+
+
+class Chord:
+    """Notes that start together, start and end are in grid steps"""
+
+    def __init__(self, start: int, end: int, pitches: list, velocity: int):
+        self.start = start
+        self.end = end
+        self.pitches = pitches
+        self.velocity = velocity
+
+
+# Rounds note events to the grid, returns (starts, ends, pitches, velocities) arrays
+# sorted by start then pitch, with repeated notes of one pitch at one start merged
+def quantize(note_events: list, tempo: int) -> tuple:
+    events = np.array([event[:4] for event in note_events], dtype=float).reshape(-1, 4)
+    steps_per_second = tempo / 60 * DIVISIONS
+    starts = np.rint(events[:, 0] * steps_per_second).astype(np.int64)
+    ## a note never rounds away to nothing
+    ends = np.maximum(np.rint(events[:, 1] * steps_per_second).astype(np.int64), starts + 1)
+    pitches = events[:, 2].astype(np.int64)
+    velocities = np.clip(np.rint(events[:, 3] * 127), 1, 127).astype(np.int64)
+    order = np.lexsort((pitches, starts))
+    starts, ends, pitches, velocities = (
+        starts[order], ends[order], pitches[order], velocities[order]
+    )
+    _, first = np.unique(starts * 128 + pitches, return_index=True)
+    if len(first) < len(starts):
+        ends = np.maximum.reduceat(ends, first)
+        starts, pitches, velocities = starts[first], pitches[first], velocities[first]
+    return starts, ends, pitches, velocities
+
+
+# Groups quantized notes into chords and spreads overlapping chords over voices
+def assign_voices(starts, ends, pitches, velocities) -> list:
+    voices = []
+    if len(starts) == 0:
+        return voices
+    chord_starts, first = np.unique(starts, return_index=True)
+    chord_ends = np.maximum.reduceat(ends, first)
+    chord_velocities = np.maximum.reduceat(velocities, first)
+    chord_pitches = np.split(pitches, first[1:])
+    for start, end, chord_pitches, velocity in zip(
+        chord_starts.tolist(), chord_ends.tolist(), chord_pitches, chord_velocities.tolist()
+    ):
+        chord = Chord(start, end, chord_pitches.tolist(), velocity)
+        voice = next((v for v in voices if v[-1].end <= start), None)
+        if voice is None and voices:
+            ## the voice that frees up first gets cut short if it is legato or we're out of voices
+            earliest = min(voices, key=lambda v: v[-1].end)
+            if earliest[-1].end - start <= LEGATO_STEPS or len(voices) >= MAX_VOICES:
+                earliest[-1].end = start
+                voice = earliest
+        if voice is None:
+            voice = []
+            voices.append(voice)
+        voice.append(chord)
+    return voices
+
+
+# Splits a length in grid steps into note types, longest first
+def split_length(length: int) -> list:
+    pieces = []
+    while length > 0:
+        piece = next(note_type for note_type in NOTE_TYPES if note_type[0] <= length)
+        pieces.append(piece)
+        length -= piece[0]
+    return pieces
+
+
+# Returns each measure's notes for one voice as lists of
+# [start, steps, type, dots, chord or None for a rest, tie stop, tie start]
+def voice_measures(voice: list, measures: int) -> list:
+    ## chords with the rests between them, covering the whole score
+    spans = []
+    position = 0
+    for chord in voice:
+        if chord.start > position:
+            spans.append((position, chord.start, None))
+        spans.append((chord.start, chord.end, chord))
+        position = chord.end
+    spans.append((position, measures * MEASURE_STEPS, None))
+
+    notes = [[] for _ in range(measures)]
+    for start, end, chord in spans:
+        position = start
+        while position < end:
+            measure = position // MEASURE_STEPS
+            ## notes crossing a barline are split and tied over it
+            piece_end = min(end, (measure + 1) * MEASURE_STEPS)
+            for steps, note_type, dots in split_length(piece_end - position):
+                notes[measure].append(
+                    [position, steps, note_type, dots, chord,
+                     chord is not None and position > start,
+                     chord is not None and position + steps < end]
+                )
+                position += steps
+    return notes
+
+
+# Returns {index in notes: [(beam number, value)]} for one voice's notes in a measure
+# eighths and sixteenths are beamed together within each beat
+def beam_groups(notes: list) -> dict:
+    groups = []
+    group = []
+    for index, (start, steps, _, _, chord, _, _) in enumerate(notes):
+        beat = start // DIVISIONS
+        beamable = (
+            chord is not None
+            and steps < DIVISIONS
+            and (start + steps - 1) // DIVISIONS == beat
+        )
+        if group and (not beamable or notes[group[-1]][0] // DIVISIONS != beat):
+            groups.append(group)
+            group = []
+        if beamable:
+            group.append(index)
+    groups.append(group)
+
+    beams = {}
+    for group in groups:
+        if len(group) < 2:
+            continue
+        for position, index in enumerate(group):
+            value = "begin" if position == 0 else "end" if position == len(group) - 1 else "continue"
+            beams[index] = [(1, value)]
+        ## second beam between neighbouring sixteenths, a hook on a lone one
+        sixteenths = [notes[index][1] == 1 for index in group]
+        for position, index in enumerate(group):
+            if not sixteenths[position]:
+                continue
+            before = position > 0 and sixteenths[position - 1]
+            after = position < len(group) - 1 and sixteenths[position + 1]
+            if before and after:
+                value = "continue"
+            elif after:
+                value = "begin"
+            elif before:
+                value = "end"
+            else:
+                value = "forward hook" if position == 0 else "backward hook"
+            beams[index].append((2, value))
+    return beams
+
+
+def write_note(out: list, note: list, voice: int, beams: list, spelling: list):
+    start, steps, note_type, dots, chord, tie_stop, tie_start = note
+    pitches = chord.pitches if chord is not None else [None]
+    for index, pitch in enumerate(pitches):
+        ## velocity goes on the attack, like music21 writes it
+        if chord is not None and not tie_stop:
+            out.append(f'<note dynamics="{chord.velocity / 90 * 100:.2f}">')
+        else:
+            out.append("<note>")
+        if index > 0:
+            out.append("<chord/>")
+        if pitch is None:
+            out.append("<rest/>")
+        else:
+            step, alter = spelling[pitch % 12]
+            out.append(f"<pitch><step>{step}</step>")
+            if alter:
+                out.append(f"<alter>{alter}</alter>")
+            out.append(f"<octave>{pitch // 12 - 1}</octave></pitch>")
+        out.append(f"<duration>{steps}</duration>")
+        if tie_stop:
+            out.append('<tie type="stop"/>')
+        if tie_start:
+            out.append('<tie type="start"/>')
+        out.append(f"<voice>{voice}</voice><type>{note_type}</type>")
+        out.append("<dot/>" * dots)
+        ## beams belong to the chord's first note only
+        if index == 0:
+            for number, value in beams:
+                out.append(f'<beam number="{number}">{value}</beam>')
+        if tie_stop or tie_start:
+            out.append("<notations>")
+            if tie_stop:
+                out.append('<tied type="stop"/>')
+            if tie_start:
+                out.append('<tied type="start"/>')
+            out.append("</notations>")
+        out.append("</note>")
+
+
+# Returns a single part MusicXML score for basic-pitch note events
+# each event is (start seconds, end seconds, MIDI pitch, amplitude, pitch bends)
+# title, composer, key as (mode, fifths) and instrument are left out when None
+def WriteMusicXML(
+    note_events: list, tempo: int, title: str = None, composer: str = None,
+    key: tuple = None, instrument: str = None,
+) -> str:
+    starts, ends, pitches, velocities = quantize(note_events, tempo)
+    spelling = FLAT_SPELLING if key is not None and key[1] < 0 else SHARP_SPELLING
+    voices = assign_voices(starts, ends, pitches, velocities)
+    measures = max(1, -(-int(ends.max(initial=0)) // MEASURE_STEPS))
+    ## an empty transcription is one bar of rest
+    per_voice = [voice_measures(voice, measures) for voice in voices] or [
+        voice_measures([], measures)
+    ]
+
+    out = [HEADER, '<score-partwise version="4.0">']
+    if title is not None:
+        title = escape(title)
+        out.append(f"<work><work-title>{title}</work-title></work>")
+        out.append(f"<movement-title>{title}</movement-title>")
+    out.append("<identification>")
+    if composer is not None:
+        out.append(f'<creator type="composer">{escape(composer)}</creator>')
+    out.append("<encoding><software>String Scribe</software></encoding></identification>")
+    out.append('<part-list><score-part id="P1">')
+    if instrument is not None:
+        instrument = escape(instrument)
+        out += [
+            f"<part-name>{instrument}</part-name>",
+            f'<score-instrument id="P1-I1"><instrument-name>{instrument}</instrument-name></score-instrument>',
+            '<midi-instrument id="P1-I1"><midi-channel>1</midi-channel>',
+            "<midi-program>41</midi-program></midi-instrument>",
+        ]
+    else:
+        out.append("<part-name/>")
+    out += ["</score-part></part-list>", '<part id="P1">']
+    key_element = "" if key is None else (
+        f"<key><fifths>{key[1]}</fifths><mode>{key[0]}</mode></key>"
+    )
+    for measure in range(measures):
+        out.append(f'<measure number="{measure + 1}">')
+        if measure == 0:
+            out.append(
+                f"<attributes><divisions>{DIVISIONS}</divisions>"
+                f"{key_element}"
+                f"<time><beats>{BEATS_PER_MEASURE}</beats><beat-type>4</beat-type></time>"
+                "<clef><sign>G</sign><line>2</line></clef></attributes>"
+                '<direction placement="above"><direction-type>'
+                '<metronome parentheses="no"><beat-unit>quarter</beat-unit>'
+                f"<per-minute>{tempo}</per-minute></metronome></direction-type>"
+                f'<sound tempo="{tempo}"/></direction>'
+            )
+        written = False
+        for voice, notes in enumerate(per_voice):
+            notes = notes[measure]
+            ## only the first voice fills bars it has nothing in
+            if voice > 0 and all(note[4] is None for note in notes):
+                continue
+            if written:
+                out.append(f"<backup><duration>{MEASURE_STEPS}</duration></backup>")
+            beams = beam_groups(notes)
+            for index, note in enumerate(notes):
+                write_note(out, note, voice + 1, beams.get(index, []), spelling)
+            written = True
+        out.append("</measure>")
+    out.append("</part></score-partwise>\n")
+    return "".join(out)
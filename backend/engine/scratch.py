@@ -0,0 +1,220 @@
+import asyncio, logger, os, secrets, shutil, threading, time
+from util import GetIntEnv
+from metrics import Counter, Gauge
+
+## scratch.py hands out a working directory of its own to every job that needs files on disk:
+## uploads, unpacked zips and YouTube downloads. Small jobs can get one on a RAM-backed
+## filesystem. Every job and the machine as a whole have a byte quota, and a janitor
+## deletes whatever a crashed or killed job left behind
+
+log = logger.get()
+
+SCRATCH_DIR_ENV = "ENGINE_SCRATCH_DIR"
+## a tmpfs mount such as /dev/shm, unset keeps every job on disk
+SCRATCH_RAM_DIR_ENV = "ENGINE_SCRATCH_RAM_DIR"
+SCRATCH_RAM_JOB_BYTES_ENV = "ENGINE_SCRATCH_RAM_JOB_BYTES"
+SCRATCH_RAM_MAX_BYTES_ENV = "ENGINE_SCRATCH_RAM_MAX_BYTES"
+SCRATCH_JOB_MAX_BYTES_ENV = "ENGINE_SCRATCH_JOB_MAX_BYTES"
+SCRATCH_MAX_BYTES_ENV = "ENGINE_SCRATCH_MAX_BYTES"
+SCRATCH_ORPHAN_SECONDS_ENV = "ENGINE_SCRATCH_ORPHAN_SECONDS"
+
+MEDIUM_DISK = "disk"
+MEDIUM_RAM = "ram"
+
+## how often the janitor looks for orphaned files
+JANITOR_SECONDS = 5 * 60
+## suggested wait for clients when scratch space is full
+FULL_RETRY_AFTER = 30
+
+ORPHANS_REMOVED = Counter(
+    "string_scribe_scratch_orphans_removed_total",
+    "Files and directories left behind by jobs that the janitor deleted",
+)
+
+
+class ScratchQuotaError(Exception):
+    """Raised when a job writes more than its scratch quota"""
+
+
+class ScratchFullError(Exception):
+    """Raised when every job together would write more than the machine's scratch quota"""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.retry_after = FULL_RETRY_AFTER
+
+
+class ScratchSpace:
+    """A job's own directory, deleted with everything in it by Release"""
+
+    def __init__(self, manager, path: str, medium: str, quota: int):
+        self.manager = manager
+        self.path = path
+        self.medium = medium
+        self.quota = quota
+        self.used = 0
+
+    ## a path for a new file in the space
+    def Path(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def Remaining(self) -> int:
+        return max(0, self.quota - self.used)
+
+    ## counts bytes about to be written, raises if they don't fit
+    def Charge(self, size: int):
+        self.manager.charge(self, size)
+
+    ## counts files written by something that couldn't charge as it went (yt-dlp)
+    def Measure(self):
+        total = 0
+        for directory, _, names in os.walk(self.path):
+            for name in names:
+                try:
+                    total += os.path.getsize(os.path.join(directory, name))
+                except OSError:
+                    pass
+        self.Charge(total - self.used)
+
+    def Release(self):
+        self.manager.release(self)
+
+
+class ScratchManager:
+    """Creates and tracks the scratch spaces of the jobs running in this process"""
+
+    def __init__(
+        self,
+        disk_dir: str,
+        ram_dir: str,
+        ram_job_bytes: int,
+        ram_max_bytes: int,
+        job_max_bytes: int,
+        max_bytes: int,
+        orphan_seconds: int,
+    ):
+        self.roots = {MEDIUM_DISK: disk_dir}
+        if ram_dir:
+            self.roots[MEDIUM_RAM] = ram_dir
+        for root in self.roots.values():
+            os.makedirs(root, exist_ok=True)
+        self.ram_job_bytes = ram_job_bytes
+        self.ram_max_bytes = ram_max_bytes
+        self.job_max_bytes = job_max_bytes
+        self.max_bytes = max_bytes
+        self.orphan_seconds = orphan_seconds
+        ## path -> ScratchSpace of every live job
+        self.spaces = {}
+        self.used = {MEDIUM_DISK: 0, MEDIUM_RAM: 0}
+        self.lock = threading.Lock()
+
+    def FromEnv():
+        return ScratchManager(
+            os.getenv(SCRATCH_DIR_ENV, "./processing"),
+            os.getenv(SCRATCH_RAM_DIR_ENV, ""),
+            GetIntEnv(SCRATCH_RAM_JOB_BYTES_ENV, 16 * 1024 * 1024),
+            GetIntEnv(SCRATCH_RAM_MAX_BYTES_ENV, 128 * 1024 * 1024),
+            GetIntEnv(SCRATCH_JOB_MAX_BYTES_ENV, 512 * 1024 * 1024),
+            GetIntEnv(SCRATCH_MAX_BYTES_ENV, 2 * 1024 * 1024 * 1024),
+            GetIntEnv(SCRATCH_ORPHAN_SECONDS_ENV, 15 * 60),
+        )
+
+    ## a new space for a job, in RAM if expected_bytes is known and small enough to fit there
+    def Create(self, expected_bytes: int = None) -> ScratchSpace:
+        medium = MEDIUM_DISK
+        quota = self.job_max_bytes
+        with self.lock:
+            if (
+                MEDIUM_RAM in self.roots
+                and expected_bytes is not None
+                and expected_bytes <= self.ram_job_bytes
+                and self.used[MEDIUM_RAM] + expected_bytes <= self.ram_max_bytes
+            ):
+                medium = MEDIUM_RAM
+                quota = min(quota, self.ram_job_bytes)
+            path = os.path.join(self.roots[medium], f"job_{secrets.token_urlsafe(8)}")
+            os.makedirs(path)
+            space = ScratchSpace(self, path, medium, quota)
+            self.spaces[path] = space
+        return space
+
+    ## releases the space holding path, or deletes path itself if it isn't in one
+    def Release(self, path: str):
+        space = self.spaces.get(os.path.dirname(path))
+        if space is not None:
+            space.Release()
+        elif os.path.exists(path):
+            os.remove(path)
+
+    ## (labels, bytes) pairs for /metrics
+    def UsedByMedium(self) -> list:
+        return [({"medium": medium}, used) for medium, used in self.used.items()]
+
+    def charge(self, space: ScratchSpace, size: int):
+        with self.lock:
+            if size > 0 and space.used + size > space.quota:
+                raise ScratchQuotaError(
+                    f"job needs more than {space.quota // (1024 * 1024)}MB of scratch space"
+                )
+            total = self.used[MEDIUM_DISK] + self.used[MEDIUM_RAM]
+            if size > 0 and total + size > self.max_bytes:
+                raise ScratchFullError("the server is out of scratch space")
+            space.used += size
+            self.used[space.medium] += size
+
+    def release(self, space: ScratchSpace):
+        with self.lock:
+            if self.spaces.pop(space.path, None) is None:
+                return
+            self.used[space.medium] -= space.used
+        shutil.rmtree(space.path, ignore_errors=True)
+        log.info(f"removed scratch space {space.path}")
+
+    ## deletes everything in the scratch directories that no live job owns
+    ## and hasn't been touched for orphan_seconds, returns how many entries went
+    def Sweep(self) -> int:
+        cutoff = time.time() - self.orphan_seconds
+        removed = 0
+        for root in self.roots.values():
+            try:
+                entries = list(os.scandir(root))
+            except OSError as e:
+                log.warning(f"could not list scratch directory {root}: {e}")
+                continue
+            for entry in entries:
+                if entry.path in self.spaces:
+                    continue
+                try:
+                    if entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
+                except OSError as e:
+                    log.warning(f"could not remove orphaned {entry.path}: {e}")
+                    continue
+                removed += 1
+        if removed:
+            log.info(f"removed {removed} orphaned scratch entries")
+            ORPHANS_REMOVED.Inc(removed)
+        return removed
+
+    ## runs Sweep every JANITOR_SECONDS, off the event loop
+    async def RunJanitor(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.Sweep)
+            except Exception as e:
+                log.error(f"scratch janitor failed: {e}")
+            await asyncio.sleep(JANITOR_SECONDS)
+
+
+scratch_manager = ScratchManager.FromEnv()
+
+Gauge(
+    "string_scribe_scratch_bytes",
+    "Bytes written to job scratch spaces, by medium",
+    ("medium",),
+    fn=lambda: scratch_manager.UsedByMedium(),
+)
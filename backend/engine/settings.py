@@ -0,0 +1,103 @@
+import os
+from engine.key import key_profile
+
+## settings.py holds everything that decides how a recording is transcribed:
+## basic-pitch's parameters, the score writer and the post-processing options.
+## it imports nothing heavy, so the API process can validate requests and
+## build result cache keys without loading the engine stack
+
+## basic-pitch settings tuned for violin
+PREDICT_PARAMS = {
+    "onset_threshold": 0.7,
+    "frame_threshold": 0.5,
+    ## 196 HZ is lowest note on violin
+    "minimum_frequency": 196,
+    ## 3520 HZ is highest note on violin
+    "maximum_frequency": 3520,
+    "melodia_trick": True,
+    ## basic-pitch's default, in milliseconds
+    "minimum_note_length": 127.70,
+}
+
+## music21 builds the score from a MIDI file, direct writes MusicXML from the
+## note events itself (engine/score.py), which is much faster on dense transcriptions
+SCORE_WRITER_ENV = "SCORE_WRITER"
+SCORE_WRITER_MUSIC21 = "music21"
+SCORE_WRITER_DIRECT = "direct"
+score_writer = os.getenv(SCORE_WRITER_ENV, SCORE_WRITER_MUSIC21)
+
+## numpy estimates the key from the note events (engine/key.py), music21 runs its
+## own analysis over the score, validate runs both, logs when they disagree and keeps music21's
+KEY_DETECTION_ENV = "KEY_DETECTION"
+KEY_DETECTION_NUMPY = "numpy"
+KEY_DETECTION_MUSIC21 = "music21"
+KEY_DETECTION_VALIDATE = "validate"
+key_detection = os.getenv(KEY_DETECTION_ENV, KEY_DETECTION_NUMPY)
+
+## only run inference on the parts of a recording with energy in the violin range,
+## skipping silences, intros and outros (engine/activity.py)
+SKIP_SILENCE_ENV = "ENGINE_SKIP_SILENCE"
+skip_silence = os.getenv(SKIP_SILENCE_ENV, "1").lower() in ("1", "true", "yes")
+
+## beat_track runs librosa's beat tracker over the whole recording and keeps its tempo,
+## excerpts reads the tempo off a few excerpts instead, so its cost doesn't grow
+## with the recording's length (engine/tempo.py)
+TEMPO_ESTIMATOR_ENV = "ENGINE_TEMPO_ESTIMATOR"
+TEMPO_ESTIMATOR_BEAT_TRACK = "beat_track"
+TEMPO_ESTIMATOR_EXCERPTS = "excerpts"
+tempo_estimator = os.getenv(TEMPO_ESTIMATOR_ENV, TEMPO_ESTIMATOR_EXCERPTS)
+
+## settings that change every score, for the result cache keys
+SCORE_PARAMS = {
+    "key_detection": key_detection,
+    "key_profile": key_profile,
+    "skip_silence": skip_silence,
+    "tempo_estimator": tempo_estimator,
+}
+
+STAGE_RANGE = "range"
+STAGE_QUANTIZE = "quantize"
+STAGE_METADATA = "metadata"
+STAGE_KEY = "key"
+STAGE_INSTRUMENT = "instrument"
+## post-processing stages in the order they run, engine/postprocess.py has what each one does
+STAGE_NAMES = [STAGE_RANGE, STAGE_QUANTIZE, STAGE_METADATA, STAGE_KEY, STAGE_INSTRUMENT]
+
+## full runs every stage with the configured writer
+## preview skips what the direct writer doesn't need, it quantizes on its own
+## and music21 key detection would build the music21 score it is meant to avoid
+PROFILE_FULL = "full"
+PROFILE_PREVIEW = "preview"
+PROFILES = {
+    PROFILE_FULL: (None, ()),
+    PROFILE_PREVIEW: (SCORE_WRITER_DIRECT, (STAGE_QUANTIZE, STAGE_KEY)),
+}
+
+
+class ScoreOptions:
+    """
+    Which writer makes the score and which stages are skipped.
+    Sent to the worker with the job, so it must stay picklable.
+    """
+
+    def __init__(self, writer: str = None, skip=()):
+        self.writer = writer or score_writer
+        self.skip = tuple(sorted(set(skip)))
+
+    ## options for a request's profile plus any extra stages it asked to skip,
+    ## given as a comma separated list. Raises ValueError if either is unknown
+    def FromRequest(profile: str = PROFILE_FULL, skip: str = ""):
+        if profile not in PROFILES:
+            raise ValueError(f"profile must be one of: {', '.join(PROFILES)}")
+        writer, skipped = PROFILES[profile]
+        extra = [name.strip() for name in skip.split(",") if name.strip()]
+        unknown = [name for name in extra if name not in STAGE_NAMES]
+        if unknown:
+            raise ValueError(
+                f"unknown stages {', '.join(unknown)}, "
+                f"stages are: {', '.join(STAGE_NAMES)}"
+            )
+        return ScoreOptions(writer, skipped + tuple(extra))
+
+    def ToDict(self) -> dict:
+        return {"score_writer": self.writer, "skip": list(self.skip)}
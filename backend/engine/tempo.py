@@ -0,0 +1,126 @@
+import logger, librosa
+import numpy as np
+from basic_pitch.constants import AUDIO_SAMPLE_RATE
+from engine.audio import tempo_view, TEMPO_SAMPLE_RATE
+from engine.settings import tempo_estimator, TEMPO_ESTIMATOR_EXCERPTS
+
+## tempo.py estimates a recording's tempo in BPM from its onset strength envelope
+## either over the whole recording with librosa's beat tracker,
+## or from a few excerpts so the cost stays the same however long the recording is
+
+log = logger.get()
+
+DEFAULT_TEMPO = 120
+HOP_LENGTH = 256
+## seconds of onsets each tempogram frame looks at, librosa's default
+AC_SIZE = 8.0
+
+## the excerpts estimator reads this many excerpts of this many seconds,
+## centered at even steps through the recording so intros and outros are left out
+EXCERPTS = 3
+EXCERPT_SECONDS = 20
+
+
+# Returns [(start sample, end sample)] the configured estimator reads,
+# or None for the whole recording
+def tempo_ranges(length: int):
+    if tempo_estimator != TEMPO_ESTIMATOR_EXCERPTS:
+        return None
+    return excerpt_ranges(length)
+
+
+# Returns [(start sample, end sample)] of the excerpts of a recording of length samples,
+# or None if it is short enough to read whole
+def excerpt_ranges(length: int):
+    size = EXCERPT_SECONDS * AUDIO_SAMPLE_RATE
+    if length <= EXCERPTS * size:
+        return None
+    centers = [length * (i + 1) // (EXCERPTS + 1) for i in range(EXCERPTS)]
+    return [(center - size // 2, center + size // 2) for center in centers]
+
+
+# Returns the onset envelopes of the parts of a block of audio that are in ranges,
+# offset is where the block starts in the recording
+def block_envelopes(block: np.ndarray, offset: int, ranges) -> list:
+    if ranges is None:
+        return [onset_envelope(block)]
+    envelopes = []
+    for start, end in ranges:
+        start = max(start - offset, 0)
+        end = min(end - offset, block.shape[0])
+        if end - start >= HOP_LENGTH * 2:
+            envelopes.append(onset_envelope(block[start:end]))
+    return envelopes
+
+
+# Returns estimated BPM of decoded audio
+def extract_audio_tempo(audio: np.ndarray) -> int:
+    try:
+        envelopes = block_envelopes(audio, 0, tempo_ranges(audio.shape[0]))
+    except Exception as e:
+        log.error(f"Error extracting tempo from audio: {e}")
+        # Fallback to default tempo
+        return DEFAULT_TEMPO
+    return tempo_from_envelopes(envelopes)
+
+
+# Returns the onset strength envelope used for tempo detection
+def onset_envelope(audio: np.ndarray) -> np.ndarray:
+    ## half the FFT size and hop at half the sample rate keeps the same
+    ## time resolution as librosa's defaults at full rate, for half the work
+    return librosa.onset.onset_strength(
+        y=tempo_view(audio), sr=TEMPO_SAMPLE_RATE, n_fft=1024, hop_length=HOP_LENGTH
+    )
+
+
+# Returns estimated BPM from the onset envelopes block_envelopes collected
+def tempo_from_envelopes(envelopes: list) -> int:
+    if tempo_estimator == TEMPO_ESTIMATOR_EXCERPTS:
+        return tempo_from_excerpts(envelopes)
+    return tempo_from_envelope(np.concatenate(envelopes))
+
+
+# Returns estimated BPM from an onset envelope
+def tempo_from_envelope(envelope: np.ndarray) -> int:
+    try:
+        # Extract tempo using librosa's tempo detection
+        tempo, _ = librosa.beat.beat_track(
+            onset_envelope=envelope, sr=TEMPO_SAMPLE_RATE, hop_length=HOP_LENGTH
+        )
+        # Convert numpy float to Python float, then to int
+        detected_tempo = int(float(tempo))
+        return detected_tempo
+    except Exception as e:
+        log.error(f"Error extracting tempo from audio: {e}")
+        # Fallback to default tempo
+        return DEFAULT_TEMPO
+
+
+# Returns estimated BPM from the onset envelopes of several excerpts
+## beat_track's tempo is the peak of the tempogram averaged over the whole recording,
+## this averages it over the excerpts instead and skips the beat tracking,
+## which only places the beats we never use
+def tempo_from_excerpts(envelopes: list) -> int:
+    try:
+        win_length = int(
+            librosa.time_to_frames(AC_SIZE, sr=TEMPO_SAMPLE_RATE, hop_length=HOP_LENGTH)
+        )
+        tempogram = np.concatenate(
+            [
+                librosa.feature.tempogram(
+                    onset_envelope=envelope,
+                    sr=TEMPO_SAMPLE_RATE,
+                    hop_length=HOP_LENGTH,
+                    win_length=win_length,
+                )
+                for envelope in envelopes
+            ],
+            axis=1,
+        )
+        tempo = librosa.feature.tempo(
+            tg=tempogram, sr=TEMPO_SAMPLE_RATE, hop_length=HOP_LENGTH, ac_size=AC_SIZE
+        )
+        return int(float(tempo[0]))
+    except Exception as e:
+        log.error(f"Error extracting tempo from audio: {e}")
+        return DEFAULT_TEMPO
@@ -0,0 +1,199 @@
+import logger
+from basic_pitch.constants import AUDIO_SAMPLE_RATE
+from engine.audio import load_audio, stream_audio
+from engine.duration import probe_duration, too_long_error, AudioTooLongError, MAX_DURATION
+from engine.inference import (
+    predict_audio,
+    predict_stream,
+    predict_batched,
+    note_events_to_midi,
+    midi_to_bytes,
+)
+from engine.jobs import (
+    report_stage,
+    report_ready,
+    report_result,
+    report_failure,
+    timed_stage,
+    set_progress_queue,
+    STAGE_DECODE,
+    STAGE_TEMPO,
+    STAGE_INFERENCE,
+    STAGE_MUSICXML,
+)
+from engine.pool import WorkerCount
+from engine.postprocess import BuildScore
+from engine.runtime import LoadModel, WarmUp, ThreadsPerWorker
+from engine.settings import ScoreOptions
+from engine.tempo import (
+    extract_audio_tempo,
+    tempo_ranges,
+    block_envelopes,
+    tempo_from_envelopes,
+)
+from util import GetIntEnv
+
+## worker.py is the part of the engine that runs inside the worker processes:
+## decoding, tempo detection, inference and writing the score
+## only the workers import it, the API process never loads librosa, basic-pitch or music21
+
+log = logger.get()
+
+## basic-pitch model, loaded once per worker process by init_worker
+MODEL = None
+
+## recordings longer than this many seconds are decoded and transcribed in chunks,
+## so memory stays flat no matter how long they are
+STREAM_THRESHOLD_ENV = "ENGINE_STREAM_THRESHOLD"
+CHUNK_SECONDS_ENV = "ENGINE_CHUNK_SECONDS"
+stream_threshold = GetIntEnv(STREAM_THRESHOLD_ENV, 120)
+chunk_seconds = GetIntEnv(CHUNK_SECONDS_ENV, 30)
+
+
+## runs once in every worker process when the pool starts it
+## workers is the size of the pool, the model's threads are shared out between them
+def init_worker(queue=None, workers: int = None):
+    if queue is not None:
+        set_progress_queue(queue)
+    load_model(ThreadsPerWorker(workers or WorkerCount()))
+
+
+## loads the model and runs it once, so the first job doesn't wait on either
+def load_model(threads: int = None):
+    global MODEL
+    with timed_stage("model_load"):
+        MODEL = LoadModel(threads or ThreadsPerWorker(WorkerCount()))
+    with timed_stage("model_warmup"):
+        WarmUp(MODEL)
+    report_ready()
+
+
+## returns the worker's model, loading it if this process hasn't yet
+def get_model():
+    if MODEL is None:
+        load_model()
+    return MODEL
+
+
+# Runs in a worker process, returns the musicXML string and MIDI bytes for an audio file
+## the MIDI and musicXML only ever live in memory, the audio file is the one thing on disk
+def transcribe_file(file_path: str, title: str, options: ScoreOptions = None) -> (str, bytes):
+    ## step 1: audio to MIDI
+    midi_data, note_events, tempo = create_midi(file_path)
+    midi_bytes = midi_to_bytes(midi_data)
+    ## step 2: note events to musicXML, through the post-processing stages
+    report_stage(STAGE_MUSICXML)
+    log.info(f"attempting to convert MIDI to musicXML")
+    mxml_string = BuildScore(title, note_events, tempo, options)
+    return mxml_string, midi_bytes
+
+
+# Runs in a worker process, transcribes a batch of (file path, title, job ID) items
+# returns the (musicXML string, MIDI bytes) of each, None where one failed,
+# and {index: (message, HTTP status)} for the ones that failed
+## the short recordings share model calls, every item is reported to its job
+## as soon as it is done rather than when the whole batch is
+def transcribe_batch(items: list, options: ScoreOptions = None) -> (list, dict):
+    results = [None] * len(items)
+    failures = {}
+    tempos = {}
+
+    def finish(index: int, result: tuple):
+        results[index] = result
+        report_result(items[index][2], result)
+
+    def fail(index: int, err: Exception):
+        file_path, title, job_id = items[index]
+        log.error(f"batch item {title} failed: {err}")
+        if isinstance(err, AudioTooLongError):
+            failures[index] = (str(err), 400)
+        else:
+            failures[index] = ("failed to generate sheet music", 500)
+        report_failure(job_id, *failures[index])
+
+    ## long recordings stream through the single file path, they would hold up the batch
+    short = []
+    for index, (file_path, title, _) in enumerate(items):
+        duration = probe_duration(file_path)
+        if duration is None or duration <= stream_threshold:
+            short.append(index)
+            continue
+        try:
+            finish(index, transcribe_file(file_path, title, options))
+        except Exception as e:
+            fail(index, e)
+
+    ## decoded one at a time, as the batch needs more windows
+    def recordings():
+        for index in short:
+            file_path = items[index][0]
+            try:
+                with timed_stage("decode"):
+                    audio = load_audio(file_path)
+                if audio.shape[0] > MAX_DURATION * AUDIO_SAMPLE_RATE:
+                    raise too_long_error()
+                with timed_stage("tempo"):
+                    tempos[index] = extract_audio_tempo(audio)
+            except Exception as e:
+                fail(index, e)
+                continue
+            yield index, audio
+
+    report_stage(STAGE_INFERENCE)
+    for index, note_events in predict_batched(recordings(), get_model()):
+        title = items[index][1]
+        try:
+            midi_bytes = midi_to_bytes(note_events_to_midi(note_events, tempos[index]))
+            finish(index, (BuildScore(title, note_events, tempos[index], options), midi_bytes))
+        except Exception as e:
+            fail(index, e)
+    return results, failures
+
+
+# Returns (PrettyMIDI object, note events, tempo) transcribed from the audio file
+def create_midi(file_path: str) -> tuple:
+    duration = probe_duration(file_path)
+    if duration is not None and duration > stream_threshold:
+        with timed_stage("streaming"):
+            return create_midi_streaming(file_path, duration)
+    else:
+        ## decode once, tempo detection and inference both use this array
+        report_stage(STAGE_DECODE)
+        with timed_stage("decode"):
+            audio = load_audio(file_path)
+        if audio.shape[0] > MAX_DURATION * AUDIO_SAMPLE_RATE:
+            raise too_long_error()
+        # Extract tempo from audio
+        log.info("attempting to extract tempo")
+        report_stage(STAGE_TEMPO)
+        with timed_stage("tempo"):
+            detected_tempo = extract_audio_tempo(audio)
+        log.info(f"DETECTED TEMPO: {detected_tempo} BPM")
+        report_stage(STAGE_INFERENCE)
+        with timed_stage("inference"):
+            midi_data, note_events = predict_audio(audio, get_model(), detected_tempo)
+    return midi_data, note_events, detected_tempo
+
+
+# Same as create_midi, transcribing the file one chunk at a time
+# duration is the probed length in seconds, it places the tempo excerpts
+def create_midi_streaming(file_path: str, duration: float):
+    log.info(f"transcribing {file_path} in {chunk_seconds}s chunks")
+    ## decoding, tempo and inference are interleaved chunk by chunk here
+    report_stage(STAGE_INFERENCE)
+    ## tempo needs the whole recording (or its excerpts), but onset envelopes are tiny,
+    ## so collect them per chunk and estimate the tempo at the end
+    envelopes = []
+    ranges = tempo_ranges(int(duration * AUDIO_SAMPLE_RATE))
+
+    def blocks():
+        offset = 0
+        for block in stream_audio(file_path, chunk_seconds):
+            envelopes.extend(block_envelopes(block, offset, ranges))
+            offset += block.shape[0]
+            yield block
+
+    note_events = predict_stream(blocks(), get_model())
+    detected_tempo = tempo_from_envelopes(envelopes)
+    log.info(f"DETECTED TEMPO: {detected_tempo} BPM")
+    return note_events_to_midi(note_events, detected_tempo), note_events, detected_tempo
@@ -0,0 +1,51 @@
+import re
+from urllib.parse import urlparse, parse_qs
+
+## youtube.py normalizes the many shapes of YouTube links to a single video ID
+
+## YouTube video IDs are always 11 URL-safe base64 characters
+VIDEO_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{11}$")
+
+YOUTUBE_HOSTS = {
+    "youtube.com",
+    "www.youtube.com",
+    "m.youtube.com",
+    "music.youtube.com",
+    "youtube-nocookie.com",
+    "www.youtube-nocookie.com",
+}
+SHORT_HOSTS = {"youtu.be", "www.youtu.be"}
+## path prefixes that are followed directly by the video ID
+ID_PATH_PREFIXES = ("shorts", "embed", "live", "v", "e")
+
+
+# Returns the 11 character video ID of a YouTube link, or None if it isn't one
+def canonical_video_id(url: str):
+    url = url.strip()
+    ## people often paste links without the scheme
+    if "://" not in url:
+        url = "https://" + url
+    parsed = urlparse(url)
+    host = (parsed.hostname or "").lower()
+    segments = [segment for segment in parsed.path.split("/") if segment]
+
+    video_id = None
+    if host in SHORT_HOSTS and segments:
+        ## https://youtu.be/<id>?si=...
+        video_id = segments[0]
+    elif host in YOUTUBE_HOSTS:
+        if segments and segments[0] == "watch":
+            ## https://www.youtube.com/watch?v=<id>&list=...&t=42s
+            video_id = parse_qs(parsed.query).get("v", [None])[0]
+        elif len(segments) >= 2 and segments[0] in ID_PATH_PREFIXES:
+            ## https://www.youtube.com/shorts/<id>
+            video_id = segments[1]
+
+    if video_id and VIDEO_ID_PATTERN.match(video_id):
+        return video_id
+    return None
+
+
+# Returns the canonical watch URL for a video ID
+def canonical_url(video_id: str) -> str:
+    return f"https://www.youtube.com/watch?v={video_id}"
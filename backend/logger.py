@@ -5,9 +5,15 @@ import logging, os, sys
 def get() -> logging.Logger:
     log_level = os.getenv("LOG_LEVEL", "INFO")
     logger = logging.getLogger()
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-    logger.addHandler(handler)
+    ## every module calls get(), only the first call adds the handler
+    ## otherwise each record is formatted and written once per module
+    if not any(getattr(h, "string_scribe", False) for h in logger.handlers):
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+        )
+        handler.string_scribe = True
+        logger.addHandler(handler)
     try:
         logger.setLevel(log_level)
     except:
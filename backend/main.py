@@ -1,16 +1,39 @@
-import json, logger, uvicorn, base64, os, stripe
+import json, logger, uvicorn, base64, os, secrets, stripe, zlib
 from fastapi import FastAPI, UploadFile, HTTPException, Request, Response
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import Form
 from engine.engine import MusicEngine
+from engine.settings import ScoreOptions, PROFILE_FULL
+from engine.pool import PoolSaturatedError, JobTimeoutError
+from engine.duration import AudioTooLongError
+from engine.jobs import job_store, Job, STATUS_DONE, STATUS_FAILED
+from engine.ingest import (
+    MAX_UPLOAD_BYTES,
+    BATCH_MAX_BYTES,
+    UploadTooLargeError,
+    UnsupportedAudioError,
+)
+from engine.scratch import ScratchQuotaError, ScratchFullError
 from util import MustGetEnv
 import client.client as client
+from client.role_queue import (
+    EnqueueRoleChange,
+    StartConsumer,
+    StopConsumer,
+    ACTION_ADD,
+    ACTION_REMOVE,
+)
+import metrics
 from middleware.rate_limit import (
     get_or_create_session_id,
-    check_rate_limit,
-    increment_usage,
+    consume_usage,
+    refund_usage,
+    RateLimitUnavailableError,
+    redact_session,
 )
+from middleware.upload_limit import UploadLimitMiddleware
+from middleware.metrics import RequestMetricsMiddleware
 
 from dotenv import load_dotenv
 
@@ -25,6 +48,7 @@ STRIPE_WEBHOOK_SK_ENV = "STRIPE_WEBHOOK_SK"
 STRIPE_PRICE_ID_ENV = "STRIPE_PRICE_ID"
 FRONTEND_HOST_ENV = "FRONTEND_HOST"
 PROD_FLAG_ENV = "PROD"
+METRICS_TOKEN_ENV = "METRICS_TOKEN"
 
 stripe.api_key = MustGetEnv(STRIPE_SK_ENV)
 webhook_sk = MustGetEnv(STRIPE_WEBHOOK_SK_ENV)
@@ -34,9 +58,38 @@ prod = MustGetEnv(PROD_FLAG_ENV)
 
 prod_flag = bool(prod)
 
+## when set, /metrics requires "Authorization: Bearer <token>"
+metrics_token = os.getenv(METRICS_TOKEN_ENV, "")
+
+## seconds between keep-alive comments on idle job event streams
+SSE_KEEPALIVE_SECONDS = 15
+
+## how transcription results are returned
+## json: MusicXML and base64 MIDI inline in one JSON document (the original format)
+## artifacts: links to separately downloadable MusicXML and MIDI files
+## multipart: a multipart/mixed body with the MusicXML and the raw MIDI bytes
+FORMAT_JSON = "json"
+FORMAT_ARTIFACTS = "artifacts"
+FORMAT_MULTIPART = "multipart"
+RESPONSE_FORMATS = (FORMAT_JSON, FORMAT_ARTIFACTS, FORMAT_MULTIPART)
+
+MUSICXML_MEDIA_TYPE = "application/vnd.recordare.musicxml+xml"
+MIDI_MEDIA_TYPE = "audio/midi"
+## size of each piece of a streamed MusicXML download
+STREAM_CHUNK_BYTES = 64 * 1024
+
 
 app = FastAPI()
 
+## reject oversized uploads before their body is parsed
+## added before CORS so the 413 still carries CORS headers
+## batches carry several files, so they get a larger limit of their own
+app.add_middleware(
+    UploadLimitMiddleware,
+    max_bytes=MAX_UPLOAD_BYTES,
+    path_limits={"/api/v1/jobs/batch": BATCH_MAX_BYTES},
+)
+
 ## allowed CORS web origins
 origins = [frontend_host]
 
@@ -49,11 +102,46 @@ app.add_middleware(
     expose_headers=["set-cookie"],  ## expose set-cookie header
 )
 
+## added last so it is outermost, and rejected and CORS preflight requests are measured too
+app.add_middleware(RequestMetricsMiddleware)
+
 
-## initialize Auth0 client
+## initialize Auth0 client, start applying queued subscription changes
+## and start the transcription workers
 @app.on_event("startup")
 async def startup_event():
     client.InitClient()
+    StartConsumer()
+    MusicEngine.Start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await StopConsumer()
+    MusicEngine.Shutdown()
+
+
+## response for when every transcription worker is busy and the queue is full
+def engine_busy_response(err: PoolSaturatedError) -> JSONResponse:
+    log.warning(f"rejecting transcription: {err}")
+    return JSONResponse(
+        status_code=503,
+        headers={"Retry-After": str(err.retry_after)},
+        content={
+            "detail": "The server is busy transcribing other files. Please try again shortly.",
+            "queue_depth": err.queue_depth,
+            "retry_after": err.retry_after,
+        },
+    )
+
+
+## response for when a transcription took longer than the job timeout
+def engine_timeout_response() -> JSONResponse:
+    log.error("transcription job timed out")
+    return JSONResponse(
+        status_code=504,
+        content={"detail": "Transcription took too long. Please try a shorter file."},
+    )
 
 
 ## https://docs.stripe.com/api/checkout/sessions/object
@@ -92,6 +180,8 @@ async def createCheckoutSession(id: str = Form(...)):
 ## we currently only look for two events:
 ## 1: invoice.payment_succeeded for when a user creates a subscription
 ## 2: customer.subscription.deleted for when a user deletes a subscription
+## the role change is queued and applied to Auth0 in the background (client/role_queue.py),
+## so Stripe gets its answer without waiting on Auth0
 ## https://docs.stripe.com/webhooks/quickstart
 @app.post("/api/v1/process-subscription")
 async def processSubscription(request: Request):
@@ -122,9 +212,7 @@ async def processSubscription(request: Request):
             return JSONResponse({"success": False}, 400)
         log.info(f"Creating subscription for user: {user_id}")
         ## add the Pro role to the user in Auth0
-        try:
-            client.AddProRole(user_id)
-        except:
+        if not await queue_role_change(event, user_id, ACTION_ADD):
             return JSONResponse({"success": False}, 500)
     ## Handle the subscription deleted event
     elif event and event["type"] == "customer.subscription.deleted":
@@ -136,9 +224,7 @@ async def processSubscription(request: Request):
             return JSONResponse({"success": False}, 400)
         log.info(f"Deleting subscription for user: {user_id}")
         ## remove Pro role in Auth0
-        try:
-            client.RemoveProRole(user_id)
-        except:
+        if not await queue_role_change(event, user_id, ACTION_REMOVE):
             return JSONResponse({"success": False}, 500)
     else:
         # Unexpected event type
@@ -146,26 +232,34 @@ async def processSubscription(request: Request):
     return JSONResponse({"success": True}, 200)
 
 
-## endpoint for transcribing a music file
-@app.post("/api/v1/upload")
-async def uploadFile(
-    request: Request,
-    response: Response,
-    file: UploadFile = Form(...),
-    user_id: str = Form(...),
-):
-    ## determine whether or not the user has pro subscription
-    has_pro = False
-    ## if they are not signed in, user ID will be empty string
-    if user_id != "":
-        try:
-            has_pro = client.HasProRole(user_id)
-        except Exception as e:
-            log.error(f"Error checking user role: {e}")
-            raise HTTPException(
-                status_code=500, detail="Failed to verify subscription status"
-            )
+## queues the role change of a webhook event, returns False if it couldn't be stored
+## so Stripe sends the event again, events that were already queued count as stored
+async def queue_role_change(event, user_id: str, action: str) -> bool:
+    try:
+        if not await EnqueueRoleChange(event["id"], user_id, action, event.get("created", 0)):
+            log.info(f"event {event['id']} was already queued")
+        return True
+    except Exception as e:
+        log.error(f"could not queue role change for event {event.get('id')}: {e}")
+        return False
+
 
+## determine whether or not the user has pro subscription
+## if they are not signed in, user ID will be empty string
+async def resolve_pro(user_id: str) -> bool:
+    if user_id == "":
+        return False
+    try:
+        return await client.HasProRoleAsync(user_id)
+    except Exception as e:
+        log.error(f"Error checking user role: {e}")
+        raise HTTPException(
+            status_code=500, detail="Failed to verify subscription status"
+        )
+
+
+## sets the anonymous session cookie used for rate limiting
+def set_session_cookie(response: Response, session_id: str):
     ## determine whether or not we are on localhost or not
     ## true for prod (https), false for localhost (http)
     secure = prod_flag
@@ -173,36 +267,43 @@ async def uploadFile(
     ## none = for fly.io deployment, because it is across multiple domains
     ## lax = for local development, because it works with http (localhost)
     same_site = "none" if prod_flag else "lax"
+    response.set_cookie(
+        key="session_id",
+        value=session_id,
+        max_age=24 * 60 * 60,  # 24 hours
+        httponly=True,
+        samesite=same_site,
+        secure=secure,  # Allow on localhost HTTP
+    )
 
-    if not has_pro:
-        # Get or create session ID
-        session_id = get_or_create_session_id(request)
 
-        # Check rate limit
-        is_allowed, remaining, reset_time = check_rate_limit(session_id)
+## response for when a free user has used up their transcriptions
+def rate_limited_response(session_id: str, reset_time: int) -> JSONResponse:
+    log.info(f"rate limit exceeded for session {redact_session(session_id)}")
+    response = JSONResponse(
+        status_code=429,  ## means too many request
+        content={
+            "detail": "Translation limit reached. Please subscribe for unlimited access.",
+            "remaining": 0,
+            "reset_time": reset_time,
+        },
+    )
+    set_session_cookie(response, session_id)
+    return response
 
-        if not is_allowed:
-            log.warning(f"Rate limit exceeded for session {session_id}")
-            response.set_cookie(
-                key="session_id",
-                value=session_id,
-                max_age=24 * 60 * 60,
-                httponly=True,
-                samesite=same_site,
-                secure=secure,  # Allow on localhost HTTP
-            )
-            log.info(f"[COOKIE] Setting cookie on 429 response: {session_id}")
-            return JSONResponse(
-                status_code=429,  ## means too many request
-                content={
-                    "detail": "Translation limit reached. Please subscribe for unlimited access.",
-                    "remaining": 0,
-                    "reset_time": reset_time,
-                },
-            )
-    else:
-        log.info("User has the pro role, will skip rate limiting")
 
+## response for when the free tier usage store couldn't be checked
+def rate_limit_unavailable_response(err: RateLimitUnavailableError) -> JSONResponse:
+    log.error(f"rate limit check failed: {err}")
+    return JSONResponse(
+        status_code=503,
+        headers={"Retry-After": str(err.retry_after)},
+        content={"detail": "The server is busy. Please try again shortly."},
+    )
+
+
+## raises a 400 if the upload isn't an acceptable audio file
+def validate_audio_upload(file: UploadFile):
     # Validate file exists
     if not file:
         raise HTTPException(status_code=400, detail="No file uploaded")
@@ -211,63 +312,239 @@ async def uploadFile(
     if not file.content_type or not file.content_type.startswith("audio/"):
         raise HTTPException(status_code=400, detail="File must be an audio file")
 
-    # Validate file size (max 50MB)
-    max_size = 50 * 1024 * 1024
-    if file.size and file.size > max_size:
-        raise HTTPException(status_code=400, detail="File size must be less than 50MB")
+    # Validate file size when the client sent it, the upload is also
+    # checked while it streams to disk since this isn't always set
+    if file.size and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File size must be less than {MAX_UPLOAD_BYTES // (1024 * 1024)}MB",
+        )
 
     # Validate filename
     if not file.filename:
         raise HTTPException(status_code=400, detail="Invalid filename")
 
-    ## get music XML (for creating rendering sheet music) and MIDI (for playing audio)
-    mxml, midi = await MusicEngine.ProcessMusic(file)
-    ## base64 encode MIDI
-    midi_b64 = base64.b64encode(midi).decode("utf-8")
 
-    if not has_pro:
-        # Increment usage count
-        increment_usage(session_id)
+## errors from saving an upload that upload_error turns into a response
+UPLOAD_ERRORS = (
+    UploadTooLargeError,
+    UnsupportedAudioError,
+    ScratchQuotaError,
+    ScratchFullError,
+)
 
-        # Get updated remaining count
-        _, remaining, reset_time = check_rate_limit(session_id)
 
-        # Set session cookie using Response parameter
-        response.set_cookie(
-            key="session_id",
-            value=session_id,
-            max_age=24 * 60 * 60,  # 24 hours
-            httponly=True,
-            samesite=same_site,
-            secure=secure,  # Allow on localhost HTTP
+## HTTP error for an upload that couldn't be saved
+def upload_error(err: Exception) -> HTTPException:
+    if isinstance(err, (UploadTooLargeError, ScratchQuotaError)):
+        return HTTPException(status_code=413, detail=str(err))
+    if isinstance(err, ScratchFullError):
+        log.warning(f"rejecting upload: {err}")
+        return HTTPException(
+            status_code=503,
+            detail="The server is out of space for uploads. Please try again shortly.",
+            headers={"Retry-After": str(err.retry_after)},
+        )
+    return HTTPException(status_code=400, detail=f"Invalid file: {err}")
+
+
+## HTTP status reported for a failed transcription
+def engine_error_status(err: Exception) -> int:
+    if isinstance(err, (PoolSaturatedError, ScratchFullError)):
+        return 503
+    if isinstance(err, JobTimeoutError):
+        return 504
+    if isinstance(err, AudioTooLongError):
+        return 400
+    if isinstance(err, ScratchQuotaError):
+        return 413
+    return 500
+
+
+## raises a 400 if the requested response format is unknown
+def validate_response_format(response_format: str):
+    if response_format not in RESPONSE_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"format must be one of: {', '.join(RESPONSE_FORMATS)}",
         )
 
-        log.info(f"[COOKIE] Setting cookie on success response: {session_id}")
 
-    # Return JSON response
+## score post-processing options for a request's profile and skipped stages
+def score_options(profile: str, skip: str) -> ScoreOptions:
+    try:
+        return ScoreOptions.FromRequest(profile, skip)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+## download links for a finished job's artifacts
+def artifact_links(job: Job) -> dict:
+    return {
+        "mxml_url": f"/api/v1/jobs/{job.id}/musicxml",
+        "midi_url": f"/api/v1/jobs/{job.id}/midi",
+    }
+
+
+## multipart/mixed body with the MusicXML part followed by the MIDI part
+def multipart_response(mxml: str, midi: bytes) -> Response:
+    boundary = secrets.token_hex(16)
+    parts = [
+        (MUSICXML_MEDIA_TYPE + "; charset=utf-8", "score.musicxml", mxml.encode("utf-8")),
+        (MIDI_MEDIA_TYPE, "score.mid", midi),
+    ]
+    body = bytearray()
+    for media_type, filename, data in parts:
+        body += (
+            f"--{boundary}\r\n"
+            f"Content-Type: {media_type}\r\n"
+            f'Content-Disposition: attachment; filename="{filename}"\r\n'
+            f"Content-Length: {len(data)}\r\n\r\n"
+        ).encode("ascii")
+        body += data
+        body += b"\r\n"
+    body += f"--{boundary}--\r\n".encode("ascii")
+    return Response(
+        content=bytes(body), media_type=f"multipart/mixed; boundary={boundary}"
+    )
+
+
+## returns the transcription in the requested format
+## artifacts are kept as a finished job so they can be downloaded afterwards
+def transcription_response(
+    mxml: str, midi: bytes, response_format: str, kind: str
+) -> Response | dict:
+    if response_format == FORMAT_MULTIPART:
+        return multipart_response(mxml, midi)
+    if response_format == FORMAT_ARTIFACTS:
+        job = job_store.Create(kind)
+        job.Finish((mxml, midi))
+        return {"job_id": job.id, **artifact_links(job)}
     return {
         "mxml": mxml,
-        "midi": midi_b64,
+        "midi": base64.b64encode(midi).decode("utf-8"),
     }
 
 
+## true if the client accepts gzip encoded responses
+def accepts_gzip(request: Request) -> bool:
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        ## "gzip;q=0" means the client refuses it
+        return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+## yields the text in fixed size pieces, gzip compressed if requested
+def stream_text(text: str, compress: bool):
+    data = text.encode("utf-8")
+    ## wbits of 16 + MAX_WBITS writes a gzip header and trailer instead of raw zlib
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    for i in range(0, len(data), STREAM_CHUNK_BYTES):
+        chunk = data[i : i + STREAM_CHUNK_BYTES]
+        if compressor:
+            chunk = compressor.compress(chunk)
+            if not chunk:
+                continue
+        yield chunk
+    if compressor:
+        yield compressor.flush()
+
+
+## returns the finished job's result, or raises if there isn't one yet
+def finished_job_result(job_id: str) -> tuple:
+    job = job_store.Get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.result is None:
+        raise HTTPException(status_code=409, detail="Job has not finished yet")
+    return job.result
+
+
+## endpoint for transcribing a music file
+@app.post("/api/v1/upload")
+async def uploadFile(
+    request: Request,
+    response: Response,
+    file: UploadFile = Form(...),
+    user_id: str = Form(...),
+    response_format: str = Form(FORMAT_JSON),
+    profile: str = Form(PROFILE_FULL),
+    skip: str = Form(""),
+):
+    validate_response_format(response_format)
+    options = score_options(profile, skip)
+    has_pro = await resolve_pro(user_id)
+    session_id = None
+
+    if not has_pro:
+        # Get or create session ID
+        session_id = get_or_create_session_id(request)
+
+        # Check the rate limit and use up a translation in one step,
+        # it is given back below if the transcription fails
+        try:
+            is_allowed, remaining, reset_time = await consume_usage(session_id)
+        except RateLimitUnavailableError as e:
+            return rate_limit_unavailable_response(e)
+
+        if not is_allowed:
+            return rate_limited_response(session_id, reset_time)
+    else:
+        log.info("User has the pro role, will skip rate limiting")
+
+    transcribed = False
+    try:
+        validate_audio_upload(file)
+
+        ## get music XML (for creating rendering sheet music) and MIDI (for playing audio)
+        try:
+            mxml, midi = await MusicEngine.ProcessMusic(file, options)
+        except PoolSaturatedError as e:
+            return engine_busy_response(e)
+        except JobTimeoutError:
+            return engine_timeout_response()
+        except AudioTooLongError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid file: {e}")
+        except UPLOAD_ERRORS as e:
+            raise upload_error(e)
+        transcribed = True
+    finally:
+        ## free translations only count once they succeed
+        if session_id and not transcribed:
+            await refund_usage(session_id)
+
+    if not has_pro:
+        # Set session cookie using Response parameter
+        set_session_cookie(response, session_id)
+
+    result = transcription_response(mxml, midi, response_format, "upload")
+    if isinstance(result, Response) and not has_pro:
+        ## a returned Response doesn't pick up cookies set on the injected one
+        set_session_cookie(result, session_id)
+    return result
+
+
 # Endpoint for transcribing a YouTube video (Premium only)
 @app.post("/api/v1/upload-youtube")
 async def uploadYouTube(
-    request: Request, response: Response, url: str = Form(...), user_id: str = Form(...)
+    request: Request,
+    response: Response,
+    url: str = Form(...),
+    user_id: str = Form(...),
+    response_format: str = Form(FORMAT_JSON),
+    profile: str = Form(PROFILE_FULL),
+    skip: str = Form(""),
 ):
+    validate_response_format(response_format)
+    options = score_options(profile, skip)
     # Check if user has Pro role
-    try:
-        has_pro = client.HasProRole(user_id)
-        if not has_pro:
-            raise HTTPException(
-                status_code=403,
-                detail="YouTube transcription is only available for premium subscribers. Please upgrade your account.",
-            )
-    except Exception as e:
-        log.error(f"Error checking user role: {e}")
+    if not await resolve_pro(user_id):
         raise HTTPException(
-            status_code=500, detail="Failed to verify subscription status"
+            status_code=403,
+            detail="YouTube transcription is only available for premium subscribers. Please upgrade your account.",
         )
 
     # Validate URL
@@ -276,12 +553,16 @@ async def uploadYouTube(
 
     try:
         # Download YouTube audio and process it
-        mxml, midi = await MusicEngine.ProcessYouTube(url)
-        # Base64 encode MIDI
-        midi_b64 = base64.b64encode(midi).decode("utf-8")
-
-        # Return JSON response
-        return {"mxml": mxml, "midi": midi_b64}
+        mxml, midi = await MusicEngine.ProcessYouTube(url, options=options)
+        return transcription_response(mxml, midi, response_format, "youtube")
+    except PoolSaturatedError as e:
+        return engine_busy_response(e)
+    except JobTimeoutError:
+        return engine_timeout_response()
+    except AudioTooLongError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid video: {e}")
+    except (ScratchQuotaError, ScratchFullError) as e:
+        raise upload_error(e)
     except Exception as e:
         log.error(f"Error processing YouTube URL: {e}")
         raise HTTPException(
@@ -289,11 +570,240 @@ async def uploadYouTube(
         )
 
 
+## job API: submit returns a job ID right away, then clients poll
+## /api/v1/jobs/{job_id} or listen on /api/v1/jobs/{job_id}/events for progress
+
+
+## JSON body describing a job, with the result once it is done
+## the artifacts format links to the downloads instead of inlining them
+## batch jobs list each file's payload under items
+def job_payload(job: Job, response_format: str = FORMAT_JSON) -> dict:
+    payload = job.ToDict()
+    if job.items:
+        payload["items"] = [job_payload(item, response_format) for item in job.items]
+    if job.result is not None:
+        if response_format == FORMAT_ARTIFACTS:
+            payload.update(artifact_links(job))
+        else:
+            mxml, midi = job.result
+            payload["mxml"] = mxml
+            payload["midi"] = base64.b64encode(midi).decode("utf-8")
+    return payload
+
+
+## submits a music file for transcription and returns the job ID
+@app.post("/api/v1/jobs/upload", status_code=202)
+async def submitUploadJob(
+    request: Request,
+    response: Response,
+    file: UploadFile = Form(...),
+    user_id: str = Form(...),
+    profile: str = Form(PROFILE_FULL),
+    skip: str = Form(""),
+):
+    options = score_options(profile, skip)
+    has_pro = await resolve_pro(user_id)
+    session_id = None
+    if not has_pro:
+        session_id = get_or_create_session_id(request)
+        try:
+            is_allowed, _, reset_time = await consume_usage(session_id)
+        except RateLimitUnavailableError as e:
+            return rate_limit_unavailable_response(e)
+        if not is_allowed:
+            return rate_limited_response(session_id, reset_time)
+        set_session_cookie(response, session_id)
+
+    ## free transcriptions only count once they succeed
+    refund = (lambda: refund_usage(session_id)) if session_id else None
+    try:
+        validate_audio_upload(file)
+        ## the upload is closed once this request returns, so save it now
+        file_path, audio_hash = await MusicEngine.SaveUpload(file)
+    except Exception as e:
+        if refund:
+            await refund()
+        if isinstance(e, UPLOAD_ERRORS):
+            raise upload_error(e)
+        raise
+    job = job_store.Create("upload")
+    job_store.Run(
+        job,
+        MusicEngine.ProcessSaved(file_path, audio_hash, file.filename, job.id, options),
+        engine_error_status,
+        on_failure=refund,
+    )
+    return job.ToDict()
+
+
+## submits a YouTube video for transcription (Premium only) and returns the job ID
+@app.post("/api/v1/jobs/upload-youtube", status_code=202)
+async def submitYouTubeJob(
+    url: str = Form(...),
+    user_id: str = Form(...),
+    profile: str = Form(PROFILE_FULL),
+    skip: str = Form(""),
+):
+    options = score_options(profile, skip)
+    if not await resolve_pro(user_id):
+        raise HTTPException(
+            status_code=403,
+            detail="YouTube transcription is only available for premium subscribers. Please upgrade your account.",
+        )
+    if not url or url.strip() == "":
+        raise HTTPException(status_code=400, detail="No URL provided")
+
+    job = job_store.Create("youtube")
+    job_store.Run(
+        job, MusicEngine.ProcessYouTube(url, job.id, options), engine_error_status
+    )
+    return job.ToDict()
+
+
+## submits several music files, or zips of them, as one batch job (Premium only)
+## every file gets its own item job, which finishes as soon as its score is written,
+## poll the batch or listen on its events to collect them
+@app.post("/api/v1/jobs/batch", status_code=202)
+async def submitBatchJob(
+    files: list[UploadFile] = Form(...),
+    user_id: str = Form(...),
+    profile: str = Form(PROFILE_FULL),
+    skip: str = Form(""),
+):
+    options = score_options(profile, skip)
+    if not await resolve_pro(user_id):
+        raise HTTPException(
+            status_code=403,
+            detail="Batch transcription is only available for premium subscribers. Please upgrade your account.",
+        )
+    for file in files:
+        if not file.filename:
+            raise HTTPException(status_code=400, detail="Invalid filename")
+    try:
+        ## the uploads are closed once this request returns, so save them now
+        saved = await MusicEngine.SaveBatch(files)
+    except UPLOAD_ERRORS as e:
+        raise upload_error(e)
+
+    job = job_store.Create("batch")
+    for name, _, _ in saved:
+        job_store.Create("batch_item", name, parent=job)
+    job_store.Run(job, MusicEngine.ProcessBatch(job, saved, options), engine_error_status)
+    return job.ToDict()
+
+
+## reports a job's status, and its result once it is done
+@app.get("/api/v1/jobs/{job_id}")
+async def getJob(job_id: str, response_format: str = FORMAT_JSON):
+    validate_response_format(response_format)
+    job = job_store.Get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_payload(job, response_format)
+
+
+## downloads a finished job's MIDI file
+@app.get("/api/v1/jobs/{job_id}/midi")
+async def getJobMidi(job_id: str):
+    _, midi = finished_job_result(job_id)
+    return Response(
+        content=midi,
+        media_type=MIDI_MEDIA_TYPE,
+        headers={"Content-Disposition": 'attachment; filename="score.mid"'},
+    )
+
+
+## downloads a finished job's MusicXML, streamed and gzip compressed when accepted
+## MusicXML is very repetitive, so it usually shrinks by 90% or more
+@app.get("/api/v1/jobs/{job_id}/musicxml")
+async def getJobMusicXML(request: Request, job_id: str):
+    mxml, _ = finished_job_result(job_id)
+    compress = accepts_gzip(request)
+    headers = {
+        "Content-Disposition": 'attachment; filename="score.musicxml"',
+        "Vary": "Accept-Encoding",
+    }
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(
+        stream_text(mxml, compress),
+        media_type=MUSICXML_MEDIA_TYPE + "; charset=utf-8",
+        headers=headers,
+    )
+
+
+## server-sent events: a "status" event on every stage change,
+## then a final "result" or "failed" event
+## ("error" is reserved by the browser's EventSource for connection errors)
+## batch jobs also send an "item" event with each file's result as soon as it finishes
+## reconnecting clients immediately get the current state again
+@app.get("/api/v1/jobs/{job_id}/events")
+async def jobEvents(job_id: str, response_format: str = FORMAT_JSON):
+    validate_response_format(response_format)
+    job = job_store.Get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    def event(name: str, data: dict) -> str:
+        return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+    async def stream():
+        version = None
+        sent_items = set()
+        while True:
+            if job.version != version:
+                version = job.version
+                for item in job.items:
+                    if item.Finished() and item.id not in sent_items:
+                        sent_items.add(item.id)
+                        yield event("item", job_payload(item, response_format))
+                yield event("status", job.ToDict())
+                if job.status == STATUS_DONE:
+                    yield event("result", job_payload(job, response_format))
+                    return
+                if job.status == STATUS_FAILED:
+                    yield event(
+                        "failed", {"detail": job.error, "status": job.error_status}
+                    )
+                    return
+            else:
+                ## comment line keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+            await job.WaitForChange(version, SSE_KEEPALIVE_SECONDS)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+## readiness probe: 200 once a transcription worker has its model warmed up, 503 until then
+## the API itself answers as soon as it is up, workers start on the first job or ENGINE_PRELOAD
+@app.get("/ready")
+async def getReady():
+    status = MusicEngine.Ready()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+
+## Prometheus metrics: pipeline stage timings, request latency, worker queue,
+## caches, Auth0 calls and rate limiting
+@app.get("/metrics")
+async def getMetrics(request: Request):
+    if metrics_token and not secrets.compare_digest(
+        request.headers.get("authorization", ""), f"Bearer {metrics_token}"
+    ):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(
+        content=metrics.Render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8000,
         reload=False,
-        reload_excludes=["./engine/processing/"],
+        reload_excludes=["./processing/"],
     )
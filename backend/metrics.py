@@ -0,0 +1,197 @@
+import bisect, threading, time
+from contextlib import contextmanager
+
+## metrics.py keeps counters, gauges and histograms in memory
+## and renders them in the Prometheus text format for /metrics
+
+## seconds, from quick cache lookups up to the longest transcriptions
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+)
+
+## every metric registers itself here when it is created
+REGISTRY = []
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def Render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(Metric):
+    """Value that only goes up, e.g. requests served"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+
+    def Inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down. Pass fn to read the value when /metrics is
+    scraped instead of setting it, fn returns a number, or a list of
+    (labels dict, number) pairs when the gauge has labels.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), fn=None, kind=None):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+        self._fn = fn
+        ## callback gauges can mirror counters kept elsewhere
+        if kind:
+            self.kind = kind
+
+    def Set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _samples(self) -> list:
+        if self._fn is not None:
+            result = self._fn()
+            if not isinstance(result, list):
+                result = [({}, result)]
+            values = [(self._key(labels), value) for labels, value in result]
+        else:
+            with self._lock:
+                values = sorted(self._values.items())
+        return [
+            f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. how long each pipeline stage takes"""
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labelnames: tuple = (), buckets=DEFAULT_BUCKETS
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        ## label values -> [per bucket counts (plus +Inf), sum, count]
+        self._values = {}
+
+    def Observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[key] = series
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    ## observes how long the with block takes, if it finishes without raising
+    @contextmanager
+    def Time(self, **labels):
+        start = time.perf_counter()
+        yield
+        self.Observe(time.perf_counter() - start, **labels)
+
+    ## returns {label values: (sum, count)}, e.g. for the benchmarks to diff
+    def Snapshot(self) -> dict:
+        with self._lock:
+            return {key: (total, count) for key, (_, total, count) in self._values.items()}
+
+    def _samples(self) -> list:
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), total, count))
+                for key, (counts, total, count) in self._values.items()
+            )
+        lines = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = format_labels(
+                    self.labelnames + ("le",), key + (format_value(bound),)
+                )
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+# Returns every registered metric in the Prometheus text exposition format
+def Render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.Render())
+    return "\n".join(lines) + "\n"
+
+
+## shared by the API process and, through the progress queue, the workers
+STAGE_SECONDS = Histogram(
+    "string_scribe_stage_seconds",
+    "Time spent in each stage of the transcription pipeline",
+    ("stage",),
+)
@@ -0,0 +1,51 @@
+import time
+from metrics import Counter, Histogram
+
+REQUEST_SECONDS = Histogram(
+    "string_scribe_request_seconds",
+    "Time to serve each HTTP request, by endpoint",
+    ("method", "endpoint"),
+)
+REQUESTS = Counter(
+    "string_scribe_requests_total",
+    "HTTP requests by endpoint and status code",
+    ("method", "endpoint", "status"),
+)
+
+
+class RequestMetricsMiddleware:
+    """
+    Records the latency and status of every HTTP request.
+    Endpoints are labeled with their route template (/api/v1/jobs/{job_id}),
+    not the raw path, so job IDs don't create a new series each.
+    For streamed responses the latency covers the whole stream.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            ## the router stores the matched route in the scope
+            route = scope.get("route")
+            endpoint = getattr(route, "path", "unmatched")
+            method = scope["method"]
+            REQUEST_SECONDS.Observe(
+                time.perf_counter() - start, method=method, endpoint=endpoint
+            )
+            REQUESTS.Inc(method=method, endpoint=endpoint, status=status)
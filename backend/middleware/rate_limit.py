@@ -1,14 +1,297 @@
-import time, secrets
-from typing import Dict
+import asyncio, hashlib, json, logger, logging, os, random, secrets, sqlite3, threading, time
+from collections import OrderedDict
 from fastapi import Request
+from util import GetIntEnv
+from metrics import Gauge
 
-# Store usage data: {cookie_id: {"count": int, "reset_time": float}}
-usage_tracker: Dict[str, Dict] = {}
+log = logger.get()
 
 # Configuration
 FREE_TIER_LIMIT = 1  # Number of free translations
 RESET_PERIOD = 24 * 60 * 60  # 24 hours in seconds
 
+# Where usage is kept and how it is counted, see README for the options
+RATE_LIMIT_STORE_ENV = "RATE_LIMIT_STORE"
+RATE_LIMIT_DB_ENV = "RATE_LIMIT_DB"
+RATE_LIMIT_POLICY_ENV = "RATE_LIMIT_POLICY"
+RATE_LIMIT_MAX_SESSIONS_ENV = "RATE_LIMIT_MAX_SESSIONS"
+RATE_LIMIT_TRACE_SAMPLE_ENV = "RATE_LIMIT_TRACE_SAMPLE"
+
+STORE_MEMORY = "memory"
+STORE_SQLITE = "sqlite"
+POLICY_FIXED = "fixed"
+POLICY_SLIDING = "sliding"
+POLICY_TOKEN_BUCKET = "token_bucket"
+
+## how long an update waits for another process's write lock on the SQLite store
+SQLITE_LOCK_TIMEOUT = 2
+## suggested wait for clients when the store stays locked
+UNAVAILABLE_RETRY_AFTER = 2
+
+
+class RateLimitUnavailableError(Exception):
+    """Raised when the usage store can't be updated, e.g. another process holds its lock"""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.retry_after = UNAVAILABLE_RETRY_AFTER
+
+
+class FixedWindow:
+    """
+    The original policy: FREE_TIER_LIMIT uses, then nothing until
+    RESET_PERIOD after the session was first seen.
+    State: {"count": uses, "reset_time": when the count goes back to 0}
+    """
+
+    def __init__(self, limit: int, period: int):
+        self.limit = limit
+        self.period = period
+
+    ## cost is 1 to use one translation, -1 to give one back and 0 to just look
+    ## returns (new state, is_allowed, remaining, reset_time, expires_at, was_reset)
+    ## where was_reset means the session got its full allowance back since it was last seen
+    def Apply(self, state, now: float, cost: int):
+        was_reset = state is not None and now >= state["reset_time"]
+        if state is None or was_reset:
+            state = {"count": 0, "reset_time": now + self.period}
+        is_allowed = state["count"] < self.limit
+        if cost > 0 and is_allowed:
+            state["count"] += cost
+        elif cost < 0:
+            state["count"] = max(0, state["count"] + cost)
+        remaining = self.limit - state["count"]
+        return (
+            state,
+            is_allowed,
+            remaining,
+            state["reset_time"],
+            state["reset_time"],
+            was_reset,
+        )
+
+
+class SlidingWindow:
+    """
+    At most limit uses in any period long window, each use frees up
+    again exactly one period after it happened.
+    State: {"uses": timestamps of the uses still inside the window}
+    """
+
+    def __init__(self, limit: int, period: int):
+        self.limit = limit
+        self.period = period
+
+    def Apply(self, state, now: float, cost: int):
+        previous = (state or {}).get("uses", [])
+        uses = [t for t in previous if t > now - self.period]
+        was_reset = bool(previous) and not uses
+        is_allowed = len(uses) < self.limit
+        if cost > 0 and is_allowed:
+            uses.append(now)
+        elif cost < 0 and uses:
+            uses.pop()
+        remaining = self.limit - len(uses)
+        ## when the oldest use leaves the window, a new one is allowed
+        reset_time = uses[0] + self.period if uses else now
+        expires_at = uses[-1] + self.period if uses else now
+        return {"uses": uses}, is_allowed, remaining, reset_time, expires_at, was_reset
+
+
+class TokenBucket:
+    """
+    A bucket of limit tokens that refills continuously over period,
+    so usage is smoothed out instead of reset all at once.
+    State: {"tokens": tokens left, "updated": when tokens was computed}
+    """
+
+    def __init__(self, limit: int, period: int):
+        self.limit = limit
+        self.rate = limit / period
+
+    def Apply(self, state, now: float, cost: int):
+        was_reset = False
+        if state is None:
+            tokens = float(self.limit)
+        else:
+            elapsed = max(0.0, now - state["updated"])
+            tokens = min(float(self.limit), state["tokens"] + elapsed * self.rate)
+            was_reset = state["tokens"] < self.limit and tokens == self.limit
+        is_allowed = tokens >= 1
+        if cost > 0 and is_allowed:
+            tokens -= cost
+        elif cost < 0:
+            tokens = min(float(self.limit), tokens - cost)
+        remaining = int(tokens)
+        reset_time = now + (1 - tokens) / self.rate if tokens < 1 else now
+        ## a full bucket is the same as a session we have never seen
+        expires_at = now + (self.limit - tokens) / self.rate
+        state = {"tokens": tokens, "updated": now}
+        return state, is_allowed, remaining, reset_time, expires_at, was_reset
+
+
+class MemoryStore:
+    """
+    Per-process store. Entries are dropped once they expire, and the least
+    recently used sessions are evicted past max_entries, so memory is bounded.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        ## session ID -> (state, expires_at), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    ## atomically runs fn(state, now) -> (new state, expires_at, result) for the session
+    def Update(self, session_id: str, fn):
+        now = time.time()
+        with self.lock:
+            ## expired state is still passed on, policies handle their own expiry
+            state, _ = self.entries.get(session_id, (None, 0))
+            state, expires_at, result = fn(state, now)
+            self.entries[session_id] = (state, expires_at)
+            self.entries.move_to_end(session_id)
+            ## expired sessions collect at the front since they weren't used recently
+            while self.entries:
+                oldest = next(iter(self.entries.values()))
+                if oldest[1] > now and len(self.entries) <= self.max_entries:
+                    break
+                self.entries.popitem(last=False)
+            return result
+
+    def Size(self) -> int:
+        return len(self.entries)
+
+
+class SQLiteStore:
+    """
+    Store shared by every process on the machine through a SQLite file.
+    Each update runs in an immediate transaction, so a check and its
+    increment can't interleave with another worker's.
+    Updates block on the file, call them off the event loop.
+    """
+
+    ## expired rows are purged once every this many updates
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        ## autocommit mode, transactions are started explicitly below
+        self.conn = sqlite3.connect(
+            path,
+            timeout=SQLITE_LOCK_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            "session_id TEXT PRIMARY KEY, state TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self.lock = threading.Lock()
+        self.updates = 0
+        ## rows in the file, kept up to date by Update so /metrics doesn't query it
+        self.size = self.conn.execute("SELECT COUNT(*) FROM usage").fetchone()[0]
+
+    def Update(self, session_id: str, fn):
+        now = time.time()
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as e:
+                raise RateLimitUnavailableError(f"rate limit store is busy: {e}")
+            try:
+                row = self.conn.execute(
+                    "SELECT state FROM usage WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                state = json.loads(row[0]) if row else None
+                state, expires_at, result = fn(state, now)
+                added = 0 if row else 1
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO usage (session_id, state, expires_at) VALUES (?, ?, ?)",
+                    (session_id, json.dumps(state), expires_at),
+                )
+                self.updates += 1
+                if self.updates % self.PURGE_EVERY == 0:
+                    purged = self.conn.execute(
+                        "DELETE FROM usage WHERE expires_at <= ?", (now,)
+                    ).rowcount
+                    added -= purged
+                self.conn.execute("COMMIT")
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.size += added
+            return result
+
+    def Size(self) -> int:
+        return self.size
+
+
+def create_policy(name: str):
+    policies = {
+        POLICY_FIXED: FixedWindow,
+        POLICY_SLIDING: SlidingWindow,
+        POLICY_TOKEN_BUCKET: TokenBucket,
+    }
+    if name not in policies:
+        log.warning(f"unknown rate limit policy {name}, using {POLICY_FIXED}")
+        name = POLICY_FIXED
+    return policies[name](FREE_TIER_LIMIT, RESET_PERIOD)
+
+
+def create_store(name: str):
+    if name == STORE_SQLITE:
+        return SQLiteStore(os.getenv(RATE_LIMIT_DB_ENV, "./cache/rate_limit.sqlite3"))
+    if name != STORE_MEMORY:
+        log.warning(f"unknown rate limit store {name}, using {STORE_MEMORY}")
+    return MemoryStore(GetIntEnv(RATE_LIMIT_MAX_SESSIONS_ENV, 100000))
+
+
+policy = create_policy(os.getenv(RATE_LIMIT_POLICY_ENV, POLICY_FIXED))
+usage_store = create_store(os.getenv(RATE_LIMIT_STORE_ENV, STORE_MEMORY))
+
+## fraction of decisions traced when the log level is DEBUG
+try:
+    trace_sample = float(os.getenv(RATE_LIMIT_TRACE_SAMPLE_ENV, "0.01"))
+except ValueError:
+    trace_sample = 0.01
+
+## event counts since the process started, only touched while the store's lock is held
+stats = {
+    "allowed": 0,
+    "denied": 0,
+    "refunded": 0,
+    "new_sessions": 0,
+    "resets": 0,
+}
+
+
+def RateLimitStats() -> dict:
+    """Copy of the rate limiter's event counters"""
+    return dict(stats)
+
+
+Gauge(
+    "string_scribe_rate_limit_events_total",
+    "Free tier rate limit events (allowed, denied, refunded, new_sessions, resets)",
+    ("event",),
+    fn=lambda: [({"event": event}, count) for event, count in RateLimitStats().items()],
+    kind="counter",
+)
+Gauge(
+    "string_scribe_rate_limit_sessions",
+    "Anonymous sessions tracked by this process's rate limit store",
+    fn=lambda: usage_store.Size(),
+)
+
+
+def redact_session(session_id: str) -> str:
+    """Short stable tag for a session ID, so logs can correlate without leaking it"""
+    return hashlib.sha256(session_id.encode()).hexdigest()[:8]
+
 
 def get_or_create_session_id(request: Request) -> str:
     """Get session ID from cookie or create a new one"""
@@ -16,52 +299,51 @@ def get_or_create_session_id(request: Request) -> str:
     if not session_id:
         # Generate a simple session ID
         session_id = secrets.token_urlsafe(32)
-    print(f"[RATE LIMIT] Session ID: {session_id}")
-    print(f"[RATE LIMIT] Current tracker state: {usage_tracker}")
     return session_id
 
 
-def check_rate_limit(session_id: str) -> tuple[bool, int, int]:
+def apply_usage(session_id: str, cost: int) -> tuple[bool, int, int]:
+    """Applies cost to the session's usage, returns (is_allowed, remaining_count, reset_timestamp)"""
+
+    def update(state, now):
+        if state is None:
+            stats["new_sessions"] += 1
+        state, is_allowed, remaining, reset_time, expires_at, was_reset = policy.Apply(
+            state, now, cost
+        )
+        if was_reset:
+            stats["resets"] += 1
+        if cost > 0:
+            stats["allowed" if is_allowed else "denied"] += 1
+        elif cost < 0:
+            stats["refunded"] += 1
+        return state, expires_at, (is_allowed, remaining, int(reset_time))
+
+    is_allowed, remaining, reset_time = usage_store.Update(session_id, update)
+    ## level check first so the common case never formats anything
+    if log.isEnabledFor(logging.DEBUG) and random.random() < trace_sample:
+        log.debug(
+            f"rate limit session={redact_session(session_id)} cost={cost} "
+            f"allowed={is_allowed} remaining={remaining} reset_time={reset_time}"
+        )
+    return is_allowed, remaining, reset_time
+
+
+async def consume_usage(session_id: str) -> tuple[bool, int, int]:
     """
-    Check if user has exceeded rate limit
+    Atomically checks the rate limit and uses up a translation if allowed,
+    so concurrent requests from one session can't both get the last one
+    Raises RateLimitUnavailableError if the store can't be updated
     Returns: (is_allowed, remaining_count, reset_timestamp)
     """
-    current_time = time.time()
-
-    # Get or initialize user data
-    if session_id not in usage_tracker:
-        usage_tracker[session_id] = {
-            "count": 0,
-            "reset_time": current_time + RESET_PERIOD,
-        }
-        print(f"[RATE LIMIT] New session created for {session_id}")
-
-    user_data = usage_tracker[session_id]
-    print(f"[RATE LIMIT] Current count for {session_id}: {user_data['count']}")
-
-    # Check if reset period has passed
-    if current_time >= user_data["reset_time"]:
-        print(f"[RATE LIMIT] Resetting count for {session_id}")
-        user_data["count"] = 0
-        user_data["reset_time"] = current_time + RESET_PERIOD
-
-    # Check if limit exceeded
-    remaining = FREE_TIER_LIMIT - user_data["count"]
-    is_allowed = user_data["count"] < FREE_TIER_LIMIT
-
-    print(
-        f"[RATE LIMIT] CHECK - Count: {user_data['count']}, Limit: {FREE_TIER_LIMIT}, Allowed: {is_allowed}, Remaining: {remaining}"
-    )
-
-    return is_allowed, remaining, int(user_data["reset_time"])
-
-
-def increment_usage(session_id: str):
-    """Increment usage count for a session"""
-    if session_id in usage_tracker:
-        usage_tracker[session_id]["count"] += 1
-        print(
-            f"[RATE LIMIT] Incremented count for {session_id} to {usage_tracker[session_id]['count']}"
-        )
+    ## the SQLite store can wait on another process's lock, keep that off the event loop
+    return await asyncio.to_thread(apply_usage, session_id, 1)
+
 
-    print(f"[RATE LIMIT] Full tracker after increment: {usage_tracker}")
+async def refund_usage(session_id: str):
+    """Gives back a translation taken by consume_usage when the transcription failed"""
+    try:
+        await asyncio.to_thread(apply_usage, session_id, -1)
+    except RateLimitUnavailableError as e:
+        ## the session loses one free translation, not worth failing the request over
+        log.error(f"could not refund session {redact_session(session_id)}: {e}")
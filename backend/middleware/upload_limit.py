@@ -0,0 +1,57 @@
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+# Room for the multipart boundaries and form fields around the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+def too_large_detail(max_bytes: int) -> str:
+    return f"File size must be less than {max_bytes // (1024 * 1024)}MB"
+
+
+class UploadLimitMiddleware:
+    """
+    Rejects request bodies too large to hold a max_bytes upload before they are parsed.
+    Checks Content-Length up front, and counts the bytes of bodies that
+    don't declare a length (or lie about it) as they arrive.
+    path_limits gives routes that take several files at once a limit of their own.
+    """
+
+    def __init__(self, app, max_bytes: int, path_limits: dict = None):
+        self.app = app
+        self.limits = {
+            path: (limit + MULTIPART_OVERHEAD, too_large_detail(limit))
+            for path, limit in (path_limits or {}).items()
+        }
+        self.default = (max_bytes + MULTIPART_OVERHEAD, too_large_detail(max_bytes))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT"):
+            await self.app(scope, receive, send)
+            return
+
+        max_bytes, detail = self.limits.get(scope["path"], self.default)
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit():
+            if int(content_length) > max_bytes:
+                response = JSONResponse(
+                    status_code=413,
+                    content={"detail": detail},
+                )
+                await response(scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    ## FastAPI lets HTTPExceptions raised while reading the body through
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
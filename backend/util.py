@@ -11,3 +11,16 @@ def MustGetEnv(var_name: str) -> str:
         log.fatal(f"environment variable {var_name} not found. exiting...")
         sys.exit(1)
     return value
+
+
+## fetches a positive integer environment variable, or the default if it is unset or invalid
+def GetIntEnv(var_name: str, default: int) -> int:
+    value = os.getenv(var_name)
+    if not value:
+        return default
+    try:
+        parsed = int(value)
+    except ValueError:
+        log.warning(f"invalid value for {var_name}: {value}, using {default}")
+        return default
+    return parsed if parsed > 0 else default
@@ -1,17 +1,24 @@
 import React, { useState, useRef } from "react";
 import { Box, Button, Typography, Paper, LinearProgress } from "@mui/material";
 import { CloudUpload } from "@mui/icons-material";
-import { PurpleGradientHoverSX, PurpleGradientSX } from "../util";
+import {
+  JobStageLabel,
+  PurpleGradientHoverSX,
+  PurpleGradientSX,
+} from "../util";
+import { JobStatus } from "../types";
 import TOS from "./TOS";
 
 interface FileUploadProps {
   onFileSelect?: (file: File) => void;
   isLoading?: boolean;
+  jobStatus?: JobStatus | null;
 }
 
 const FileUpload: React.FC<FileUploadProps> = ({
   onFileSelect,
   isLoading = false,
+  jobStatus = null,
 }) => {
   const [selectedFile, setSelectedFile] = useState<File | null>(null);
   const [dragActive, setDragActive] = useState(false);
@@ -173,6 +180,8 @@ const FileUpload: React.FC<FileUploadProps> = ({
           }}
         >
           <LinearProgress
+            variant={jobStatus ? "determinate" : "indeterminate"}
+            value={(jobStatus?.progress || 0) * 100}
             sx={{
               height: 8,
               borderRadius: 4,
@@ -193,6 +202,7 @@ const FileUpload: React.FC<FileUploadProps> = ({
             }}
           >
             Processing {selectedFile?.name || "audio file..."}
+            {jobStatus && ` (${JobStageLabel(jobStatus.stage)})`}
           </Typography>
         </Box>
       )}
@@ -11,13 +11,12 @@ import { OpenSheetMusicDisplay } from "opensheetmusicdisplay";
 import generatePDF from "react-to-pdf";
 import { Midi } from "@tonejs/midi";
 import * as Tone from "tone";
-import { DecodeBase64Data } from "../util";
 
 // this is the main UI for viewing/exporting sheet music and playing the generated MIDI
 
 interface MusicViewerProps {
   selectedMxml: string;
-  selectedMidi: string; //base64 string
+  selectedMidi: Uint8Array | null; // raw MIDI file bytes
 }
 
 const MusicViewer = ({ selectedMxml, selectedMidi }: MusicViewerProps) => {
@@ -84,10 +83,9 @@ const MusicViewer = ({ selectedMxml, selectedMidi }: MusicViewerProps) => {
   // plays the generated MIDI audio
   const handlePlayMidi = async () => {
     // TODO: handle when midi gets done playing
-    if (!isPlayingMidi) {
+    if (!isPlayingMidi && selectedMidi) {
       setIsPlayingMidi(true);
-      const midiBytes = DecodeBase64Data(selectedMidi);
-      const midi = new Midi(midiBytes);
+      const midi = new Midi(selectedMidi);
       const now = Tone.now() + 0.5;
       midi.tracks.forEach((track) => {
         // schedule all of the events
@@ -9,19 +9,22 @@ import {
 } from "@mui/material";
 import { YouTube } from "@mui/icons-material";
 import TOS from "./TOS";
-import { RedGradientHoverSX, RedGradientSX } from "../util";
+import { JobStageLabel, RedGradientHoverSX, RedGradientSX } from "../util";
+import { JobStatus } from "../types";
 
 // component for transcribing via YT link
 
 interface YouTubeUploadProps {
   onUrlSubmit?: (url: string) => void;
   isLoading?: boolean;
+  jobStatus?: JobStatus | null;
   isPremium?: boolean;
 }
 
 const YouTubeUpload: React.FC<YouTubeUploadProps> = ({
   onUrlSubmit,
   isLoading = false,
+  jobStatus = null,
   isPremium = false,
 }) => {
   const [url, setUrl] = useState("");
@@ -151,6 +154,8 @@ const YouTubeUpload: React.FC<YouTubeUploadProps> = ({
           }}
         >
           <LinearProgress
+            variant={jobStatus ? "determinate" : "indeterminate"}
+            value={(jobStatus?.progress || 0) * 100}
             sx={{
               height: 8,
               borderRadius: 4,
@@ -171,6 +176,7 @@ const YouTubeUpload: React.FC<YouTubeUploadProps> = ({
             }}
           >
             Processing YouTube video...
+            {jobStatus && ` (${JobStageLabel(jobStatus.stage)})`}
           </Typography>
         </Box>
       )}
@@ -3,17 +3,25 @@ import { Container, Typography, Box, Divider } from "@mui/material";
 import { useAuth0 } from "@auth0/auth0-react";
 import FileUpload from "../components/FileUpload";
 import YouTubeUpload from "../components/YouTubeUpload";
-import { UploadFile, UploadYouTube } from "../requests";
+import {
+  FetchJobArtifacts,
+  SubmitFileJob,
+  SubmitYouTubeJob,
+  WatchJob,
+} from "../requests";
 import MusicViewer from "../components/MusicViewer";
 import { IsPro } from "../util";
 import PaywallDialog from "../components/PaywallDialog";
+import { JobArtifacts, JobFailure, JobStatus } from "../types";
 
 const Home: React.FC = () => {
   const { user } = useAuth0();
   const [isFileUploadLoading, setIsFileUploadLoading] = useState(false);
   const [isYoutubeLoading, setIsYoutubeLoading] = useState(false);
   const [mxml, setMxml] = useState("");
-  const [midi, setMidi] = useState("");
+  const [midi, setMidi] = useState<Uint8Array | null>(null);
+  // progress of the job currently running, if any
+  const [jobStatus, setJobStatus] = useState<JobStatus | null>(null);
   const isPremium = user ? IsPro(user) : false;
 
   // dialog state
@@ -23,17 +31,15 @@ const Home: React.FC = () => {
   const handleFileSelect = async (file: File) => {
     // update loading state
     setIsFileUploadLoading(true);
-    // send file to backend for processing
+    // send file to backend for processing, then follow the job's progress
     // userId is empty string if they are not signed in
-    UploadFile({ file: file }, user?.sub || "")
+    SubmitFileJob({ file: file }, user?.sub || "")
       .then((resp) => {
-        // set MXML and MIDI states
-        if (resp.data?.mxml) {
-          setMxml(resp.data.mxml);
-        }
-        if (resp.data?.midi) {
-          setMidi(resp.data.midi);
-        }
+        setJobStatus(resp.data);
+        return WatchJob(resp.data.job_id, setJobStatus).then(
+          (result) => FetchJobArtifacts(result).then(showResult),
+          (failure) => alertJobFailure(failure, "processing your file"),
+        );
       })
       .catch((error) => {
         console.error(error);
@@ -43,6 +49,12 @@ const Home: React.FC = () => {
             "You've reached your transcription limit. Please subscribe for unlimited access or try again later.",
           );
           setDialogOpen(true);
+        } else if (
+          error.response?.status === 413 ||
+          error.response?.status === 400
+        ) {
+          // file too large or not a supported audio format
+          alert(error.response.data.detail);
         } else {
           alert(
             "An error occurred while processing your file. Please try again.",
@@ -52,9 +64,32 @@ const Home: React.FC = () => {
       .finally(() => {
         // remove loading state
         setIsFileUploadLoading(false);
+        setJobStatus(null);
       });
   };
 
+  // set MXML and MIDI states from a finished job
+  const showResult = (artifacts: JobArtifacts) => {
+    if (artifacts.mxml) {
+      setMxml(artifacts.mxml);
+    }
+    if (artifacts.midi.length > 0) {
+      setMidi(artifacts.midi);
+    }
+  };
+
+  // the job was accepted but failed while running
+  const alertJobFailure = (failure: JobFailure, action: string) => {
+    console.error(failure);
+    if (failure.status === 503) {
+      alert("The server is busy right now. Please try again in a minute.");
+    } else if (failure.status === 400) {
+      alert(failure.detail);
+    } else {
+      alert(`An error occurred while ${action}. Please try again.`);
+    }
+  };
+
   const handleYouTubeSubmit = async (url: string) => {
     // check if user is logged in
     if (!user?.sub) {
@@ -64,16 +99,14 @@ const Home: React.FC = () => {
 
     // update loading state
     setIsYoutubeLoading(true);
-    // send YouTube URL to backend for processing
-    UploadYouTube(url, user.sub)
+    // send YouTube URL to backend for processing, then follow the job's progress
+    SubmitYouTubeJob(url, user.sub)
       .then((resp) => {
-        // set MXML and MIDI states
-        if (resp.data?.mxml) {
-          setMxml(resp.data.mxml);
-        }
-        if (resp.data?.midi) {
-          setMidi(resp.data.midi);
-        }
+        setJobStatus(resp.data);
+        return WatchJob(resp.data.job_id, setJobStatus).then(
+          (result) => FetchJobArtifacts(result).then(showResult),
+          (failure) => alertJobFailure(failure, "processing the YouTube video"),
+        );
       })
       .catch((error) => {
         console.error(error);
@@ -99,6 +132,7 @@ const Home: React.FC = () => {
       .finally(() => {
         // remove loading state
         setIsYoutubeLoading(false);
+        setJobStatus(null);
       });
   };
 
@@ -138,6 +172,7 @@ const Home: React.FC = () => {
           <FileUpload
             onFileSelect={handleFileSelect}
             isLoading={isFileUploadLoading}
+            jobStatus={jobStatus}
           />
 
           <Divider sx={{ my: 4 }}>
@@ -150,6 +185,7 @@ const Home: React.FC = () => {
             onUrlSubmit={handleYouTubeSubmit}
             isLoading={isYoutubeLoading}
             isPremium={isPremium}
+            jobStatus={jobStatus}
           />
         </Box>
       </Container>
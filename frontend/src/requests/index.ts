@@ -1,5 +1,11 @@
 import axios from "axios";
-import { FileUploadType } from "../types";
+import {
+  FileUploadType,
+  JobArtifacts,
+  JobFailure,
+  JobResult,
+  JobStatus,
+} from "../types";
 import { BACKEND_BASE } from "../config";
 
 // upload file to backend
@@ -27,3 +33,79 @@ export const UploadYouTube = async (url: string, userId: string) => {
     withCredentials: true,
   });
 };
+
+// submit file for transcription, resolves with the job ID right away
+export const SubmitFileJob = async (fileData: FileUploadType, userId: string) => {
+  const formData = new FormData();
+  formData.append("file", fileData.file);
+  formData.append("user_id", userId);
+  return axios.post<JobStatus>(`${BACKEND_BASE}/api/v1/jobs/upload`, formData, {
+    headers: {
+      "Content-Type": "multipart/form-data",
+    },
+    withCredentials: true,
+  });
+};
+
+// submit YouTube URL for transcription, resolves with the job ID right away
+export const SubmitYouTubeJob = async (url: string, userId: string) => {
+  const formData = new FormData();
+  formData.append("url", url);
+  formData.append("user_id", userId);
+  return axios.post<JobStatus>(
+    `${BACKEND_BASE}/api/v1/jobs/upload-youtube`,
+    formData,
+    {
+      headers: {
+        "Content-Type": "multipart/form-data",
+      },
+      withCredentials: true,
+    },
+  );
+};
+
+// follow a job's progress over server-sent events
+// resolves with links to the result, or rejects with a JobFailure
+export const WatchJob = (
+  jobId: string,
+  onStatus: (status: JobStatus) => void,
+): Promise<JobResult> =>
+  new Promise((resolve, reject) => {
+    const source = new EventSource(
+      `${BACKEND_BASE}/api/v1/jobs/${jobId}/events?response_format=artifacts`,
+    );
+    source.addEventListener("status", (e) => {
+      onStatus(JSON.parse((e as MessageEvent).data));
+    });
+    source.addEventListener("result", (e) => {
+      source.close();
+      resolve(JSON.parse((e as MessageEvent).data));
+    });
+    source.addEventListener("failed", (e) => {
+      source.close();
+      reject(JSON.parse((e as MessageEvent).data) as JobFailure);
+    });
+    // dropped connections are retried by the browser,
+    // only give up once it stops retrying (e.g. the job expired)
+    source.onerror = () => {
+      if (source.readyState === EventSource.CLOSED) {
+        reject({ detail: "Lost connection to the server", status: 0 });
+      }
+    };
+  });
+
+// download a finished job's MusicXML and MIDI
+// MusicXML comes gzip compressed and MIDI as raw bytes, so neither needs decoding by hand
+export const FetchJobArtifacts = async (
+  result: JobResult,
+): Promise<JobArtifacts> => {
+  const [mxml, midi] = await Promise.all([
+    axios.get<string>(`${BACKEND_BASE}${result.mxml_url}`, {
+      responseType: "text",
+    }),
+    axios.get<ArrayBuffer>(`${BACKEND_BASE}${result.midi_url}`, {
+      responseType: "arraybuffer",
+    }),
+  ]);
+  return { mxml: mxml.data, midi: new Uint8Array(midi.data) };
+};
@@ -1,3 +1,31 @@
 export interface FileUploadType {
   file: File;
 }
+
+// status of a transcription job, as reported by the backend
+export interface JobStatus {
+  job_id: string;
+  kind: string;
+  status: "queued" | "running" | "done" | "failed";
+  stage: string;
+  progress: number;
+  error?: string | null;
+}
+
+// final event of a job, links to the transcription's downloads
+export interface JobResult extends JobStatus {
+  mxml_url: string;
+  midi_url: string;
+}
+
+// downloaded transcription
+export interface JobArtifacts {
+  mxml: string;
+  midi: Uint8Array;
+}
+
+// final event of a job that failed
+export interface JobFailure {
+  detail: string;
+  status: number;
+}
@@ -1,14 +1,26 @@
 import { User } from "@auth0/auth0-react";
 import { AUTH0_CLAIM_NS } from "./config";
 
-export const DecodeBase64Data = (base64String: string): Uint8Array => {
-  // can I just say I hate that this is the easiest way to do this (CMIIW)
-  const decodedBinaryString = atob(base64String);
-  const actualBytes = new Uint8Array(decodedBinaryString.length);
-  for (let i = 0; i < decodedBinaryString.length; i++) {
-    actualBytes[i] = decodedBinaryString.charCodeAt(i);
+// human readable label for each transcription job stage
+export const JobStageLabel = (stage: string): string => {
+  switch (stage) {
+    case "queued":
+      return "Waiting for a free transcriber";
+    case "download":
+      return "Downloading audio";
+    case "decode":
+      return "Decoding audio";
+    case "tempo":
+      return "Detecting tempo";
+    case "inference":
+      return "Transcribing notes";
+    case "musicxml":
+      return "Writing sheet music";
+    case "done":
+      return "Done";
+    default:
+      return "Processing";
   }
-  return actualBytes;
 };
 
 // given an Auth0 user, returns whether or not they have a pro subscription